@@ -0,0 +1,49 @@
+""" pytest-benchmark scenarios against a synthetic warehouse; run with
+``py.test benchmarks``. """
+
+import os
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from gioland import bench
+
+
+@pytest.fixture(scope='module')
+def bench_app():
+    with bench.bench_warehouse() as app:
+        app.bench_tails = bench.generate_warehouse(app)
+        app.bench_targets = bench.sample_targets(app, app.bench_tails)
+        yield app
+
+
+@pytest.fixture
+def client(bench_app):
+    return bench.bench_client(bench_app)
+
+
+@pytest.mark.parametrize('url_pattern', [
+    '/search',
+    '/country/%(country)s',
+    '/lot/%(lot)s',
+    '/parcel/%(tail)s',
+    '/parcel/%(first)s/chain',
+])
+def test_view(benchmark, bench_app, client, url_pattern):
+    url = url_pattern % bench_app.bench_targets
+    benchmark(bench.fetch, client, url)
+
+
+def test_chunked_upload(benchmark, bench_app, client):
+    data = os.urandom(4 * 1024 * 1024)
+
+    def setup():
+        return (client, bench.new_upload_parcel(bench_app), data,
+                1024 * 1024), {}
+
+    benchmark.pedantic(bench.upload_chunked, setup=setup, rounds=5)
+
+
+def test_fsck(benchmark, bench_app):
+    benchmark(bench.fsck, bench_app)
@@ -0,0 +1,198 @@
+""" Paged reading of the activity log, newest first. Lines are found by
+seeking backwards through a memory-mapped file; filtering by user or
+parcel uses a sidecar index of line offsets that is brought up to date
+before each query. The parsed index is kept in memory, so a query only
+reads what was logged since the previous one. """
+
+import bisect
+import mmap
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from gioland.utils import get_lock
+
+INDEX_SUFFIX = '.idx'
+INDEX_CACHE_SIZE = 32
+USER_PATTERN = re.compile(r"\(user ([^)\s]+)\)\s*$")
+PARCEL_PATTERN = re.compile(r"path\(u?'(\w+)'\)|parcel u?'(\w+)'")
+
+
+@contextmanager
+def open_mmap(log_path):
+    """ Yield a read-only map of the file, or an empty string if it's
+    empty (which can't be mapped). """
+    with open(log_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            yield ''
+            return
+        mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            yield mm
+        finally:
+            mm.close()
+
+
+def line_keys(line):
+    """ Index keys for a log line: `user:<id>` and `parcel:<name>`. """
+    keys = set()
+    match = USER_PATTERN.search(line)
+    if match:
+        keys.add('user:' + match.group(1))
+    for match in PARCEL_PATTERN.finditer(line):
+        keys.add('parcel:' + (match.group(1) or match.group(2)))
+    return sorted(keys)
+
+
+class _Index(object):
+    """ Parsed sidecar index of one log, kept between queries so that only
+    the rows added since the last query are read. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, sidecar_inode=None):
+        self.sidecar_inode = sidecar_inode
+        self.size = 0  # bytes of the sidecar parsed so far
+        self.log_inode = None
+        self.position = 0  # log offset covered by the index
+        # replaced rather than cleared, for readers that still hold it
+        self.entries = {}
+
+    def read_new_rows(self, index_path):
+        """ Parse the rows appended to the sidecar since the last call,
+        starting over if it was replaced. """
+        try:
+            f = open(index_path, 'rb')
+        except IOError:
+            self.reset()
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.sidecar_inode or stat.st_size < self.size:
+                self.reset(stat.st_ino)
+            f.seek(self.size)
+            for row in f:
+                if not row.endswith('\n'):
+                    break
+                self.size += len(row)
+                if row.startswith('!'):
+                    self.log_inode = int(row[1:])
+                elif row.startswith('#'):
+                    self.position = int(row[1:])
+                else:
+                    offset, keys = row.split(' ', 1)
+                    for key in keys.split():
+                        self.entries.setdefault(key, []).append(int(offset))
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _get_index(index_path):
+    """ The cached index of `index_path`; the least recently used ones are
+    dropped beyond `INDEX_CACHE_SIZE`. """
+    with _indexes_lock:
+        index = _indexes.pop(index_path, None) or _Index()
+        _indexes[index_path] = index
+        while len(_indexes) > INDEX_CACHE_SIZE:
+            _indexes.popitem(last=False)
+        return index
+
+
+def update_index(log_path, line_keys=line_keys):
+    """ Index the lines appended to the log since the last update, and
+    return the `{key: [offset, ...]}` dict. """
+    index_path = log_path + INDEX_SUFFIX
+    index = _get_index(index_path)
+    with index.lock:
+        stat = os.stat(log_path)
+        if (index.log_inode == stat.st_ino and
+                index.position == stat.st_size):
+            return index.entries
+
+        lock = get_lock(index_path + '.lock')
+        try:
+            # pick up rows written by other processes
+            index.read_new_rows(index_path)
+            with open(log_path, 'rb') as f:
+                log_inode = os.fstat(f.fileno()).st_ino
+            with open_mmap(log_path) as mm:
+                if index.log_inode != log_inode or len(mm) < index.position:
+                    # a new log (rotated), or an index from before inodes
+                    # were recorded
+                    if os.path.exists(index_path):
+                        os.remove(index_path)
+                    index.reset()
+                end = mm.rfind('\n') + 1
+                if index.size and end <= index.position:
+                    return index.entries
+                rows = []
+                if not index.size:
+                    rows.append('!%d\n' % log_inode)
+                offset = index.position
+                while offset < end:
+                    next_offset = mm.find('\n', offset) + 1
+                    keys = line_keys(mm[offset:next_offset - 1])
+                    if keys:
+                        rows.append('%d %s\n' % (offset, ' '.join(keys)))
+                    offset = next_offset
+            rows.append('#%d\n' % end)
+            with open(index_path, 'ab') as f:
+                f.write(''.join(rows))
+            index.read_new_rows(index_path)
+            return index.entries
+        finally:
+            lock.close()
+
+
+def read_page(log_path, before=None, limit=100, user=None, parcel=None,
+              line_keys=line_keys):
+    """ Return up to `limit` lines older than offset `before` (the end of
+    the file if `None`), newest first, as `(lines, cursor)`. `cursor` is
+    the `before` value for the next page, or `None` if there is none. """
+    if not os.path.exists(log_path):
+        return [], None
+
+    keys = []
+    if user:
+        keys.append('user:' + user)
+    if parcel:
+        keys.append('parcel:' + parcel)
+
+    with open_mmap(log_path) as mm:
+        if before is None or before > len(mm):
+            before = len(mm)
+
+        if keys:
+            entries = update_index(log_path, line_keys)
+            offsets = set(entries.get(keys[0], []))
+            for key in keys[1:]:
+                offsets.intersection_update(entries.get(key, []))
+            offsets = sorted(offsets)
+            stop = bisect.bisect_left(offsets, before)
+            start = max(stop - limit, 0)
+            lines = []
+            for offset in reversed(offsets[start:stop]):
+                end = mm.find('\n', offset)
+                if end == -1:
+                    end = len(mm)
+                lines.append(mm[offset:end])
+            cursor = offsets[start] if start > 0 else None
+            return lines, cursor
+
+        lines = []
+        end = before
+        if end > 0 and mm[end - 1] == '\n':
+            end -= 1
+        while end > 0 and len(lines) < limit:
+            start = mm.rfind('\n', 0, end) + 1
+            lines.append(mm[start:end])
+            end = start - 1
+        cursor = end + 1 if end > 0 else None
+        return lines, cursor
@@ -0,0 +1,84 @@
+""" Structured audit log: each record of the warehouse logger is also
+written as a JSON line to `audit/<day>.jsonl` in the warehouse folder.
+Queries by parcel or user go through the same sidecar offset index as
+the activity log viewer, which keeps the parsed index of each day file
+in memory and only indexes the records added since the last query. """
+
+import json
+import logging
+import os
+import re
+from datetime import datetime
+
+from gioland import activitylog
+
+AUDIT_DIR_NAME = 'audit'
+DAY_FILE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2})\.jsonl$')
+
+
+def _day_path(audit_dir, day):
+    return os.path.join(audit_dir, '%s.jsonl' % day)
+
+
+class AuditHandler(logging.Handler):
+
+    def __init__(self, audit_dir):
+        logging.Handler.__init__(self)
+        self.audit_dir = audit_dir
+
+    def emit(self, record):
+        try:
+            time = datetime.utcfromtimestamp(record.created)
+            audit = getattr(record, 'audit', {})
+            entry = {
+                'time': time.isoformat(),
+                'level': record.levelname,
+                'event': audit.get('event'),
+                'user': audit.get('user'),
+                'parcel': audit.get('parcel'),
+                'data': audit.get('data', {}),
+                'message': record.getMessage(),
+            }
+            line = json.dumps(entry, default=unicode, sort_keys=True) + '\n'
+            day_path = _day_path(self.audit_dir, time.date().isoformat())
+            with open(day_path, 'ab') as f:
+                f.write(line)
+        except Exception:
+            self.handleError(record)
+
+
+def record_keys(line):
+    record = json.loads(line)
+    keys = []
+    if record.get('user'):
+        keys.append('user:' + record['user'])
+    if record.get('parcel'):
+        keys.append('parcel:' + record['parcel'])
+    return keys
+
+
+def list_days(audit_dir):
+    if not os.path.isdir(audit_dir):
+        return []
+    return sorted(m.group(1) for m in map(DAY_FILE_PATTERN.match,
+                                         os.listdir(audit_dir)) if m)
+
+
+def query(audit_dir, parcel=None, user=None, since=None, until=None,
+          limit=100):
+    """ Return up to `limit` records, newest first, optionally only those
+    of one `parcel` and/or `user`, between the days (`YYYY-MM-DD`)
+    `since` and `until`, inclusive. """
+    records = []
+    for day in reversed(list_days(audit_dir)):
+        if until is not None and day > until:
+            continue
+        if since is not None and day < since:
+            break
+        lines, _cursor = activitylog.read_page(
+            _day_path(audit_dir, day), limit=limit - len(records),
+            user=user, parcel=parcel, line_keys=record_keys)
+        records.extend(json.loads(line) for line in lines)
+        if len(records) >= limit:
+            break
+    return records
@@ -1,13 +1,22 @@
+import logging
+import os
+import threading
+import time
 from functools import wraps
 
 import flask
 import ldap
+import ldap.filter
 import urlparse
 from eea.usersdb import UsersDB
 
+from gioland import ldappool
 from gioland.definitions import ALL_ROLES
 from gioland.utils import cached
 
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
 auth_views = flask.Blueprint('auth', __name__)
 
 
@@ -32,8 +41,8 @@ def login():
             user_id = username.lower()
             if ldapconn.bind(user_id, form['password']):
                 flask.session['username'] = user_id
-                flask.flash("Login successful as %s" % ldap_full_name(user_id),
-                            'system')
+                flask.flash("Login successful as %s" %
+                            (ldap_full_name(user_id) or user_id), 'system')
                 return flask.redirect(next)
 
             else:
@@ -48,7 +57,7 @@ def login():
     user_id = flask.g.username
     return flask.render_template('auth_login.html', **{
         'user_id': user_id,
-        'full_name': ldap_full_name(user_id) if user_id else None,
+        'full_name': (ldap_full_name(user_id) or user_id) if user_id else None,
         'next': next,
     })
 
@@ -61,70 +70,264 @@ def impersonate():
     user_id = flask.request.form['user_id']
     app.logger.warn("User %r impersonating %r", flask.g.username, user_id)
     flask.session['username'] = user_id
-    flask.flash("Login successful as %s" % ldap_full_name(user_id), 'system')
+    flask.flash("Login successful as %s" %
+                (ldap_full_name(user_id) or user_id), 'system')
     return flask.redirect(flask.url_for('auth.login'))
 
 
-@cached(timeout=5 * 60)
+LDAP_BATCH_SIZE = 50
+
+
+@cached(timeout=5 * 60, negative_timeout=60, stale=5 * 60)
 def ldap_full_name(user_id):
+    prefetched = getattr(flask.g, 'ldap_full_names', {})
+    if user_id in prefetched:
+        return prefetched[user_id]
     return LdapConnection(flask.current_app).get_user_name(user_id)
 
 
+def prefetch_full_names(user_ids):
+    """ Resolve names for `user_ids` with as few LDAP searches as possible
+    and remember them for the rest of the request. """
+    prefetched = getattr(flask.g, 'ldap_full_names', None)
+    if prefetched is None:
+        prefetched = flask.g.ldap_full_names = {}
+    missing = sorted(set(u for u in user_ids if u) - set(prefetched))
+    if not missing:
+        return
+
+    cached_names = ldap_full_name.lookup_many([(u,) for u in missing])
+    for (user_id,), name in cached_names.items():
+        prefetched[user_id] = name
+    missing = [u for u in missing if u not in prefetched]
+    if not missing:
+        return
+
+    found = LdapConnection(flask.current_app).get_user_names(missing)
+    for user_id in missing:
+        name = found.get(user_id)
+        ldap_full_name.prime((user_id,), name)
+        prefetched[user_id] = name
+
+
+_ldap_pool_lock = threading.Lock()
+
+
+def get_ldap_pool(app=None):
+    if app is None:
+        app = flask.current_app
+    if 'gioland-ldap-pool' not in app.extensions:
+        with _ldap_pool_lock:
+            if 'gioland-ldap-pool' not in app.extensions:
+                server = app.config['LDAP_SERVER']
+                timeout = app.config['LDAP_TIMEOUT']
+                pool = ldappool.LdapPool(
+                    lambda: ldappool.connect(server, timeout),
+                    size=app.config['LDAP_POOL_SIZE'],
+                    idle_timeout=app.config['LDAP_POOL_IDLE_TIMEOUT'])
+                app.extensions['gioland-ldap-pool'] = pool
+    return app.extensions['gioland-ldap-pool']
+
+
+class PooledUsersDB(UsersDB):
+    """ A UsersDB that doesn't open a connection of its own: its queries
+    run on the pooled connection checked out by the current thread. """
+
+    def __init__(self, **config):
+        self._local = threading.local()
+        super(PooledUsersDB, self).__init__(**config)
+
+    def connect(self, server):
+        return None
+
+    @property
+    def conn(self):
+        return getattr(self._local, 'conn', None)
+
+    @conn.setter
+    def conn(self, conn):
+        self._local.conn = conn
+
+
+def get_users_db(app=None):
+    if app is None:
+        app = flask.current_app
+    if 'gioland-users-db' not in app.extensions:
+        with _ldap_pool_lock:
+            if 'gioland-users-db' not in app.extensions:
+                ldap_server = urlparse.urlsplit(
+                    app.config['LDAP_SERVER']).netloc
+                app.extensions['gioland-users-db'] = \
+                    PooledUsersDB(ldap_server=ldap_server)
+    return app.extensions['gioland-users-db']
+
+
 class LdapConnection(object):
 
     def __init__(self, app):
-        ldap_server = app.config['LDAP_SERVER']
-        if ldap_server is None:
-            self.conn = None
+        if app.config['LDAP_SERVER'] is None:
+            self.pool = None
         else:
-            self.conn = ldap.initialize(ldap_server)
-            self.conn.protocol_version = ldap.VERSION3
-            self.conn.timeout = app.config['LDAP_TIMEOUT']
+            self.pool = get_ldap_pool(app)
             self._user_dn_pattern = app.config['LDAP_USER_DN_PATTERN']
 
     def get_user_dn(self, user_id):
         return self._user_dn_pattern.format(user_id=user_id)
 
     def bind(self, user_id, password):
-        if self.conn is None:
+        if self.pool is None:
             return False
         user_dn = self.get_user_dn(user_id)
-        try:
-            result = self.conn.simple_bind_s(user_dn, password)
-        except (ldap.INVALID_CREDENTIALS, ldap.UNWILLING_TO_PERFORM):
-            return False
-        assert result[:2] == (ldap.RES_BIND, [])
-        return True
+
+        def simple_bind(conn):
+            try:
+                result = conn.simple_bind_s(user_dn, password)
+            except (ldap.INVALID_CREDENTIALS, ldap.UNWILLING_TO_PERFORM):
+                return False
+            assert result[:2] == (ldap.RES_BIND, [])
+            return True
+
+        return self.pool.run(simple_bind, restore_identity=True)
 
     def get_user_name(self, user_id):
-        if self.conn is None:
+        if self.pool is None:
             return u""
         user_dn = self.get_user_dn(user_id)
-        result2 = self.conn.search_s(user_dn, ldap.SCOPE_BASE)
+        try:
+            result2 = self.pool.run(
+                lambda conn: conn.search_s(user_dn, ldap.SCOPE_BASE))
+        except ldap.NO_SUCH_OBJECT:
+            return None
         [[_dn, attr]] = result2
         return attr['cn'][0].decode('utf-8')
 
+    def get_user_names(self, user_ids):
+        if self.pool is None:
+            return {user_id: u"" for user_id in user_ids}
+        rdn, base_dn = self._user_dn_pattern.split(',', 1)
+        id_attr, id_value = rdn.split('=', 1)
+        if id_value != '{user_id}':
+            return {user_id: self.get_user_name(user_id)
+                    for user_id in user_ids}
+
+        names = {}
+        requested = {user_id.lower(): user_id for user_id in user_ids}
+        user_ids = list(user_ids)
+        for i in xrange(0, len(user_ids), LDAP_BATCH_SIZE):
+            batch = user_ids[i:i + LDAP_BATCH_SIZE]
+            query = ''.join('(%s=%s)' % (id_attr,
+                                         ldap.filter.escape_filter_chars(u))
+                            for u in batch)
+            result = self.pool.run(lambda conn: conn.search_s(
+                base_dn, ldap.SCOPE_ONELEVEL, '(|%s)' % query,
+                [id_attr, 'cn']))
+            for _dn, attr in result:
+                user_id = requested.get(attr[id_attr][0].lower())
+                if user_id is not None:
+                    names[user_id] = attr['cn'][0].decode('utf-8')
+        return names
+
+
+def _roles_config(config):
+    return tuple(sorted((name, tuple(value)) for name, value in config.items()
+                        if name.startswith('ROLE_')))
+
+
+class RoleResolver(object):
+
+    def __init__(self, config):
+        self.roles_config = _roles_config(config)
+        self.roles_by_user = {}
+        self.roles_by_group = {}
+        for role_name, principals in self.roles_config:
+            for principal in principals:
+                if principal.startswith('user_id:'):
+                    user_id = principal[len('user_id:'):]
+                    self.roles_by_user.setdefault(user_id, set()) \
+                        .add(role_name)
+                elif principal.startswith('ldap_group:'):
+                    group_name = principal[len('ldap_group:'):]
+                    self.roles_by_group.setdefault(group_name, set()) \
+                        .add(role_name)
+
+    def resolve(self, user_id):
+        roles = set(self.roles_by_user.get(user_id, ()))
+        if self.roles_by_group:
+            for group_name in get_ldap_groups(user_id):
+                roles.update(self.roles_by_group.get(group_name, ()))
+        return frozenset(roles)
+
+
+class GroupRefresher(object):
+    """ Re-fetches LDAP groups of recently active users in a background
+    thread, so that `authorize` rarely has to wait for LDAP. """
+
+    def __init__(self, app, interval, max_idle=30 * 60):
+        self.app = app
+        self.interval = interval
+        self.max_idle = max_idle
+        self._users = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def track(self, user_id):
+        with self._lock:
+            self._users[user_id] = time.time()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='gioland-ldap-groups')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.refresh()
+
+    def refresh(self):
+        cutoff = time.time() - self.max_idle
+        with self._lock:
+            for user_id, last_seen in self._users.items():
+                if last_seen < cutoff:
+                    del self._users[user_id]
+            user_ids = list(self._users)
+        with self.app.app_context():
+            for user_id in user_ids:
+                try:
+                    get_ldap_groups.refresh(user_id)
+                except Exception:
+                    log.exception("Failed to refresh LDAP groups of %r",
+                                  user_id)
+
+
+def reload_roles(app):
+    """ Compile the `ROLE_*` settings of `app` again; call this after
+    changing them. """
+    app.extensions['gioland-roles'] = RoleResolver(app.config)
+
+
+def get_role_resolver():
+    return flask.current_app.extensions['gioland-roles']
+
+
+def get_user_roles(user_id):
+    memo = getattr(flask.g, 'user_roles', None)
+    if memo is not None and memo[0] == user_id:
+        return memo[1]
+    resolver = get_role_resolver()
+    roles = resolver.resolve(user_id)
+    refresher = flask.current_app.extensions.get('gioland-groups-refresher')
+    if refresher is not None and resolver.roles_by_group:
+        refresher.track(user_id)
+    flask.g.user_roles = (user_id, roles)
+    return roles
+
 
 def authorize(role_names):
     user_id = flask.g.username
     if user_id is None:
         return False
-    config = flask.current_app.config
-
-    def has_role(role_name):
-        for principal in config.get(role_name, []):
-            if principal == 'user_id:' + user_id:
-                return True
-
-            elif principal.startswith('ldap_group:'):
-                group_name = principal[len('ldap_group:'):]
-                if group_name in get_ldap_groups(user_id):
-                    return True
-
-        else:
-            return False
-
-    return any(has_role(role_name) for role_name in role_names)
+    return not get_user_roles(user_id).isdisjoint(role_names)
 
 
 def require_admin(func):
@@ -143,19 +346,55 @@ def roles_debug():
     return flask.render_template('auth_roles_debug.html', ALL_ROLES=ALL_ROLES)
 
 
+LOGS_PAGE_SIZE = 200
+LOGS_MAX_PAGE_SIZE = 5000
+
+
 @auth_views.route('/logs')
 @require_admin
 def view_logs():
-    from gioland import warehouse
+    from gioland import activitylog, warehouse
+    app = flask.current_app
+    args = flask.request.args
+    warehouse_log_file = os.path.join(app.config['WAREHOUSE_PATH'],
+                                      warehouse.LOG_FILE_NAME)
+    limit = min(args.get('limit', LOGS_PAGE_SIZE, type=int), LOGS_MAX_PAGE_SIZE)
+    filters = {'user': args.get('user') or None,
+               'parcel': args.get('parcel') or None}
+    lines, cursor = activitylog.read_page(warehouse_log_file,
+                                          before=args.get('before', type=int),
+                                          limit=max(limit, 1), **filters)
+    lines = [line.decode('utf-8', 'replace') for line in lines]
+    return flask.render_template('auth_logs.html', lines=lines,
+                                 cursor=cursor, limit=limit, filters=filters)
+
+
+@auth_views.route('/logs/audit')
+@require_admin
+def query_audit_log():
+    from gioland import audit
     app = flask.current_app
-    warehouse_log_file = app.config['WAREHOUSE_PATH'] / warehouse.LOG_FILE_NAME
-    with warehouse_log_file.open('rb') as log_file:
-        return flask.render_template('auth_logs.html', log_file=log_file)
+    args = flask.request.args
+    audit_dir = os.path.join(app.config['WAREHOUSE_PATH'],
+                             audit.AUDIT_DIR_NAME)
+    limit = min(args.get('limit', LOGS_PAGE_SIZE, type=int), LOGS_MAX_PAGE_SIZE)
+    records = audit.query(audit_dir,
+                          parcel=args.get('parcel') or None,
+                          user=args.get('user') or None,
+                          since=args.get('since') or None,
+                          until=args.get('until') or None,
+                          limit=max(limit, 1))
+    return flask.jsonify({'records': records})
 
 
 def register_on(app):
     app.register_blueprint(auth_views)
     app.before_request(set_user)
+    reload_roles(app)
+    refresh_interval = app.config['LDAP_GROUPS_REFRESH_INTERVAL']
+    if app.config['CACHING'] and refresh_interval and not app.testing:
+        app.extensions['gioland-groups-refresher'] = \
+            GroupRefresher(app, refresh_interval)
 
     @app.context_processor
     def inject():
@@ -164,9 +403,16 @@ def register_on(app):
         }
 
 
-@cached(timeout=5 * 60)
+@cached(timeout=5 * 60, stale=5 * 60)
 def get_ldap_groups(user_id):
     app = flask.current_app
-    ldap_server = urlparse.urlsplit(app.config['LDAP_SERVER']).netloc
-    udb = UsersDB(ldap_server=ldap_server)
-    return [r for r, _info in udb.member_roles_info('user', user_id)]
+    udb = get_users_db(app)
+
+    def member_roles(conn):
+        udb.conn = conn
+        try:
+            return [r for r, _info in udb.member_roles_info('user', user_id)]
+        finally:
+            udb.conn = None
+
+    return get_ldap_pool(app).run(member_roles)
@@ -0,0 +1,457 @@
+""" Synthetic warehouse generator and benchmarks for the views and
+operations that slow down as the warehouse grows. Used by `manage.py
+bench` and by the pytest-benchmark module in `benchmarks/`. """
+
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from StringIO import StringIO
+
+import flask
+from path import path
+
+from gioland import parcel as parcel_module
+from gioland.definitions import COUNTRY, COUNTRY_PRODUCTS_IDS, COUNTRIES
+from gioland.definitions import LOT, LOTS, PARTIAL, REFERENCES, RESOLUTIONS
+from gioland.definitions import FULL, INITIAL_STAGE, PRODUCTS_IDS
+from gioland.warehouse import checksum, get_warehouse
+
+BENCH_USER = 'bench'
+
+DEFAULTS = {
+    'chains': 50,
+    'chain_length': 4,
+    'fan_in': 1,
+    'history': 5,
+    'file_size': 64 * 1024,
+    'seed': 0,
+}
+
+RUN_DEFAULTS = {
+    'repeat': 5,
+    'upload_size': 4 * 1024 * 1024,
+    'chunk_size': 1024 * 1024,
+}
+
+COMPARE_TOLERANCE = 0.1
+COMPARE_NOISE = 3
+
+
+def create_bench_app(warehouse_path, **config):
+    """ App with its own warehouse, no notifications and `BENCH_USER` as
+    administrator. """
+    from manage import create_app
+    warehouse_path = path(warehouse_path)
+    bench_config = {
+        'WAREHOUSE_PATH': str(warehouse_path),
+        'LOCK_FILE_PATH': str(warehouse_path / 'lockfile'),
+        'SECRET_KEY': 'bench',
+        'UNS_SUPPRESS_NOTIFICATIONS': True,
+        'ROLE_ADMIN': ['user_id:' + BENCH_USER],
+        'CACHING': False,
+    }
+    bench_config.update(config)
+    return create_app(bench_config, testing=True)
+
+
+def bench_client(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['username'] = BENCH_USER
+    return client
+
+
+def write_file(file_path, size):
+    block = os.urandom(min(size, 64 * 1024)) if size else ''
+    with open(file_path, 'wb') as f:
+        written = 0
+        while written < size:
+            data = block[:size - written]
+            f.write(data)
+            written += len(data)
+
+
+def _add_history(parcel, count):
+    for i in range(count):
+        parcel.add_history_item("Comment", datetime.utcnow(), BENCH_USER,
+                                "<p>Synthetic comment %d</p>" % i)
+
+
+def _fill_parcel(parcel, history, file_size):
+    if file_size:
+        write_file(parcel.get_path() / 'data.gml', file_size)
+    _add_history(parcel, history)
+
+
+def _start_chain(wh, rnd, delivery_type, extent=FULL):
+    metadata = {
+        'delivery_type': delivery_type,
+        'stage': INITIAL_STAGE[delivery_type],
+        'lot': rnd.choice(LOTS)[0],
+        'resolution': rnd.choice(RESOLUTIONS)[0],
+        'reference': rnd.choice(REFERENCES)[0],
+    }
+    if delivery_type == COUNTRY:
+        metadata['country'] = rnd.choice(COUNTRIES)[0]
+        metadata['product'] = rnd.choice(COUNTRY_PRODUCTS_IDS)
+    else:
+        metadata['extent'] = extent
+        metadata['product'] = rnd.choice(PRODUCTS_IDS)
+    parcel = wh.new_parcel()
+    parcel.save_metadata(metadata)
+    parcel.add_history_item("New upload", datetime.utcnow(), BENCH_USER, "")
+    return parcel
+
+
+def _finalize(wh, parcel, steps_left):
+    """ Finalize `parcel`, rejecting it when the chain would otherwise
+    reach its last stage before `steps_left` runs out. """
+    stages, order = parcel_module._get_stages_for_parcel(parcel)
+    stage = parcel.metadata['stage']
+    to_last = len(order) - 1 - order.index(stage)
+    reject = bool(stages[stage].get('reject') and steps_left > to_last)
+    parcel_module.finalize_parcel(wh, parcel, reject)
+    return wh.get_parcel(parcel.metadata['next_parcel'])
+
+
+def _merge(wh, partial_parcels):
+    """ Merge partial lot parcels into a full one, the way
+    `finalize_and_merge_parcel` does. """
+    stages, order = parcel_module._get_stages_for_parcel(partial_parcels[0])
+    stage = partial_parcels[0].metadata['stage']
+    next_stage = order[order.index(stage) + 1]
+    for partial_parcel in partial_parcels:
+        parcel_module.close_prev_parcel(partial_parcel, merged=True)
+    next_parcel = parcel_module.create_next_parcel(
+        wh, partial_parcels, next_stage, stages[stage], stages[next_stage])
+    next_parcel.save_metadata({'extent': FULL})
+    for partial_parcel in partial_parcels:
+        parcel_module.link_to_next_parcel(next_parcel, partial_parcel,
+                                          stages[stage], stages[next_stage])
+    return next_parcel
+
+
+def _build_chain(wh, rnd, delivery_type, chain_length, fan_in, history,
+                 file_size):
+    if delivery_type == LOT and fan_in > 1:
+        first = _start_chain(wh, rnd, LOT, extent=PARTIAL)
+        partial_parcels = [first]
+        for i in range(fan_in - 1):
+            partial = wh.new_parcel()
+            partial.save_metadata(dict(first.metadata))
+            partial_parcels.append(partial)
+        for partial in partial_parcels:
+            _fill_parcel(partial, history, file_size)
+        partial_parcels = [_finalize(wh, partial, 0)
+                           for partial in partial_parcels]
+        for partial in partial_parcels:
+            _fill_parcel(partial, history, file_size)
+        parcel = _merge(wh, partial_parcels)
+        chain_length -= 2
+    else:
+        parcel = _start_chain(wh, rnd, delivery_type)
+
+    for steps_left in range(chain_length - 1, 0, -1):
+        stages, _ = parcel_module._get_stages_for_parcel(parcel)
+        if stages[parcel.metadata['stage']].get('last'):
+            break
+        _fill_parcel(parcel, history, file_size)
+        parcel = _finalize(wh, parcel, steps_left)
+    _fill_parcel(parcel, history, file_size)
+    return parcel
+
+
+def generate_warehouse(app, chains=DEFAULTS['chains'],
+                       chain_length=DEFAULTS['chain_length'],
+                       fan_in=DEFAULTS['fan_in'], history=DEFAULTS['history'],
+                       file_size=DEFAULTS['file_size'], seed=DEFAULTS['seed']):
+    """ Fill the warehouse of `app` with `chains` delivery chains, each
+    about `chain_length` parcels long, alternating between country and lot
+    deliveries. With a `fan_in` above 1, lot chains start with that many
+    partial parcels, merged into one after validation. Every parcel gets
+    `history` comments and a `file_size` file. Returns the names of the
+    chain tails. """
+    rnd = random.Random(seed)
+    tails = []
+    for i in range(chains):
+        with app.test_request_context('/search'):
+            flask.g.username = BENCH_USER
+            wh = get_warehouse()
+            delivery_type = LOT if i % 2 else COUNTRY
+            tail = _build_chain(wh, rnd, delivery_type, chain_length, fan_in,
+                                history, file_size)
+            tails.append(str(tail.name))
+    return tails
+
+
+def summarize(durations):
+    durations = sorted(durations)
+    n = len(durations)
+    middle = n // 2
+    if n % 2:
+        median = durations[middle]
+    else:
+        median = (durations[middle - 1] + durations[middle]) / 2.0
+    deviations = sorted(abs(d - median) for d in durations)
+    return {
+        'n': n,
+        'min': durations[0],
+        'max': durations[-1],
+        'mean': sum(durations) / n,
+        'median': median,
+        'mad': deviations[middle],
+    }
+
+
+def time_call(func, repeat):
+    durations = []
+    for i in range(repeat):
+        t0 = time.time()
+        func()
+        durations.append(time.time() - t0)
+    return summarize(durations)
+
+
+def fetch(client, url):
+    resp = client.get(url)
+    resp.close()
+    if resp.status_code != 200:
+        raise RuntimeError("GET %s returned %d" % (url, resp.status_code))
+
+
+def new_upload_parcel(app):
+    with app.test_request_context('/search'):
+        flask.g.username = BENCH_USER
+        parcel = get_warehouse().new_parcel()
+        parcel.save_metadata({
+            'delivery_type': COUNTRY,
+            'stage': INITIAL_STAGE[COUNTRY],
+            'country': 'dk',
+            'lot': 'lot1',
+            'product': COUNTRY_PRODUCTS_IDS[0],
+            'resolution': '20m',
+            'reference': '2015',
+        })
+        return parcel.name
+
+
+def upload_chunked(client, name, data, chunk_size, filename='data.gml'):
+    """ Upload `data` the way resumable.js does: one POST per chunk, then
+    a POST to `finalize_upload`. """
+    form = {
+        'resumableFilename': filename,
+        'resumableIdentifier': 'bench_' + filename.replace('.', '_'),
+        'resumableTotalSize': str(len(data)),
+    }
+    for n, offset in enumerate(range(0, len(data), chunk_size), 1):
+        chunk = data[offset:offset + chunk_size]
+        chunk_form = dict(form, resumableChunkNumber=str(n),
+                          resumableChunkSize=str(len(chunk)),
+                          file=(StringIO(chunk), filename))
+        resp = client.post('/parcel/%s/chunk' % name, data=chunk_form)
+        resp.close()
+        if resp.status_code != 200:
+            raise RuntimeError("Chunk upload returned %d" % resp.status_code)
+    resp = client.post('/parcel/%s/finalize_upload' % name, data=form)
+    resp.close()
+    if resp.status_code != 200:
+        raise RuntimeError("Finalize upload returned %d" % resp.status_code)
+
+
+def fsck(app):
+    with app.test_request_context():
+        wh = get_warehouse()
+        return [p.name for p in wh.get_all_parcels()
+                if checksum(p.get_path()) != getattr(p, 'checksum', [])]
+
+
+def sample_targets(app, tails):
+    """ A country, a lot and a chain that exist in the generated
+    warehouse. """
+    with app.test_request_context():
+        wh = get_warehouse()
+        tail_parcels = [wh.get_parcel(name) for name in tails]
+        country = next((p.metadata['country'] for p in tail_parcels
+                        if p.metadata['delivery_type'] == COUNTRY), 'dk')
+        lot = next((p.metadata['lot'] for p in tail_parcels
+                    if p.metadata['delivery_type'] == LOT), 'lot1')
+        first = tails[0]
+        while wh.get_parcel(first).metadata.get('prev_parcel_list'):
+            first = wh.get_parcel(first).metadata['prev_parcel_list'][0]
+    return {'country': country, 'lot': lot, 'tail': tails[0], 'first': first}
+
+
+def run(app, tails, repeat=RUN_DEFAULTS['repeat'],
+        upload_size=RUN_DEFAULTS['upload_size'],
+        chunk_size=RUN_DEFAULTS['chunk_size']):
+    """ Time the views, a chunked upload and fsck against the warehouse of
+    `app`. Returns a dict of timing summaries in seconds. """
+    client = bench_client(app)
+    targets = sample_targets(app, tails)
+    urls = {
+        'search': '/search',
+        'country': '/country/%s' % targets['country'],
+        'lot': '/lot/%s' % targets['lot'],
+        'parcel': '/parcel/%s' % targets['tail'],
+        'chain': '/parcel/%s/chain' % targets['first'],
+    }
+    results = {}
+    for key, url in sorted(urls.items()):
+        fetch(client, url)
+        results[key] = time_call(lambda: fetch(client, url), repeat)
+        results[key]['url'] = url
+
+    data = os.urandom(upload_size)
+    upload_names = [new_upload_parcel(app) for i in range(repeat)]
+    upload_names.reverse()
+    results['upload'] = time_call(
+        lambda: upload_chunked(client, upload_names.pop(), data, chunk_size),
+        repeat)
+    results['upload']['bytes'] = upload_size
+    results['upload']['mb_per_second'] = (
+        upload_size / float(1024 * 1024) / results['upload']['median'])
+
+    results['fsck'] = time_call(lambda: fsck(app), repeat)
+    return results
+
+
+@contextmanager
+def bench_warehouse(**config):
+    """ Temporary warehouse and the app that serves it. """
+    tmp = path(tempfile.mkdtemp(prefix='gioland-bench-'))
+    app = create_bench_app(tmp / 'warehouse', **config)
+    try:
+        yield app
+    finally:
+        app.extensions['warehouse_connector'].close()
+        tmp.rmtree()
+
+
+def run_report(**options):
+    """ Generate a warehouse and run the benchmarks against it. `options`
+    are those of `generate_warehouse` and `run`; the report records them,
+    so that a later run can repeat the same workload. """
+    options = dict(DEFAULTS, **dict(RUN_DEFAULTS, **options))
+    generate_options = {k: options[k] for k in DEFAULTS}
+    run_options = {k: options[k] for k in RUN_DEFAULTS}
+    with bench_warehouse() as app:
+        t0 = time.time()
+        tails = generate_warehouse(app, **generate_options)
+        generate_seconds = time.time() - t0
+        results = run(app, tails, **run_options)
+    return {
+        'options': options,
+        'generate_seconds': generate_seconds,
+        'results': results,
+    }
+
+
+def git_revision(repo_path=None):
+    """ Current commit of the source tree, with a `+dirty` suffix when
+    there are local changes, or None outside a git checkout. """
+    repo_path = repo_path or os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__)))
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=repo_path).strip()
+        changes = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=repo_path)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('+dirty' if changes.strip() else '')
+
+
+def machine_fingerprint():
+    """ Short hash of what makes timings from two machines incomparable:
+    host, CPU and Python build. """
+    description = '|'.join([
+        platform.node(),
+        platform.machine(),
+        platform.processor(),
+        str(multiprocessing.cpu_count()),
+        platform.python_implementation(),
+        platform.python_version(),
+    ])
+    return hashlib.sha1(description).hexdigest()[:12]
+
+
+def load_runs(store_path):
+    if not os.path.exists(store_path):
+        return []
+    with open(store_path, 'rb') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def store_run(store_path, report, revision, machine):
+    """ Append `report` to the JSON lines file at `store_path`, keyed by
+    `revision` and `machine`. Returns the stored record. """
+    record = dict(report, revision=revision, machine=machine,
+                  time=datetime.utcnow().isoformat())
+    with open(store_path, 'ab') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+    return record
+
+
+def find_run(runs, machine, revision=None, exclude_revision=None):
+    """ Latest run on `machine`, for `revision` (a prefix is enough) or
+    else for any revision other than `exclude_revision`. """
+    for record in reversed(runs):
+        if record['machine'] != machine:
+            continue
+        if revision is not None:
+            if (record['revision'] or '').startswith(revision):
+                return record
+        elif record['revision'] != exclude_revision:
+            return record
+    return None
+
+
+def option_differences(base, new):
+    """ Names of the options that differ between two reports, whose
+    timings then can't be compared. """
+    names = set(base['options']) | set(new['options'])
+    return sorted(name for name in names
+                  if base['options'].get(name) != new['options'].get(name))
+
+
+def compare(base, new, tolerance=COMPARE_TOLERANCE, noise=COMPARE_NOISE):
+    """ Compare the median timings of two reports. A scenario has
+    regressed when it got slower by more than `tolerance` (a fraction of
+    the base median) and by more than `noise` times the combined median
+    absolute deviation of both runs; improvements are judged the same
+    way. Returns rows of (name, base median, new median, change, status),
+    where status is 'regression', 'improvement' or 'ok'. """
+    rows = []
+    for name in sorted(set(base['results']) & set(new['results'])):
+        before = base['results'][name]
+        after = new['results'][name]
+        delta = after['median'] - before['median']
+        change = delta / before['median'] if before['median'] else 0.0
+        threshold = max(tolerance * before['median'],
+                        noise * (before.get('mad', 0) + after.get('mad', 0)))
+        if delta > threshold:
+            status = 'regression'
+        elif -delta > threshold:
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append((name, before['median'], after['median'], change, status))
+    return rows
+
+
+def format_comparison(rows):
+    lines = ["%-10s %12s %12s %8s  %s" % ('scenario', 'base (ms)',
+                                          'new (ms)', 'change', 'status')]
+    for name, before, after, change, status in rows:
+        lines.append("%-10s %12.2f %12.2f %+7.1f%%  %s" % (
+            name, before * 1000, after * 1000, change * 100, status))
+    return '\n'.join(lines)
@@ -0,0 +1,182 @@
+import cPickle as pickle
+import os
+import threading
+from collections import OrderedDict
+from time import time
+
+from werkzeug.contrib.cache import BaseCache, FileSystemCache
+from werkzeug.contrib.cache import MemcachedCache, NullCache, RedisCache
+
+
+class LRUCache(BaseCache):
+    """ In-process cache that evicts the least recently used items once it
+    holds more than `threshold` items or `max_bytes` of pickled data. """
+
+    def __init__(self, threshold=500, max_bytes=None, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self._threshold = threshold
+        self._max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._cache.pop(key, None)
+            if item is None:
+                return None
+            expires, data = item
+            if expires <= time():
+                self._size -= len(data)
+                return None
+            self._cache[key] = item
+        return pickle.loads(data)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self._size -= len(old[1])
+            self._cache[key] = (time() + timeout, data)
+            self._size += len(data)
+            self._prune()
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is None:
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self._size -= len(old[1])
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._size = 0
+
+    def _over_limit(self):
+        if len(self._cache) > self._threshold:
+            return True
+        return self._max_bytes is not None and self._size > self._max_bytes
+
+    def _prune(self):
+        while self._cache and self._over_limit():
+            _key, (_expires, data) = self._cache.popitem(last=False)
+            self._size -= len(data)
+
+
+class FileSystemLRUCache(FileSystemCache):
+    """ Cache shared by all worker processes through files in `cache_dir`.
+    Reading an item bumps its modification time, which is used to evict
+    the least recently used files over `threshold` items or `max_bytes`.
+    The number and size of the files are tracked as they are written; the
+    folder is only scanned when that estimate goes over the limits, or
+    every `RESCAN_INTERVAL` writes to count those of other processes. """
+
+    RESCAN_INTERVAL = 100
+
+    def __init__(self, cache_dir, threshold=500, max_bytes=None,
+                 default_timeout=300):
+        FileSystemCache.__init__(self, cache_dir, threshold=threshold,
+                                 default_timeout=default_timeout)
+        self._max_bytes = max_bytes
+        self._count = None
+        self._size = 0
+        self._writes = 0
+
+    def get(self, key):
+        rv = FileSystemCache.get(self, key)
+        if rv is not None:
+            try:
+                os.utime(self._get_filename(key), None)
+            except OSError:
+                pass
+        return rv
+
+    def set(self, key, value, timeout=None):
+        FileSystemCache.set(self, key, value, timeout)
+        try:
+            size = os.path.getsize(self._get_filename(key))
+        except OSError:
+            return
+        # overwritten items are counted twice; the next scan corrects it
+        self._count += 1
+        self._size += size
+
+    def clear(self):
+        FileSystemCache.clear(self)
+        self._count = None
+
+    def _over_limit(self, count, size):
+        # `_prune` runs before the new file is written, so make room for
+        # one more item
+        if count >= self._threshold:
+            return True
+        return self._max_bytes is not None and size > self._max_bytes
+
+    def _prune(self):
+        self._writes += 1
+        if (self._count is not None and
+                self._writes < self.RESCAN_INTERVAL and
+                not self._over_limit(self._count, self._size)):
+            return
+        self._writes = 0
+
+        entries = []
+        for filename in self._list_dir():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        count = len(entries)
+        total_size = sum(size for _mtime, size, _filename in entries)
+
+        if self._over_limit(count, total_size):
+            entries.sort()
+            for _mtime, size, filename in entries:
+                if not self._over_limit(count, total_size):
+                    break
+                try:
+                    os.remove(filename)
+                except OSError:
+                    continue
+                count -= 1
+                total_size -= size
+
+        self._count = count
+        self._size = total_size
+
+
+def create_cache(config):
+    if not config['CACHING']:
+        return NullCache()
+
+    cache_type = config['CACHE_TYPE']
+    threshold = config['CACHE_THRESHOLD']
+    max_bytes = config['CACHE_MAX_BYTES']
+
+    if cache_type == 'simple':
+        return LRUCache(threshold=threshold, max_bytes=max_bytes)
+
+    elif cache_type == 'filesystem':
+        cache_dir = config.get('CACHE_DIR')
+        if cache_dir is None:
+            cache_dir = os.path.join(config['WAREHOUSE_PATH'], 'cache')
+        return FileSystemLRUCache(cache_dir, threshold=threshold,
+                                  max_bytes=max_bytes)
+
+    elif cache_type == 'memcached':
+        return MemcachedCache(config['CACHE_SERVERS'], key_prefix='gioland:')
+
+    elif cache_type == 'redis':
+        [server] = config['CACHE_SERVERS']
+        host, port = server.split(':')
+        return RedisCache(host=host, port=int(port), key_prefix='gioland:')
+
+    raise ValueError("Unknown CACHE_TYPE %r" % cache_type)
@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+
+import ldap
+
+from gioland import metrics
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+WAIT_TIMEOUT = 5.0
+HEALTH_CHECK_INTERVAL = 30
+RECONNECT_ERRORS = (ldap.SERVER_DOWN, ldap.CONNECT_ERROR)
+
+
+def connect(server, timeout):
+    conn = ldap.initialize(server)
+    conn.protocol_version = ldap.VERSION3
+    conn.timeout = timeout
+    conn.set_option(ldap.OPT_NETWORK_TIMEOUT, timeout)
+    return conn
+
+
+class LdapPool(object):
+    """ Bounded, thread-safe pool of LDAP connections. Idle connections
+    are reused most-recent first and dropped after `idle_timeout`. """
+
+    def __init__(self, connect, size=4, idle_timeout=300):
+        self._connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def _acquire(self):
+        t0 = time.time()
+        with self._cond:
+            while self._in_use >= self.size:
+                remaining = WAIT_TIMEOUT - (time.time() - t0)
+                if remaining <= 0:
+                    raise RuntimeError("Timeout while waiting for an "
+                                       "LDAP connection")
+                self._cond.wait(remaining)
+            self._in_use += 1
+            if self._idle:
+                conn, last_used = self._idle.pop()
+            else:
+                conn, last_used = None, None
+
+        try:
+            if conn is not None:
+                idle = time.time() - last_used
+                if idle > self.idle_timeout or (
+                        idle > HEALTH_CHECK_INTERVAL and
+                        not self._is_healthy(conn)):
+                    _close(conn)
+                    conn = None
+            if conn is None:
+                conn = self._connect()
+        except:
+            self._release(None)
+            raise
+        return conn
+
+    def _release(self, conn):
+        now = time.time()
+        expired = []
+        with self._cond:
+            self._in_use -= 1
+            if conn is not None:
+                self._idle.append((conn, now))
+            while self._idle and now - self._idle[0][1] > self.idle_timeout:
+                expired.append(self._idle.pop(0)[0])
+            self._cond.notify()
+        for old_conn in expired:
+            _close(old_conn)
+
+    def _is_healthy(self, conn):
+        try:
+            conn.whoami_s()
+        except ldap.LDAPError:
+            log.debug("Dropping stale LDAP connection")
+            return False
+        return True
+
+    def run(self, func, restore_identity=False):
+        """ Call `func(conn)` with a pooled connection, reconnecting once
+        if the server went away. `restore_identity` re-binds anonymously
+        afterwards, e.g. after checking a user's password. """
+        metrics.count('ldap_calls')
+        t0 = time.time()
+        try:
+            return self._run(func, restore_identity)
+        finally:
+            metrics.count('ldap_seconds', time.time() - t0)
+
+    def _run(self, func, restore_identity):
+        for attempt in (1, 2):
+            conn = self._acquire()
+            try:
+                rv = func(conn)
+                if restore_identity:
+                    conn.simple_bind_s('', '')
+            except RECONNECT_ERRORS:
+                _close(conn)
+                self._release(None)
+                if attempt == 2:
+                    raise
+                log.warn("LDAP connection lost, reconnecting")
+                continue
+            except:
+                if restore_identity:
+                    _close(conn)
+                    conn = None
+                self._release(conn)
+                raise
+            self._release(conn)
+            return rv
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _last_used in idle:
+            _close(conn)
+
+
+def _close(conn):
+    try:
+        conn.unbind_s()
+    except ldap.LDAPError:
+        pass
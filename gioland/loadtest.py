@@ -0,0 +1,304 @@
+""" Load generator for a running instance (e.g. `./manage.py
+runcherrypy`): concurrent resumable.js style uploaders, each sending
+chunks to `/parcel/<name>/chunk` and then calling `finalize_upload`,
+alongside concurrent downloaders. Lock wait and hold times are read from
+the server's `/metrics` before and after the run. """
+
+import httplib
+import math
+import os
+import re
+import socket
+import threading
+import time
+import urlparse
+import uuid
+
+DOWNLOAD_BLOCK_SIZE = 64 * 1024
+
+PARCEL_METADATA = {
+    'country': 'dk',
+    'lot': 'lot1',
+    'product': 'imp-deg',
+    'resolution': '20m',
+    'reference': '2015',
+}
+
+METRIC_LINE = re.compile(r'^gioland_(\w+)_total\{[^}]*\} (\S+)$')
+
+
+def session_cookie(app, username):
+    """ Session cookie that logs `username` in to the instance sharing the
+    `SECRET_KEY` of `app`. """
+    serializer = app.session_interface.get_signing_serializer(app)
+    value = serializer.dumps({'username': username})
+    return '%s=%s' % (app.session_cookie_name, value)
+
+
+def encode_multipart(fields, files=()):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields:
+        parts.append('--%s\r\nContent-Disposition: form-data; name="%s"'
+                     '\r\n\r\n%s\r\n' % (boundary, name, value))
+    for name, filename, data in files:
+        parts.append('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                     'filename="%s"\r\nContent-Type: application/octet-stream'
+                     '\r\n\r\n%s\r\n' % (boundary, name, filename, data))
+    parts.append('--%s--\r\n' % boundary)
+    return 'multipart/form-data; boundary=%s' % boundary, ''.join(parts)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(fraction * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def latency_summary(values):
+    return {
+        'n': len(values),
+        'p50': percentile(values, .5),
+        'p99': percentile(values, .99),
+        'max': max(values) if values else None,
+    }
+
+
+class Client(object):
+    """ A persistent HTTP connection acting as one logged in browser. """
+
+    def __init__(self, base_url, cookie, timeout=300):
+        url = urlparse.urlsplit(base_url)
+        self.prefix = url.path.rstrip('/')
+        connection_class = (httplib.HTTPSConnection if url.scheme == 'https'
+                            else httplib.HTTPConnection)
+        self.connection = connection_class(url.netloc, timeout=timeout)
+        self.cookie = cookie
+
+    def request(self, method, path, body=None, headers={}, read=True):
+        """ Returns the response status, headers and body; with `read`
+        false, the body is read and discarded, and its size returned. """
+        headers = dict(headers, Cookie=self.cookie)
+        for attempt in (1, 2):
+            try:
+                self.connection.request(method, self.prefix + path, body,
+                                        headers)
+                resp = self.connection.getresponse()
+                break
+            except (httplib.BadStatusLine, socket.error):
+                # the server closed an idle keep-alive connection
+                self.connection.close()
+                if attempt == 2:
+                    raise
+        if read:
+            return resp.status, dict(resp.getheaders()), resp.read()
+        size = 0
+        while True:
+            data = resp.read(DOWNLOAD_BLOCK_SIZE)
+            if not data:
+                break
+            size += len(data)
+        return resp.status, dict(resp.getheaders()), size
+
+    def post_form(self, path, fields, files=()):
+        content_type, body = encode_multipart(fields, files)
+        return self.request('POST', path, body,
+                            {'Content-Type': content_type})
+
+    def close(self):
+        self.connection.close()
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chunk_latency = []
+        self.finalize_latency = []
+        self.upload_bytes = 0
+        self.uploaded_files = 0
+        self.download_latency = []
+        self.download_bytes = 0
+        self.errors = []
+
+    def error(self, message):
+        with self.lock:
+            self.errors.append(message)
+
+
+def create_parcel(client):
+    fields = sorted(PARCEL_METADATA.items())
+    status, headers, body = client.post_form('/parcel/new/country', fields)
+    if status != 302:
+        raise RuntimeError("Creating a parcel returned %d" % status)
+    return headers['location'].rsplit('/', 1)[-1]
+
+
+def upload_file(client, parcel_name, filename, size, chunk_size, stats=None):
+    """ Upload `size` bytes as `filename`, one chunk at a time, the way
+    resumable.js does. Returns True on success. """
+    identifier = '%d-%s' % (size, filename.replace('.', '_'))
+    common = [
+        ('resumableFilename', filename),
+        ('resumableIdentifier', identifier),
+        ('resumableTotalSize', str(size)),
+    ]
+    chunk = os.urandom(min(chunk_size, size))
+    chunk_count = max(1, (size + chunk_size - 1) // chunk_size)
+    for n in range(1, chunk_count + 1):
+        data = chunk[:size - (n - 1) * chunk_size]
+        fields = common + [('resumableChunkNumber', str(n)),
+                           ('resumableChunkSize', str(len(data)))]
+        t0 = time.time()
+        status, headers, body = client.post_form(
+            '/parcel/%s/chunk' % parcel_name, fields,
+            [('file', filename, data)])
+        if stats is not None:
+            with stats.lock:
+                stats.chunk_latency.append(time.time() - t0)
+        if status != 200:
+            if stats is not None:
+                stats.error("Chunk %d of %s returned %d" % (n, filename,
+                                                            status))
+            return False
+
+    t0 = time.time()
+    status, headers, body = client.post_form(
+        '/parcel/%s/finalize_upload' % parcel_name, common)
+    if stats is not None:
+        with stats.lock:
+            stats.finalize_latency.append(time.time() - t0)
+    if status != 200 or '"success"' not in body:
+        if stats is not None:
+            stats.error("Finalizing %s returned %d" % (filename, status))
+        return False
+    if stats is not None:
+        with stats.lock:
+            stats.upload_bytes += size
+            stats.uploaded_files += 1
+    return True
+
+
+def _uploader(client, parcel_name, number, files, size, chunk_size, stats):
+    try:
+        for i in range(files):
+            filename = 'load_%d_%d.bin' % (number, i)
+            upload_file(client, parcel_name, filename, size, chunk_size,
+                        stats)
+    except Exception as e:
+        stats.error("Uploader %d: %r" % (number, e))
+    finally:
+        client.close()
+
+
+def _downloader(client, parcel_name, filename, stop, stats):
+    url = '/parcel/%s/download/%s' % (parcel_name, filename)
+    try:
+        while not stop.is_set():
+            t0 = time.time()
+            status, headers, size = client.request('GET', url, read=False)
+            if status != 200:
+                stats.error("Download returned %d" % status)
+                break
+            with stats.lock:
+                stats.download_latency.append(time.time() - t0)
+                stats.download_bytes += size
+    except Exception as e:
+        stats.error("Downloader: %r" % e)
+    finally:
+        client.close()
+
+
+def read_lock_metrics(client):
+    """ Total lock wait and hold seconds reported by `/metrics`. """
+    status, headers, body = client.request('GET', '/metrics')
+    totals = {'lock_wait_seconds': 0.0, 'lock_hold_seconds': 0.0}
+    if status != 200:
+        return totals
+    for line in body.splitlines():
+        match = METRIC_LINE.match(line)
+        if match and match.group(1) in totals:
+            totals[match.group(1)] += float(match.group(2))
+    return totals
+
+
+def run(base_url, cookie, uploaders=10, downloaders=2, files=1,
+        file_size=20 * 1024 * 1024, chunk_size=1024 * 1024, cleanup=False):
+    """ Run `uploaders` clients, each uploading `files` files of
+    `file_size` bytes to a parcel of its own, while `downloaders` clients
+    keep downloading a file of the same size. Returns a report dict. """
+    new_client = lambda: Client(base_url, cookie)
+    setup = new_client()
+    parcel_names = [create_parcel(setup) for i in range(uploaders)]
+    seed_parcel = None
+    if downloaders:
+        seed_parcel = create_parcel(setup)
+        if not upload_file(setup, seed_parcel, 'seed.bin', file_size,
+                           chunk_size):
+            raise RuntimeError("Could not upload the file to download")
+    metrics_before = read_lock_metrics(setup)
+
+    stats = Stats()
+    stop = threading.Event()
+    upload_threads = [
+        threading.Thread(target=_uploader,
+                         args=(new_client(), name, n, files, file_size,
+                               chunk_size, stats))
+        for n, name in enumerate(parcel_names)]
+    download_threads = [
+        threading.Thread(target=_downloader,
+                         args=(new_client(), seed_parcel, 'seed.bin', stop,
+                               stats))
+        for n in range(downloaders)]
+
+    t0 = time.time()
+    for thread in download_threads + upload_threads:
+        thread.start()
+    for thread in upload_threads:
+        thread.join()
+    upload_seconds = time.time() - t0
+    stop.set()
+    for thread in download_threads:
+        thread.join()
+    download_seconds = time.time() - t0
+
+    metrics_after = read_lock_metrics(setup)
+    if cleanup:
+        for name in parcel_names + filter(None, [seed_parcel]):
+            setup.post_form('/parcel/%s/delete' % name, [])
+    setup.close()
+
+    megabytes = float(1024 * 1024)
+    return {
+        'options': {
+            'uploaders': uploaders,
+            'downloaders': downloaders,
+            'files': files,
+            'file_size': file_size,
+            'chunk_size': chunk_size,
+        },
+        'uploads': {
+            'files': stats.uploaded_files,
+            'bytes': stats.upload_bytes,
+            'seconds': upload_seconds,
+            'mb_per_second': stats.upload_bytes / megabytes / upload_seconds,
+            'chunk_latency': latency_summary(stats.chunk_latency),
+            'finalize_latency': latency_summary(stats.finalize_latency),
+        },
+        'downloads': {
+            'files': len(stats.download_latency),
+            'bytes': stats.download_bytes,
+            'seconds': download_seconds,
+            'mb_per_second': (stats.download_bytes / megabytes /
+                              download_seconds),
+            'latency': latency_summary(stats.download_latency),
+        },
+        'lock_wait_seconds': (metrics_after['lock_wait_seconds'] -
+                              metrics_before['lock_wait_seconds']),
+        'lock_hold_seconds': (metrics_after['lock_hold_seconds'] -
+                              metrics_before['lock_hold_seconds']),
+        'errors': len(stats.errors),
+        'first_errors': stats.errors[:10],
+    }
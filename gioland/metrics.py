@@ -0,0 +1,274 @@
+""" Per-endpoint request instrumentation. A WSGI middleware times each
+request, and code that talks to ZODB, LDAP, UNS, the lock file or
+parcel files adds to the counters of the current request with
+`count()`. Totals are kept per endpoint in a `Registry`, and exposed in
+Prometheus text format at `/metrics`. """
+
+import bisect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import flask
+from werkzeug.wsgi import ClosingIterator
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+FLUSH_INTERVAL = 5
+
+COUNTERS = (
+    'zodb_loads',
+    'zodb_stores',
+    'zodb_commit_seconds',
+    'zodb_conflicts',
+    'ldap_calls',
+    'ldap_seconds',
+    'uns_calls',
+    'uns_seconds',
+    'lock_busy',
+    'lock_wait_seconds',
+    'lock_hold_seconds',
+    'upload_chunks',
+    'file_read_bytes',
+    'file_write_bytes',
+)
+
+_local = threading.local()
+
+
+def count(name, value=1):
+    """ Add `value` to counter `name` of the request being served by this
+    thread, if any. """
+    counters = getattr(_local, 'counters', None)
+    if counters is not None:
+        counters[name] = counters.get(name, 0) + value
+
+
+class EndpointStats(object):
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.requests = 0
+        self.seconds = 0.0
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.gauge_callbacks = []
+
+    def observe(self, endpoint, duration, counters):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = EndpointStats()
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+            stats.requests += 1
+            stats.seconds += duration
+            for name, value in counters.iteritems():
+                stats.counters[name] = stats.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """ `{endpoint: {'buckets', 'requests', 'seconds', 'counters'}}`,
+        with non-cumulative bucket counts (the last one is overflow). """
+        with self._lock:
+            return {endpoint: {'buckets': list(stats.buckets),
+                               'requests': stats.requests,
+                               'seconds': stats.seconds,
+                               'counters': dict(stats.counters)}
+                    for endpoint, stats in self._endpoints.iteritems()}
+
+    def gauges(self):
+        rv = {}
+        for callback in self.gauge_callbacks:
+            try:
+                rv.update(callback())
+            except Exception:
+                log.exception("Error while reading gauges")
+        return rv
+
+
+class FileCollector(object):
+    """ Lets worker processes share their metrics: each one saves its own
+    snapshot as `<pid>.json` in `directory`, and a scrape adds them up. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._last_flush = 0
+
+    def write(self, registry):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        data = json.dumps({'pid': os.getpid(),
+                           'endpoints': registry.snapshot(),
+                           'gauges': registry.gauges()})
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, os.path.join(self.directory,
+                                         '%d.json' % os.getpid()))
+        self._last_flush = time.time()
+
+    def maybe_write(self, registry):
+        if time.time() - self._last_flush > FLUSH_INTERVAL:
+            self.write(registry)
+
+    def collect(self):
+        rv = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                    rv.append(json.load(f))
+            except (IOError, ValueError):
+                continue
+        return rv
+
+
+def merge(snapshots):
+    """ Add up the `endpoints` of several process snapshots. """
+    rv = {}
+    for snapshot in snapshots:
+        for endpoint, stats in snapshot['endpoints'].iteritems():
+            total = rv.get(endpoint)
+            if total is None:
+                total = rv[endpoint] = {
+                    'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+                    'requests': 0, 'seconds': 0.0,
+                    'counters': dict.fromkeys(COUNTERS, 0)}
+            total['buckets'] = [a + b for a, b in zip(total['buckets'],
+                                                      stats['buckets'])]
+            total['requests'] += stats['requests']
+            total['seconds'] += stats['seconds']
+            for name, value in stats['counters'].iteritems():
+                total['counters'][name] = total['counters'].get(name, 0) + value
+    return rv
+
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (name, unicode(value)
+                                          .replace('\\', '\\\\')
+                                          .replace('"', '\\"'))
+                             for name, value in sorted(labels.items()))
+
+
+def render(snapshots):
+    """ Prometheus text exposition format for a list of snapshots. """
+    endpoints = merge(snapshots)
+    lines = [
+        '# HELP gioland_request_duration_seconds Request latency.',
+        '# TYPE gioland_request_duration_seconds histogram',
+    ]
+    for endpoint, stats in sorted(endpoints.items()):
+        cumulative = 0
+        for le, n in zip(LATENCY_BUCKETS + ('+Inf',), stats['buckets']):
+            cumulative += n
+            lines.append('gioland_request_duration_seconds_bucket%s %d' % (
+                _labels(endpoint=endpoint, le=le), cumulative))
+        lines.append('gioland_request_duration_seconds_sum%s %s' % (
+            _labels(endpoint=endpoint), stats['seconds']))
+        lines.append('gioland_request_duration_seconds_count%s %d' % (
+            _labels(endpoint=endpoint), stats['requests']))
+
+    for name in COUNTERS:
+        lines.append('# TYPE gioland_%s_total counter' % name)
+        for endpoint, stats in sorted(endpoints.items()):
+            lines.append('gioland_%s_total%s %s' % (
+                name, _labels(endpoint=endpoint),
+                stats['counters'].get(name, 0)))
+
+    gauge_names = sorted(set(name for snapshot in snapshots
+                             for name in snapshot['gauges']))
+    for name in gauge_names:
+        lines.append('# TYPE gioland_%s gauge' % name)
+        for snapshot in snapshots:
+            if name in snapshot['gauges']:
+                lines.append('gioland_%s%s %s' % (
+                    name, _labels(pid=snapshot['pid']),
+                    snapshot['gauges'][name]))
+
+    return '\n'.join(lines) + '\n'
+
+
+class InstrumentationMiddleware(object):
+
+    def __init__(self, wsgi_app, registry, collector=None):
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+        self.collector = collector
+
+    def __call__(self, environ, start_response):
+        t0 = time.time()
+        _local.counters = {}
+        _local.endpoint = None
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except:
+            self._finish(t0)
+            raise
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            # wrapping it would stop the server from using sendfile
+            self._finish(t0)
+            return body
+        # streamed responses are sent after the view returns
+        return ClosingIterator(body, lambda: self._finish(t0))
+
+    def _finish(self, t0):
+        duration = time.time() - t0
+        counters = _local.counters
+        endpoint = _local.endpoint or '[none]'
+        _local.counters = _local.endpoint = None
+        self.registry.observe(endpoint, duration, counters)
+        log.debug("%s %.3fs %r", endpoint, duration, counters)
+        if self.collector is not None:
+            try:
+                self.collector.maybe_write(self.registry)
+            except Exception:
+                log.exception("Error while saving metrics")
+
+
+def _record_endpoint():
+    _local.endpoint = flask.request.endpoint
+
+
+def get_registry(app=None):
+    if app is None:
+        app = flask.current_app
+    return app.extensions['gioland-metrics']
+
+
+def view_metrics():
+    app = flask.current_app
+    registry = get_registry()
+    collector = app.extensions.get('gioland-metrics-collector')
+    if collector is None:
+        snapshots = [{'pid': os.getpid(),
+                      'endpoints': registry.snapshot(),
+                      'gauges': registry.gauges()}]
+    else:
+        collector.write(registry)
+        snapshots = collector.collect()
+    return flask.Response(render(snapshots),
+                          content_type='text/plain; version=0.0.4')
+
+
+def register_on(app):
+    registry = app.extensions['gioland-metrics'] = Registry()
+    collector = None
+    if app.config.get('METRICS_DIR'):
+        collector = FileCollector(app.config['METRICS_DIR'])
+        app.extensions['gioland-metrics-collector'] = collector
+    app.wsgi_app = InstrumentationMiddleware(app.wsgi_app, registry,
+                                             collector)
+    app.before_request(_record_endpoint)
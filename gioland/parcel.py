@@ -4,7 +4,7 @@ import re
 import tempfile
 from cgi import escape
 from datetime import datetime
-from itertools import groupby
+from itertools import islice
 
 import blinker
 import flask
@@ -15,6 +15,7 @@ from werkzeug.utils import secure_filename
 
 import gioland.auth as auth
 import gioland.notification as notification
+from gioland import metrics
 
 from gioland.definitions import ALL_STAGES_MAP, ALL_ROLES, CATEGORIES, COUNTRIES
 from gioland.definitions import COUNTRIES_CC, COUNTRIES_MC, COUNTRY_PRODUCTS, COUNTRY
@@ -23,14 +24,14 @@ from gioland.definitions import EXTENTS, FULL_LOT_STAGES, FULL_LOT_STAGES_ORDER
 from gioland.definitions import INITIAL_STAGE, LOT, LOTS, LOT_STAGES, METADATA, PARTIAL
 from gioland.definitions import PARTIAL_LOT_STAGES, PARTIAL_LOT_STAGES_ORDER
 from gioland.definitions import PRODUCTS, PRODUCTS_FILTER, PRODUCTS_IDS, REFERENCES
-from gioland.definitions import REPORT_METADATA, RESOLUTIONS, SIMILAR_METADATA
+from gioland.definitions import REPORT_METADATA, RESOLUTIONS
 from gioland.definitions import STAGE_ORDER, STAGES, STAGES_FOR_MERGING, STREAM
 from gioland.definitions import STREAM_LOTS, STREAM_STAGES, STREAM_STAGES_ORDER
 from gioland.definitions import UNS_FIELD_DEFS
 from gioland.forms import CountryDeliveryForm, LotDeliveryForm, StreamDeliveryForm
 from gioland.forms import get_lot_products
 from gioland.utils import format_datetime, exclusive_lock, isoformat_to_datetime
-from gioland.warehouse import get_warehouse, _current_user
+from gioland.warehouse import get_warehouse, _current_user, _audit
 
 parcel_views = flask.Blueprint('parcel', __name__)
 
@@ -75,13 +76,63 @@ def search(delivery_type):
     })
 
 
+FIND_PARCELS_MAX_LIMIT = 1000
+BULK_METADATA_MAX_NAMES = 10000
+STREAM_CACHE_GC_INTERVAL = 1000
+PRODUCT_ORDER = {product: n for n, product in enumerate(PRODUCTS_IDS)}
+
+
+def _api_parcel_item(parcel, fields):
+    if fields is None:
+        return parcel.name
+    return {
+        'name': parcel.name,
+        'metadata': {k: parcel.metadata[k] for k in fields
+                     if k in parcel.metadata},
+    }
+
+
 @parcel_views.route('/api/find_parcels')
 def api_find_parcels():
+    """ Names of the parcels matching the metadata in the query string,
+    in name order. With `limit`, returns one page, and `next` is the
+    `after` value for the following page; without it, all matching
+    parcels are streamed. `fields` is a comma separated list of metadata
+    to include with each name. """
     wh = get_warehouse()
-    parcels = filter_parcels(wh.get_all_parcels(), **get_filter_arguments())
-    return flask.jsonify({
-        'parcels': [p.name for p in parcels],
-    })
+    args = flask.request.args
+    after = args.get('after') or None
+    fields = args.get('fields')
+    if fields is not None:
+        fields = [f for f in fields.split(',') if f]
+    parcels = filter_parcels(wh.iter_parcels(after), **get_filter_arguments())
+
+    if 'limit' in args:
+        try:
+            limit = int(args['limit'])
+        except ValueError:
+            flask.abort(400)
+        if not 0 < limit <= FIND_PARCELS_MAX_LIMIT:
+            flask.abort(400)
+        page = list(islice(parcels, limit + 1))
+        return flask.jsonify({
+            'parcels': [_api_parcel_item(p, fields) for p in page[:limit]],
+            'next': page[limit - 1].name if len(page) > limit else None,
+        })
+
+    def generate():
+        yield '{"parcels": ['
+        for n, parcel in enumerate(parcels):
+            if n:
+                yield ', '
+            yield flask.json.dumps(_api_parcel_item(parcel, fields))
+            if n % STREAM_CACHE_GC_INTERVAL == STREAM_CACHE_GC_INTERVAL - 1:
+                # keep the connection cache bounded during large exports
+                wh._p_jar.cacheGC()
+        yield ']}'
+
+    return flask.Response(flask.stream_with_context(generate()),
+                          mimetype='application/json')
 
 
 @parcel_views.route('/api/parcel/<string:name>')
@@ -91,14 +142,47 @@ def parcel_metadata(name):
     return flask.jsonify({'metadata': dict(parcel.metadata)})
 
 
+@parcel_views.route('/api/parcels', methods=['POST'])
+def parcels_metadata():
+    """ Metadata of many parcels at once. Expects a JSON object with the
+    parcel `names` and, optionally, the metadata `fields` to return. """
+    wh = get_warehouse()
+    data = flask.request.get_json(silent=True)
+    if not isinstance(data, dict):
+        flask.abort(400)
+    names = data.get('names')
+    fields = data.get('fields')
+    if not isinstance(names, list) or len(names) > BULK_METADATA_MAX_NAMES:
+        flask.abort(400)
+    if not all(isinstance(name, basestring) for name in names):
+        flask.abort(400)
+    if fields is not None:
+        if not isinstance(fields, list):
+            flask.abort(400)
+        if not all(isinstance(field, basestring) for field in fields):
+            flask.abort(400)
+
+    parcels = {}
+    missing = []
+    # key order keeps neighbouring objects together in the ZODB cache
+    for name in sorted(set(names)):
+        try:
+            parcel = wh.get_parcel(name)
+        except KeyError:
+            missing.append(name)
+            continue
+        if fields is None:
+            parcels[name] = dict(parcel.metadata)
+        else:
+            parcels[name] = {k: parcel.metadata[k] for k in fields
+                             if k in parcel.metadata}
+    return flask.jsonify({'parcels': parcels, 'missing': missing})
+
+
 @parcel_views.route('/country/<string:code>')
 def country(code):
     wh = get_warehouse()
-    all_parcels = [p for p in chain_tails(wh) if
-                   p.metadata['delivery_type'] == COUNTRY and
-                   p.metadata['country'] == code]
-
-    grouped_parcels = group_parcels(all_parcels)
+    grouped_parcels = overview_parcels(wh, COUNTRY, code)
     return flask.render_template('country.html', **{
         'code': code,
         'grouped_parcels': grouped_parcels,
@@ -108,13 +192,10 @@ def country(code):
 @parcel_views.route('/lot/<string:code>')
 def lot(code):
     wh = get_warehouse()
-    all_parcels = [p for p in chain_tails(wh) if
-                   p.metadata['delivery_type'] == LOT and
-                   p.metadata['lot'] == code]
+    grouped_parcels = overview_parcels(wh, LOT, code)
     all_reports = [r for r in wh.get_all_reports()
                    if r.lot == code]
 
-    grouped_parcels = group_parcels(all_parcels)
     return flask.render_template('lot.html', **{
         'code': code,
         'grouped_parcels': grouped_parcels,
@@ -125,10 +206,7 @@ def lot(code):
 @parcel_views.route('/stream/<string:code>')
 def stream(code):
     wh = get_warehouse()
-    all_parcels = [p for p in chain_tails(wh) if
-                   p.metadata['delivery_type'] == STREAM and
-                   p.metadata['lot'] == code]
-    grouped_parcels = group_parcels(all_parcels)
+    grouped_parcels = overview_parcels(wh, STREAM, code)
     return flask.render_template('stream.html', **{
         'code': code,
         'grouped_parcels': grouped_parcels,
@@ -209,11 +287,15 @@ def upload(name):
     tmp = path(tmp_file.name)
     tmp_file.close()
     posted_file.save(tmp)
+    metrics.count('upload_chunks')
+    metrics.count('file_write_bytes', tmp.getsize())
 
     with exclusive_lock():
         chunk_path = temp.joinpath('%s_%s' % (chunk_number, identifier))
         wh.logger.info("Begin chunked upload file %r for parcel %r (user %s)",
-                       filename, parcel.name, _current_user())
+                       filename, parcel.name, _current_user(),
+                       extra=_audit('upload_begin', parcel.name,
+                                    filename=filename))
         tmp.rename(chunk_path)
 
     return flask.jsonify({'status': 'success'})
@@ -262,9 +344,12 @@ def upload_single_file(name):
     else:
         if posted_file:
             posted_file.save(file_path)
+            metrics.count('file_write_bytes', file_path.getsize())
             file_uploaded.send(parcel, filename=filename)
             wh.logger.info("Finished upload %r for parcel %r (user %s)",
-                           filename, parcel.name, _current_user())
+                           filename, parcel.name, _current_user(),
+                           extra=_audit('upload', parcel.name,
+                                        filename=filename))
         else:
             flask.flash("Please upload a valid file", 'system')
     return flask.redirect(flask.url_for('parcel.view', name=name))
@@ -286,7 +371,9 @@ def finalize_upload(name):
     if all_chunks_uploaded(temp, total_size):
         create_file_from_chunks(parcel, temp, filename)
         wh.logger.info("Finished chunked upload %r for parcel %r (user %s)",
-                       filename, parcel.name, _current_user())
+                       filename, parcel.name, _current_user(),
+                       extra=_audit('upload', parcel.name,
+                                    filename=filename))
     else:
         response['status'] = 'error'
         response['message'] = "Upload didn't finalize. an error occurred"
@@ -337,6 +424,8 @@ def create_file_from_chunks(parcel, temp, filename):
             with open(chunk_path, 'rb') as chunk_file:
                 for chunk in read_chunk(chunk_file):
                     original_file.write(chunk)
+                    metrics.count('file_read_bytes', len(chunk))
+                    metrics.count('file_write_bytes', len(chunk))
     file_uploaded.send(parcel, filename=filename)
     temp.rmtree()
 
@@ -370,17 +459,17 @@ class Finalize(MethodView):
     def get(self, name):
         if not flask.request.args.get('merge') == 'on':
             flask.abort(405)
-        partial_parcels = filter(lambda i: similar_parcel(self.parcel, i),
-                                 chain_tails(self.wh))
+        partial_parcels = similar_parcels(self.wh, self.parcel)
         return flask.render_template('finalize_and_merge_parcel.html',
                                      parcel=self.parcel,
                                      partial_parcels=partial_parcels)
 
     def post(self, name):
-        if flask.request.form.get('merge') == 'on':
-            finalize_and_merge_parcel(self.wh, self.parcel)
-        else:
-            finalize_parcel(self.wh, self.parcel, self.reject)
+        with notification.batch():
+            if flask.request.form.get('merge') == 'on':
+                finalize_and_merge_parcel(self.wh, self.parcel)
+            else:
+                finalize_parcel(self.wh, self.parcel, self.reject)
         url = flask.url_for('parcel.view', name=self.parcel.name)
         return flask.redirect(url)
 
@@ -403,6 +492,7 @@ def download(name, filename):
     file_path = safe_join(parcel.get_path(), filename)
     if not path(file_path).isfile():
         flask.abort(404)
+    metrics.count('file_read_bytes', path(file_path).getsize())
     return flask.send_file(file_path,
                            as_attachment=True,
                            attachment_filename=filename)
@@ -452,7 +542,9 @@ def delete_file(name, filename):
         filename = secure_filename(filename)
         file_path = flask.safe_join(parcel.get_path(), filename)
         wh.logger.info("Delete file %r for parcel %r (user %s)",
-                       filename, parcel.name, _current_user())
+                       filename, parcel.name, _current_user(),
+                       extra=_audit('delete_file', parcel.name,
+                                    filename=filename))
         try:
             os.unlink(file_path)
             parcel_file_deleted.send(parcel)
@@ -492,11 +584,12 @@ def delete_parcel_and_followers(wh, name):
     for prev_name in parcel.metadata.get('prev_parcel_list', []):
         prev = wh.get_parcel(prev_name)
         del prev.metadata['upload_time'], prev.metadata['next_parcel']
+        wh.reindex(prev)
         prev.add_history_item('Next step deleted',
                               datetime.utcnow(),
                               flask.g.username,
                               'Next step deleted (%s)' % name)
-    for p in walk_parcels(wh, name):
+    for p in list(walk_parcels(wh, name)):
         wh.delete_parcel(p.name)
         parcel_deleted.send(p)
 
@@ -508,18 +601,24 @@ def change_metadata(wh, name, new_meta):
 
 
 def walk_parcels(wh, name, forward=True):
+    """ Parcels from `name` to the end of its delivery, or back to the
+    start of its chain. Going forward, a merge continues into the chain
+    of the merged parcel. """
+    chain = wh.get_chain(name)
+    names = list(chain.parcels)
+    index = names.index(name)
+    if not forward:
+        for prev_name in reversed(names[:index + 1]):
+            yield wh.get_parcel(prev_name)
+        return
     while True:
-        parcel = wh.get_parcel(name)
-        yield parcel
-        if forward:
-            name = parcel.metadata.get('next_parcel')
-        else:
-            values = parcel.metadata.get('prev_parcel_list', [])
-            if not values or len(values) > 1:
-                return
-            name = values[0]
-        if name is None:
+        for next_name in names[index:]:
+            yield wh.get_parcel(next_name)
+        next_name = wh.get_parcel(names[-1]).metadata.get('next_parcel')
+        if next_name is None:
             return
+        names = list(wh.get_chain(next_name).parcels)
+        index = names.index(next_name)
 
 
 def get_parcels_by_stage(name):
@@ -527,15 +626,15 @@ def get_parcels_by_stage(name):
     parcel = get_or_404(wh.get_parcel, name, _exc=KeyError)
     DELIVERY_STAGES, _ = _get_stages_for_parcel(parcel)
     stages_with_parcels = {stage: None for stage in DELIVERY_STAGES}
-    for parcel in walk_parcels(wh, name, forward=False):
-        stage = parcel.metadata['stage']
-        if not stages_with_parcels[stage]:
-            stages_with_parcels[stage] = parcel
-    prev_parcel_list = parcel.metadata.get('prev_parcel_list', [])
-    if len(prev_parcel_list) > 1:
-        prev_parcel = wh.get_parcel(prev_parcel_list[0])
-        stages_with_parcels[prev_parcel.metadata['stage']] = \
-            'Merged with %s other parcels.' % len(prev_parcel_list)
+    # the chain keeps the stages of its parcels, so only the parcels that
+    # are shown get loaded
+    chain = wh.get_chain(name)
+    for stage, parcel_name in chain.stage_summary(name).items():
+        stages_with_parcels[stage] = wh.get_parcel(parcel_name)
+    if chain.merged is not None:
+        merged_stage, merged_count = chain.merged
+        stages_with_parcels[merged_stage] = \
+            'Merged with %s other parcels.' % merged_count
     return stages_with_parcels
 
 
@@ -551,10 +650,9 @@ def chain(name):
     wh = get_warehouse()
     first_parcel = get_or_404(wh.get_parcel, name, _exc=KeyError)
 
-    previous_parcels = list(walk_parcels(wh, name, forward=False))
-    if len(previous_parcels) > 1:
-        first_parcel = previous_parcels[-1]
-        url = flask.url_for('parcel.chain', name=first_parcel.name)
+    first_name = wh.get_chain(name).parcels[0]
+    if first_name != name:
+        url = flask.url_for('parcel.chain', name=first_name)
         return flask.redirect(url)
 
     workflow_parcels = list(walk_parcels(wh, name))
@@ -572,12 +670,16 @@ def chain(name):
     })
 
 
-def group_parcels(parcels):
-    # order parcels based on PRODUCTS order
-    def sort_parcels_key(parcel):
-        return PRODUCTS_IDS.index(parcel.metadata['product'])
-    sorted_parcels = sorted(parcels, key=sort_parcels_key)
-    return groupby(sorted_parcels, key=lambda p: p.metadata['product'])
+def product_order(product):
+    return PRODUCT_ORDER.get(product, len(PRODUCT_ORDER))
+
+
+def overview_parcels(wh, delivery_type, code):
+    """ Chain tails of an overview page, grouped by product in PRODUCTS
+    order, read from the warehouse views. """
+    view = wh.get_view(delivery_type, code)
+    return [(product, [wh.get_parcel(name) for name in view[product]])
+            for product in sorted(view.keys(), key=product_order)]
 
 
 @parcel_views.route('/subscribe', methods=['GET', 'POST'])
@@ -717,8 +819,7 @@ def clear_chunks(parcel_path):
 
 
 def create_next_parcel(wh, parcels, next_stage, stage_def, next_stage_def):
-    next_parcel = wh.new_parcel()
-    next_parcel.save_metadata({
+    next_parcel = wh.new_parcel({
         'prev_parcel_list': [p.name for p in parcels],
         'stage': next_stage,
     })
@@ -777,14 +878,10 @@ def link_to_next_parcel(next_parcel, parcel, stage_def, next_stage_def,
         flask.g.username, description_html, rejected=reject)
 
 
-def similar_parcel(parcel, parcel_item):
-    parcel_item_metadata = {k: parcel_item.metadata.get(k, '')
-                            for k in SIMILAR_METADATA}
-    parcel_metadata = {k: parcel.metadata.get(k, '')
-                       for k in SIMILAR_METADATA}
-    parcel_item_metadata['stage'] = parcel_item.metadata['stage']
-    parcel_metadata['stage'] = parcel.metadata['stage']
-    return parcel_item_metadata == parcel_metadata
+def similar_parcels(wh, parcel):
+    """ Chain tails with the same metadata and stage as `parcel`, looked
+    up in the similarity index. """
+    return [wh.get_parcel(name) for name in wh.get_similar(parcel)]
 
 
 def finalize_parcel(wh, parcel, reject):
@@ -826,8 +923,7 @@ def finalize_and_merge_parcel(wh, parcel):
     if parcel.metadata['stage'] not in STAGES_FOR_MERGING:
         flask.abort(400)
 
-    partial_parcels = filter(lambda i: similar_parcel(parcel, i),
-                             chain_tails(wh))
+    partial_parcels = similar_parcels(wh, parcel)
     if len(partial_parcels) <= 1:
         flask.abort(400)
     stage = parcel.metadata['stage']
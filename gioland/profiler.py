@@ -0,0 +1,118 @@
+""" Profile single requests on demand. An admin adds `?_profile=inline`
+(or the `X-Profile: inline` header) to any URL to get the cProfile
+report instead of the page, or `store` to save the profile under the
+warehouse, for download from `/profiles`; only the latest
+`MAX_STORED_PROFILES` are kept. The profile covers the view and template
+rendering, not the commit that happens on teardown. """
+
+import cProfile
+import os
+import pstats
+import re
+from cStringIO import StringIO
+from datetime import datetime
+
+import flask
+
+from gioland import auth
+
+PROFILES_DIR_NAME = 'profiles'
+REPORT_LINES = 60
+MODES = ('inline', 'store')
+MAX_STORED_PROFILES = 100
+
+profiler_views = flask.Blueprint('profiler', __name__)
+
+
+def _profiles_dir():
+    return os.path.join(flask.current_app.config['WAREHOUSE_PATH'],
+                        PROFILES_DIR_NAME)
+
+
+def _list_profiles(profiles_dir):
+    """ Names of the stored profiles, newest first. """
+    if not os.path.isdir(profiles_dir):
+        return []
+    return sorted((n for n in os.listdir(profiles_dir)
+                   if n.endswith('.prof')), reverse=True)
+
+
+def _prune_profiles(profiles_dir):
+    for name in _list_profiles(profiles_dir)[MAX_STORED_PROFILES:]:
+        try:
+            os.remove(os.path.join(profiles_dir, name))
+        except OSError:
+            pass
+
+
+def _requested_mode():
+    mode = (flask.request.args.get('_profile') or
+            flask.request.headers.get('X-Profile'))
+    if mode == '1':
+        mode = 'inline'
+    return mode if mode in MODES else None
+
+
+def start_profile():
+    mode = _requested_mode()
+    if mode is None or not auth.authorize(['ROLE_ADMIN']):
+        return
+    profile = cProfile.Profile()
+    flask.g.profile = (mode, profile)
+    profile.enable()
+
+
+def finish_profile(response):
+    if getattr(flask.g, 'profile', None) is None:
+        return response
+    mode, profile = flask.g.profile
+    profile.disable()
+    flask.g.profile = None
+
+    if mode == 'store':
+        profiles_dir = _profiles_dir()
+        if not os.path.isdir(profiles_dir):
+            os.makedirs(profiles_dir)
+        name = '%s-%s.prof' % (
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'),
+            re.sub(r'[^\w.]', '_', flask.request.endpoint or 'none'))
+        profile.dump_stats(os.path.join(profiles_dir, name))
+        _prune_profiles(profiles_dir)
+        response.headers['X-Profile'] = flask.url_for('profiler.download',
+                                                      name=name)
+        return response
+
+    out = StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+    report = "%s %s -> %s\n\n%s" % (flask.request.method, flask.request.url,
+                                     response.status, out.getvalue())
+    return flask.Response(report, content_type='text/plain; charset=utf-8')
+
+
+def stop_profile(err=None):
+    # after_request is skipped if the view failed
+    if getattr(flask.g, 'profile', None) is not None:
+        flask.g.profile[1].disable()
+        flask.g.profile = None
+
+
+@profiler_views.route('/profiles')
+@auth.require_admin
+def index():
+    names = _list_profiles(_profiles_dir())
+    return flask.render_template('profiles.html', names=names)
+
+
+@profiler_views.route('/profiles/<string:name>')
+@auth.require_admin
+def download(name):
+    return flask.send_from_directory(_profiles_dir(), name,
+                                     as_attachment=True)
+
+
+def register_on(app):
+    app.register_blueprint(profiler_views)
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    app.teardown_request(stop_profile)
@@ -0,0 +1,133 @@
+""" Slow request log. A watchdog thread samples the stack of each request
+that has been running longer than `SLOW_REQUEST_THRESHOLD` seconds;
+when such a request ends, the aggregated samples are logged as a
+warning to `slow.log` in the warehouse folder (and Sentry, if set up). """
+
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+import flask
+
+log = logging.getLogger(__name__)
+
+SLOW_LOG_FILE_NAME = 'slow.log'
+MAX_FRAMES = 20
+MAX_STACKS = 5
+
+
+class ActiveRequest(object):
+
+    def __init__(self, description, endpoint, parcel):
+        self.start = time.time()
+        self.description = description
+        self.endpoint = endpoint
+        self.parcel = parcel
+        self.samples = Counter()
+
+
+class Watchdog(object):
+
+    def __init__(self, threshold, interval, log_path=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.log_path = log_path
+        self._requests = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='gioland-slowlog')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception:
+                log.exception("Error while sampling slow requests")
+
+    def sample(self):
+        now = time.time()
+        with self._lock:
+            slow = [(ident, request)
+                    for ident, request in self._requests.items()
+                    if now - request.start > self.threshold]
+        if not slow:
+            return
+        frames = sys._current_frames()
+        for ident, request in slow:
+            frame = frames.get(ident)
+            if frame is None:
+                continue
+            stack = tuple('%s:%d %s' % (filename, lineno, name)
+                          for filename, lineno, name, _line
+                          in traceback.extract_stack(frame)[-MAX_FRAMES:])
+            request.samples[stack] += 1
+
+    def begin(self, description, endpoint, parcel):
+        request = ActiveRequest(description, endpoint, parcel)
+        with self._lock:
+            self._requests[threading.current_thread().ident] = request
+
+    def end(self):
+        with self._lock:
+            request = self._requests.pop(threading.current_thread().ident,
+                                         None)
+        if request is None:
+            return
+        elapsed = time.time() - request.start
+        if elapsed > self.threshold:
+            report = format_report(request, elapsed)
+            log.warn(report)
+            if self.log_path is not None:
+                with open(self.log_path, 'ab') as f:
+                    f.write('[%s] %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                                           report))
+
+
+def format_report(request, elapsed):
+    lines = ["Slow request %s (endpoint %s, parcel %s) took %.2fs, "
+             "%d stack samples" % (request.description, request.endpoint,
+                                   request.parcel, elapsed,
+                                   sum(request.samples.values()))]
+    for stack, count in request.samples.most_common(MAX_STACKS):
+        lines.append("  %d x" % count)
+        lines.extend("    %s" % frame for frame in stack)
+    return '\n'.join(lines)
+
+
+def _begin_request():
+    watchdog = flask.current_app.extensions['gioland-slowlog']
+    watchdog.start()
+    request = flask.request
+    parcel = (request.view_args or {}).get('name')
+    watchdog.begin('%s %s' % (request.method, request.path),
+                   request.endpoint, parcel)
+
+
+def _end_request(err=None):
+    flask.current_app.extensions['gioland-slowlog'].end()
+
+
+def register_on(app):
+    threshold = app.config['SLOW_REQUEST_THRESHOLD']
+    if not threshold or app.testing:
+        return
+    log_path = None
+    if 'WAREHOUSE_PATH' in app.config:
+        log_path = os.path.join(app.config['WAREHOUSE_PATH'],
+                                SLOW_LOG_FILE_NAME)
+    app.extensions['gioland-slowlog'] = Watchdog(
+        threshold, app.config['SLOW_REQUEST_SAMPLE_INTERVAL'], log_path)
+    app.before_request(_begin_request)
+    app.teardown_request(_end_request)
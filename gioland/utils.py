@@ -1,28 +1,134 @@
+import hashlib
 import logging
+import threading
 import time
 from contextlib import contextmanager
 from functools import wraps
 
 import flask
 from dateutil import tz, parser
-from werkzeug.contrib.cache import NullCache, SimpleCache
 from zc.lockfile import LockFile, LockError
 
+from gioland import metrics
+
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
 
-def cached(timeout):
+FLIGHT_TIMEOUT = 30
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+        self.value = None
+        self.error = None
+
+
+def cached(timeout, negative_timeout=60, stale=0):
+    """ Cache results of `func` for `timeout` seconds (`negative_timeout`
+    for a `None` result). Concurrent misses for the same arguments wait
+    for a single computation, and for `stale` seconds after expiry the old
+    value is served while it is recomputed in a background thread. If the
+    computation fails, the waiters get the same exception rather than
+    retrying it themselves. """
+
     def decorator(func):
+        flights = {}
+        flights_lock = threading.Lock()
+
+        def cache_key(args):
+            # hashed, so that keys are valid for memcached too
+            return '%s.%s:%s' % (func.__module__, func.__name__,
+                                 hashlib.md5(repr(args)).hexdigest())
+
+        def store(key, value):
+            ttl = timeout if value is not None else negative_timeout
+            get_cache().set(key, (time.time() + ttl, value),
+                            timeout=ttl + stale)
+
+        def run_flight(key, args, flight):
+            try:
+                flight.value = func(*args)
+                flight.ok = True
+                store(key, flight.value)
+                return flight.value
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with flights_lock:
+                    del flights[key]
+                flight.done.set()
+
+        def compute(key, args):
+            with flights_lock:
+                flight = flights.get(key)
+                if flight is None:
+                    flight = flights[key] = _Flight()
+                    leader = True
+                else:
+                    leader = False
+            if leader:
+                return run_flight(key, args, flight)
+            if not flight.done.wait(FLIGHT_TIMEOUT):
+                raise RuntimeError("Timeout while waiting for %s%r" %
+                                   (func.__name__, args))
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        def refresh_in_background(key, args):
+            with flights_lock:
+                if key in flights:
+                    return
+                flight = flights[key] = _Flight()
+            app = flask.current_app._get_current_object()
+
+            def run():
+                with app.app_context():
+                    try:
+                        run_flight(key, args, flight)
+                    except Exception:
+                        log.exception("Failed to refresh %s%r",
+                                      func.__name__, args)
+
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+
         @wraps(func)
         def wrapper(*args):
-            cache = get_cache()
-            key = '%s.%s %r' % (func.__module__, func.__name__, args)
-            rv = cache.get(key)
-            if rv is None:
-                rv = func(*args)
-                cache.set(key, rv, timeout=timeout)
+            key = cache_key(args)
+            entry = get_cache().get(key)
+            if entry is None:
+                return compute(key, args)
+            expires, value = entry
+            if expires <= time.time():
+                if not stale:
+                    return compute(key, args)
+                refresh_in_background(key, args)
+            return value
+
+        def lookup_many(args_list):
+            keys = [cache_key(args) for args in args_list]
+            entries = get_cache().get_many(*keys)
+            return {args: entry[1] for args, entry in zip(args_list, entries)
+                    if entry is not None}
+
+        def prime(args, value):
+            store(cache_key(args), value)
+
+        def refresh(*args):
+            rv = func(*args)
+            prime(args, rv)
             return rv
+
+        wrapper.lookup_many = lookup_many
+        wrapper.prime = prime
+        wrapper.refresh = refresh
         return wrapper
     return decorator
 
@@ -32,11 +138,20 @@ def get_cache():
 
 
 def initialize_app(app):
-    if app.config['CACHING']:
-        cache = SimpleCache()
-    else:
-        cache = NullCache()
-    app.extensions['gioland-cache'] = cache
+    from gioland.cache import create_cache
+    app.extensions['gioland-cache'] = create_cache(app.config)
+
+
+_timezones = {}
+
+
+def gettz(name):
+    """ `dateutil.tz.gettz`, which parses the zone file on every call,
+    memoized. """
+    zone = _timezones.get(name)
+    if zone is None:
+        zone = _timezones[name] = tz.gettz(name)
+    return zone
 
 
 def format_datetime(value, format_name='long'):
@@ -44,8 +159,8 @@ def format_datetime(value, format_name='long'):
     from gioland.definitions import DATE_FORMAT
     timezone = flask.current_app.config.get("TIME_ZONE")
     if timezone:
-        from_zone = tz.gettz("UTC")
-        to_zone = tz.gettz(timezone)
+        from_zone = gettz("UTC")
+        to_zone = gettz(timezone)
         # Tell the datetime object that it's in UTC time zone since
         # datetime objects are 'naive' by default
         value = value.replace(tzinfo=from_zone)
@@ -61,8 +176,9 @@ def isoformat_to_datetime(value):
 LOCK_TIMEOUT = 5.0
 
 
-def get_lock():
-    lock_path = flask.current_app.config['LOCK_FILE_PATH']
+def get_lock(lock_path=None):
+    if lock_path is None:
+        lock_path = flask.current_app.config['LOCK_FILE_PATH']
     t0 = time.time()
     while True:
         if time.time() - t0 > LOCK_TIMEOUT:
@@ -72,6 +188,7 @@ def get_lock():
             return LockFile(lock_path)
 
         except LockError:
+            metrics.count('lock_busy')
             log.debug("Lock busy, sleeping ...")
             time.sleep(0.2)
 
@@ -81,13 +198,16 @@ def exclusive_lock(func=None):
         # we're being used as context manager
         @contextmanager
         def locker():
-            lock = get_lock()
             t0 = time.time()
+            lock = get_lock()
+            t1 = time.time()
+            metrics.count('lock_wait_seconds', t1 - t0)
             try:
                 yield
             finally:
                 lock.close()
-                duration = time.time() - t0
+                duration = time.time() - t1
+                metrics.count('lock_hold_seconds', duration)
                 log.debug("Held lock for %.3f" % duration)
         return locker()
 
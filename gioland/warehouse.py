@@ -2,23 +2,35 @@ import hashlib
 import logging
 import logging.handlers
 import tempfile
+import threading
+import time
+import uuid
 from datetime import datetime
 
 import transaction
-from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from ZODB.POSException import ConflictError
 from path import path
 from persistent import Persistent
 from persistent.list import PersistentList
 from persistent.mapping import PersistentMapping
 
-from gioland.definitions import COUNTRY
+from gioland import metrics
+from gioland.audit import AUDIT_DIR_NAME, AuditHandler
+from gioland.definitions import COUNTRY, SIMILAR_METADATA
 from gioland.definitions import METADATA, COUNTRY_EXCLUDE_METADATA, STREAM, STREAM_EXCLUDE_METADATA
 
 log = logging.getLogger(__name__)
 
 LOGGING_FORMAT = '[%(asctime)s] %(levelname)s %(message)s'
 LOG_FILE_NAME = 'activity.log'
+STATS_CLASSES_COUNT = 20
 BLOCK_SIZE = 8192
+# metadata that decides where a parcel is listed in the overview views
+VIEW_METADATA = frozenset(['delivery_type', 'country', 'lot', 'product',
+                           'next_parcel'])
+# metadata that decides the key of a parcel in the similarity index
+SIMILARITY_METADATA = frozenset(SIMILAR_METADATA + ('stage', 'next_parcel'))
 log_number = 1
 
 
@@ -31,6 +43,12 @@ def _current_user():
         return default
 
 
+def _audit(event, parcel=None, **data):
+    """ `extra` for a warehouse log call, picked up by the audit log. """
+    return {'audit': {'event': event, 'parcel': parcel,
+                      'user': _current_user(), 'data': data}}
+
+
 def _ensure_unicode(thing):
     if isinstance(thing, str):
         try:
@@ -61,12 +79,41 @@ def checksum(path):
                 if not data:
                     break
                 md5.update(data)
+                metrics.count('file_read_bytes', len(data))
             files.append((p.name, md5.hexdigest()))
     return files
 
 
+def _view_key(parcel):
+    """ The overview page (delivery type and country or lot code) and
+    product under which `parcel` is listed, or None if it's not the tail
+    of a chain. """
+    metadata = parcel.metadata
+    if 'next_parcel' in metadata:
+        return None
+    delivery_type = metadata.get('delivery_type')
+    code = metadata.get('country' if delivery_type == COUNTRY else 'lot')
+    product = metadata.get('product')
+    if delivery_type is None or code is None or product is None:
+        return None
+    return (delivery_type, code), product
+
+
+def similarity_key(parcel):
+    """ Parcels that may be merged together share this key. """
+    return tuple(parcel.metadata.get(k, '') for k in SIMILAR_METADATA) + \
+        (parcel.metadata.get('stage'),)
+
+
 class Parcel(Persistent):
 
+    # for parcels saved before chains were indexed
+    chain_id = None
+    # where the parcel is listed in the overview views
+    view_key = None
+    # key of the parcel in the similarity index
+    similar_key = None
+
     def __init__(self, warehouse, name):
         self._warehouse = warehouse
         self.name = name
@@ -86,13 +133,21 @@ class Parcel(Persistent):
 
     def save_metadata(self, new_metadata):
         self._warehouse.logger.info("Metadata update for %r: %r (user %s)",
-                                    self.name, new_metadata, _current_user())
+                                    self.name, new_metadata, _current_user(),
+                                    extra=_audit('metadata_update', self.name,
+                                                 metadata=new_metadata))
         for key, value in new_metadata.iteritems():
             if key == 'prev_parcel_list':
                 self.metadata[_ensure_unicode(key)] = \
                     [_ensure_unicode(v) for v in value]
             else:
                 self.metadata[_ensure_unicode(key)] = _ensure_unicode(value)
+        if 'stage' in new_metadata:
+            self._warehouse.stage_changed(self)
+        if VIEW_METADATA.intersection(new_metadata):
+            self._warehouse.update_views(self)
+        if SIMILARITY_METADATA.intersection(new_metadata):
+            self._warehouse.update_similar(self)
 
     def get_path(self):
         return self._warehouse.parcels_path / self.name
@@ -104,7 +159,8 @@ class Parcel(Persistent):
 
     def finalize(self):
         self._warehouse.logger.info("Finalizing %r (user %s)",
-                                    self.name, _current_user())
+                                    self.name, _current_user(),
+                                    extra=_audit('finalize', self.name))
         self.checksum = checksum(self.get_path())
         self.save_metadata({'upload_time': datetime.utcnow().isoformat()})
 
@@ -164,6 +220,90 @@ class Report(Persistent):
         return '%s' % self.lot
 
 
+class Chain(Persistent):
+    """ Names of the parcels of a delivery, in workflow order, and their
+    stages. The parcel created by a merge starts a new chain. The id is
+    the name of the first parcel. """
+
+    # for chains indexed before stages were kept
+    stages = None
+    # (stage, count) of the merged parcels that precede the chain
+    merged = None
+
+    def __init__(self, id_):
+        self.id = id_
+        self.parcels = PersistentList()
+        self.stages = PersistentList()
+
+    def append(self, name, stage):
+        self.parcels.append(name)
+        self.stages.append(stage)
+
+    def remove(self, name):
+        index = self.parcels.index(name)
+        del self.parcels[index]
+        del self.stages[index]
+
+    def set_stage(self, name, stage):
+        self.stages[self.parcels.index(name)] = stage
+
+    def stage_summary(self, name):
+        """ Name of the latest parcel in each stage, up to parcel
+        `name`. """
+        summary = {}
+        for index in range(self.parcels.index(name), -1, -1):
+            summary.setdefault(self.stages[index], self.parcels[index])
+        return summary
+
+
+class OutboxMessage(Persistent):
+
+    def __init__(self, key, rdf_triples, time):
+        self.key = key
+        self.rdf_triples = rdf_triples
+        self.created = time
+        self.next_attempt = time
+        self.attempts = 0
+        self.last_error = None
+
+
+class Outbox(Persistent):
+    """ Notifications waiting to be delivered, and those that were given up
+    on (`dead`) after too many failed attempts. """
+
+    def __init__(self):
+        self.pending = OOBTree()
+        self.dead = OOBTree()
+
+    def enqueue(self, rdf_triples):
+        now = datetime.utcnow()
+        key = '%s-%s' % (now.isoformat(), uuid.uuid4().hex[:8])
+        message = OutboxMessage(key, rdf_triples, now)
+        self.pending[key] = message
+        return message
+
+    def due(self, now):
+        return [m for m in self.pending.values() if m.next_attempt <= now]
+
+    def delivered(self, message):
+        del self.pending[message.key]
+
+    def failed(self, message, error, next_attempt):
+        message.attempts += 1
+        message.last_error = error
+        message.next_attempt = next_attempt
+
+    def bury(self, message):
+        del self.pending[message.key]
+        self.dead[message.key] = message
+
+    def revive(self, key):
+        message = self.dead.pop(key)
+        message.attempts = 0
+        message.next_attempt = datetime.utcnow()
+        self.pending[key] = message
+
+
 class Warehouse(Persistent):
 
     _volatile_attributes = {}
@@ -179,6 +319,9 @@ class Warehouse(Persistent):
     def __init__(self):
         self._parcels = OOBTree()
         self._reports = OOBTree()
+        self._views = OOBTree()
+        self._similar = OOBTree()
+        self._outbox = Outbox()
 
     @property
     def parcels_path(self):
@@ -192,18 +335,27 @@ class Warehouse(Persistent):
     def tree_path(self):
         return self.fs_path / 'tree'
 
-    def new_parcel(self):
+    def new_parcel(self, metadata=None):
+        """ Create a parcel with the initial `metadata`; its
+        `prev_parcel_list` decides whether it continues a chain. """
         parcel_path = path(tempfile.mkdtemp(prefix='', dir=self.parcels_path))
         parcel_path.chmod(0755)
         parcel = Parcel(self, parcel_path.name)
         self._parcels[parcel.name] = parcel
         self.logger.info("New parcel %r (user %s)",
-                         parcel.name, _current_user())
+                         parcel.name, _current_user(),
+                         extra=_audit('new_parcel', parcel.name))
+        if metadata:
+            parcel.save_metadata(metadata)
+        self._link_parcel(parcel)
         return parcel
 
     def delete_parcel(self, name):
-        self.logger.info("Deleting parcel %r (user %s)", name, _current_user())
-        self._parcels.pop(name)
+        self.logger.info("Deleting parcel %r (user %s)", name, _current_user(),
+                         extra=_audit('delete_parcel', name))
+        parcel = self._parcels.pop(name)
+        self._remove_from_chain(parcel)
+        self.reindex(parcel)
 
     def get_parcel(self, name):
         return self._parcels[name]
@@ -211,6 +363,12 @@ class Warehouse(Persistent):
     def get_all_parcels(self):
         return iter(self._parcels.values())
 
+    def iter_parcels(self, after=None):
+        """ Parcels in name order, starting after the name `after`. """
+        if after is None:
+            return iter(self._parcels.values())
+        return iter(self._parcels.values(min=after, excludemin=True))
+
     def new_report(self, lot):
         report = Report(lot)
         pk = max(self._reports.keys() or [0]) + 1
@@ -218,7 +376,8 @@ class Warehouse(Persistent):
         report.user = _current_user()
         self._reports[pk] = report
         self.logger.info("New report for %r (user %s)",
-                         report.name, _current_user())
+                         report.name, _current_user(),
+                         extra=_audit('new_report', report=report.name))
         return report
 
     def get_report(self, report_id):
@@ -230,36 +389,333 @@ class Warehouse(Persistent):
     def delete_report(self, report_id):
         self._reports.pop(report_id)
 
+    @property
+    def chains(self):
+        # created on first write, for databases that predate chain indexing
+        if getattr(self, '_chains', None) is None:
+            self._chains = OOBTree()
+        return self._chains
+
+    def _new_chain(self, parcel):
+        chain = Chain(parcel.name)
+        self.chains[chain.id] = chain
+        self._move_to_chain(parcel, chain)
+        return chain
+
+    def _remove_from_chain(self, parcel):
+        chain = self.chains.get(parcel.chain_id)
+        if chain is None or parcel.name not in chain.parcels:
+            return
+        self._ensure_stages(chain)
+        chain.remove(parcel.name)
+        if not chain.parcels:
+            del self.chains[chain.id]
+
+    def _move_to_chain(self, parcel, chain):
+        if self.chains.get(parcel.chain_id) is not chain:
+            self._remove_from_chain(parcel)
+        if parcel.name not in chain.parcels:
+            self._ensure_stages(chain)
+            chain.append(parcel.name, parcel.metadata.get('stage'))
+        if parcel.chain_id != chain.id:
+            parcel.chain_id = chain.id
+
+    def _ensure_stages(self, chain):
+        if chain.stages is not None:
+            return
+        parcels = [self._parcels.get(name) for name in chain.parcels]
+        chain.stages = PersistentList(p and p.metadata.get('stage')
+                                      for p in parcels)
+        chain.merged = self._merge_info(self._parcels.get(chain.id))
+
+    def _merge_info(self, parcel):
+        if parcel is None:
+            return None
+        prev_names = parcel.metadata.get('prev_parcel_list', [])
+        if len(prev_names) < 2 or prev_names[0] not in self._parcels:
+            return None
+        prev_parcel = self.get_parcel(prev_names[0])
+        return (prev_parcel.metadata.get('stage'), len(prev_names))
+
+    def _link_parcel(self, parcel):
+        """ Add a new `parcel` to the chain index: a single previous parcel
+        means `parcel` continues that chain, none or several (a merge)
+        mean it starts a new one. """
+        prev_names = parcel.metadata.get('prev_parcel_list', [])
+        if len(prev_names) == 1 and prev_names[0] in self._parcels:
+            prev_parcel = self.get_parcel(prev_names[0])
+            chain = self.chains.get(prev_parcel.chain_id)
+            if chain is None or prev_parcel.name not in chain.parcels:
+                # not migrated yet, see `rebuild_chains`
+                chain = self._index_chain(self._first_of_chain(prev_parcel))
+            self._move_to_chain(parcel, chain)
+        else:
+            self._new_chain(parcel).merged = self._merge_info(parcel)
+
+    def stage_changed(self, parcel):
+        chain = self.chains.get(parcel.chain_id)
+        if chain is None or parcel.name not in chain.parcels:
+            return
+        self._ensure_stages(chain)
+        chain.set_stage(parcel.name, parcel.metadata.get('stage'))
+
+    def get_chain(self, name):
+        """ The chain of parcel `name`. Doesn't write to the database:
+        parcels that predate the index get a chain computed from their
+        links until `rebuild_chains` is run. """
+        parcel = self.get_parcel(name)
+        chains = getattr(self, '_chains', None) or {}
+        chain = chains.get(parcel.chain_id)
+        if (chain is not None and name in chain.parcels and
+                chain.stages is not None):
+            return chain
+        first = self._first_of_chain(parcel)
+        chain = Chain(first.name)
+        chain.merged = self._merge_info(first)
+        for parcel in self._walk_chain(first):
+            chain.append(parcel.name, parcel.metadata.get('stage'))
+        return chain
+
+    def _first_of_chain(self, parcel):
+        while True:
+            prev_names = parcel.metadata.get('prev_parcel_list', [])
+            if len(prev_names) != 1 or prev_names[0] not in self._parcels:
+                return parcel
+            parcel = self.get_parcel(prev_names[0])
+
+    def _walk_chain(self, first):
+        parcel = first
+        while True:
+            yield parcel
+            next_name = parcel.metadata.get('next_parcel')
+            if next_name is None or next_name not in self._parcels:
+                return
+            parcel = self.get_parcel(next_name)
+            if len(parcel.metadata.get('prev_parcel_list', [])) != 1:
+                return
+
+    def _index_chain(self, first):
+        chain = self.chains.get(first.name)
+        if chain is None:
+            chain = Chain(first.name)
+            self.chains[chain.id] = chain
+        chain.parcels = PersistentList()
+        chain.stages = PersistentList()
+        chain.merged = self._merge_info(first)
+        for parcel in self._walk_chain(first):
+            self._move_to_chain(parcel, chain)
+        return chain
+
+    def rebuild_chains(self):
+        """ Index all chains again from the parcel links; run it once on
+        databases that predate the index. Returns the number of chains. """
+        self._chains = OOBTree()
+        for parcel in self._parcels.values():
+            prev_names = parcel.metadata.get('prev_parcel_list', [])
+            if len(prev_names) != 1 or prev_names[0] not in self._parcels:
+                self._index_chain(parcel)
+        for parcel in self._parcels.values():
+            chain = self._chains.get(parcel.chain_id)
+            if chain is None or parcel.name not in chain.parcels:
+                self._new_chain(parcel)
+        return len(self._chains)
+
+    @property
+    def views(self):
+        # None until `rebuild_views` is run on databases that predate them
+        return getattr(self, '_views', None)
+
+    def get_view(self, delivery_type, code):
+        """ Names of the chain tails on the overview page of `code`,
+        by product. """
+        if self.views is None:
+            return self._scan_view((delivery_type, code))
+        return self.views.get((delivery_type, code), {})
+
+    def _scan_view(self, key):
+        view = {}
+        for parcel in self._parcels.values():
+            view_key = _view_key(parcel)
+            if view_key is not None and view_key[0] == key:
+                view.setdefault(view_key[1], []).append(parcel.name)
+        return view
+
+    def update_views(self, parcel):
+        """ List `parcel` in the overview views according to its current
+        metadata, or drop it if it's no longer a chain tail or was
+        deleted. """
+        if self.views is None:
+            return
+        if parcel.name in self._parcels:
+            view_key = _view_key(parcel)
+        else:
+            view_key = None
+        if view_key == parcel.view_key:
+            return
+        views = self.views
+        if parcel.view_key is not None:
+            key, product = parcel.view_key
+            view = views.get(key, {})
+            names = view.get(product)
+            if names is not None and parcel.name in names:
+                names.remove(parcel.name)
+                if not names:
+                    del view[product]
+                    if not view:
+                        del views[key]
+        if view_key is not None:
+            self._add_to_view(view_key, parcel.name)
+        parcel.view_key = view_key
+
+    def _add_to_view(self, view_key, name):
+        key, product = view_key
+        view = self._views.get(key)
+        if view is None:
+            view = self._views[key] = OOBTree()
+        names = view.get(product)
+        if names is None:
+            names = view[product] = OOTreeSet()
+        names.insert(name)
+
+    def rebuild_views(self):
+        """ List all chain tails in the overview views again; run it once
+        on databases that predate the views. Returns the number of
+        overview pages. """
+        self._views = OOBTree()
+        for parcel in self._parcels.values():
+            view_key = _view_key(parcel)
+            if view_key is not None:
+                self._add_to_view(view_key, parcel.name)
+            if view_key != parcel.view_key:
+                parcel.view_key = view_key
+        return len(self._views)
+
+    @property
+    def similar(self):
+        # None until `rebuild_views` is run on databases that predate it
+        return getattr(self, '_similar', None)
+
+    def get_similar(self, parcel):
+        """ Names of the chain tails that share the similarity key of
+        `parcel`. """
+        key = similarity_key(parcel)
+        if self.similar is None:
+            return [p.name for p in self._parcels.values()
+                    if self._similar_key(p) == key]
+        return list(self.similar.get(key, []))
+
+    def _similar_key(self, parcel):
+        if (parcel.name in self._parcels and
+                'next_parcel' not in parcel.metadata and
+                parcel.metadata.get('stage') is not None):
+            return similarity_key(parcel)
+        return None
+
+    def update_similar(self, parcel):
+        """ Index `parcel` under its current similarity key, or drop it
+        if it's no longer a chain tail or was deleted. """
+        if self.similar is None:
+            return
+        key = self._similar_key(parcel)
+        if key == parcel.similar_key:
+            return
+        index = self.similar
+        names = index.get(parcel.similar_key)
+        if names is not None and parcel.name in names:
+            names.remove(parcel.name)
+            if not names:
+                del index[parcel.similar_key]
+        if key is not None:
+            self._add_to_similar(key, parcel.name)
+        parcel.similar_key = key
+
+    def _add_to_similar(self, key, name):
+        names = self._similar.get(key)
+        if names is None:
+            names = self._similar[key] = OOTreeSet()
+        names.insert(name)
+
+    def rebuild_similar(self):
+        """ Index all chain tails by similarity key again; run it once on
+        databases that predate the index. Returns the number of keys. """
+        self._similar = OOBTree()
+        for parcel in self._parcels.values():
+            key = self._similar_key(parcel)
+            if key is not None:
+                self._add_to_similar(key, parcel.name)
+            if key != parcel.similar_key:
+                parcel.similar_key = key
+        return len(self._similar)
+
+    def reindex(self, parcel):
+        """ Update the views and the similarity index after the metadata
+        of `parcel` was changed without `save_metadata`, or the parcel was
+        deleted. """
+        self.update_views(parcel)
+        self.update_similar(parcel)
+
+    @property
+    def outbox(self):
+        # created on the first notification queued on databases that
+        # predate the outbox; readers treat a missing `_outbox` as empty
+        if getattr(self, '_outbox', None) is None:
+            self._outbox = Outbox()
+        return self._outbox
+
 
 class WarehouseConnector(object):
 
-    def __init__(self, fs_path):
+    def __init__(self, fs_path, pool_size=7, cache_size=400,
+                 cache_size_bytes=0):
         self._fs_path = path(fs_path)
         self._db = None
+        self._db_options = {'pool_size': pool_size,
+                            'cache_size': cache_size,
+                            'cache_size_bytes': cache_size_bytes}
+        self.started = time.time()
+        self.totals = {'loads': 0, 'stores': 0, 'commits': 0}
+        self._totals_lock = threading.Lock()
 
     def _get_db(self):
         if self._db is None:
+            from ZODB.ActivityMonitor import ActivityMonitor
             from ZODB.DB import DB
             from ZODB.FileStorage import FileStorage
             filestorage_path = _ensure_dir(self._fs_path / 'filestorage')
             storage = FileStorage(str(filestorage_path / 'Data.fs'))
-            self._db = DB(storage)
+            self._db = DB(storage, **self._db_options)
+            self._db.setActivityMonitor(ActivityMonitor())
         return self._db
 
+    def add_totals(self, **counts):
+        with self._totals_lock:
+            for name, value in counts.iteritems():
+                self.totals[name] += value
+
     def open_warehouse(self):
         global log_number
 
         conn = self._get_db().open()
+        conn.getTransferCounts(True)
         transaction.begin()
         handler = logging.handlers.WatchedFileHandler(
             self._fs_path / LOG_FILE_NAME)
         handler.setLevel(logging.INFO)
         handler.setFormatter(logging.Formatter(LOGGING_FORMAT))
+        audit_handler = AuditHandler(
+            _ensure_dir(self._fs_path / AUDIT_DIR_NAME))
+        audit_handler.setLevel(logging.INFO)
 
         def cleanup():
             transaction.abort()
             warehouse.logger.removeHandler(handler)
+            warehouse.logger.removeHandler(audit_handler)
             del warehouse._volatile_attributes[id(warehouse)]
+            # not cleared; the activity monitor reads them on close
+            loads, stores = conn.getTransferCounts()
+            metrics.count('zodb_loads', loads)
+            metrics.count('zodb_stores', stores)
+            self.add_totals(loads=loads, stores=stores)
             conn.close()
 
         zodb_root = conn.root()
@@ -274,12 +730,20 @@ class WarehouseConnector(object):
         warehouse.logger.setLevel(logging.INFO)
         log_number += 1
         warehouse.logger.addHandler(handler)
+        warehouse.logger.addHandler(audit_handler)
         _ensure_dir(warehouse.parcels_path)
         _ensure_dir(warehouse.reports_path)
         _ensure_dir(warehouse.tree_path)
 
         return warehouse, cleanup
 
+    def db_stats(self):
+        """ Gauges for the metrics endpoint. """
+        if self._db is None:
+            return {}
+        return {'zodb_cache_objects': self._db.cacheSize(),
+                'zodb_database_bytes': self._db.getSize()}
+
     def close(self):
         if self._db is not None:
             self._db.close()
@@ -301,7 +765,16 @@ def _cleanup_warehouse(err=None):
     if hasattr(flask.g, 'warehouse'):
         if err is None:
             transaction.get().note(flask.request.url)
-            transaction.commit()
+            t0 = time.time()
+            try:
+                transaction.commit()
+                connector = flask.current_app.extensions['warehouse_connector']
+                connector.add_totals(commits=1)
+            except ConflictError:
+                metrics.count('zodb_conflicts')
+                raise
+            finally:
+                metrics.count('zodb_commit_seconds', time.time() - t0)
         else:
             transaction.abort()
         flask.g.warehouse_cleanup()
@@ -316,8 +789,13 @@ def initialize_app(app):
     if 'WAREHOUSE_PATH' not in app.config:
         return
 
-    connector = WarehouseConnector(app.config['WAREHOUSE_PATH'])
+    connector = WarehouseConnector(
+        app.config['WAREHOUSE_PATH'],
+        pool_size=app.config['ZODB_POOL_SIZE'],
+        cache_size=app.config['ZODB_CACHE_SIZE'],
+        cache_size_bytes=app.config['ZODB_CACHE_SIZE_BYTES'])
     app.extensions['warehouse_connector'] = connector
+    metrics.get_registry(app).gauge_callbacks.append(connector.db_stats)
     app.teardown_request(_cleanup_warehouse)
 
     @app.route('/zodb_pack', methods=['GET', 'POST'])
@@ -333,6 +811,32 @@ def initialize_app(app):
 
         return flask.render_template('zodb_pack.html', db=db)
 
+    @app.route('/zodb_stats')
+    def zodb_stats():
+        if not auth.authorize(['ROLE_ADMIN']):
+            return flask.abort(403)
+
+        db = connector._get_db()
+        now = time.time()
+        recent = db.undoLog(0, 100)
+        if len(recent) > 1:
+            span = now - min(tr['time'] for tr in recent)
+            transaction_rate = len(recent) / (span / 60.0)
+        else:
+            transaction_rate = None
+        classes = sorted(db.cacheDetail(), key=lambda item: -item[1])
+        return flask.render_template('zodb_stats.html', **{
+            'db': db,
+            'connections': db.cacheDetailSize(),
+            'classes': classes[:STATS_CLASSES_COUNT],
+            'totals': dict(connector.totals),
+            'uptime': now - connector.started,
+            'transaction_rate': transaction_rate,
+            'recent_count': len(recent),
+            'activity': db.getActivityMonitor().getActivityAnalysis(
+                divisions=6),
+        })
+
     @app.route('/zodb_undo', methods=['GET', 'POST'])
     def zodb_undo():
         if not auth.authorize(['ROLE_ADMIN']):
@@ -9,14 +9,31 @@ import flask_script
 
 default_config = {
     'LDAP_TIMEOUT': 10,
+    'LDAP_POOL_SIZE': 4,
+    'LDAP_POOL_IDLE_TIMEOUT': 300,
+    'LDAP_GROUPS_REFRESH_INTERVAL': 4 * 60,
     'TIME_ZONE': 'Europe/Copenhagen',
     'BASE_URL': "",
     'UNS_CHANNEL_ID': 0,
     'UNS_SUPPRESS_NOTIFICATIONS': False,
+    'UNS_URL': "http://uns.eionet.europa.eu/rpcrouter",
+    'UNS_TIMEOUT': 10,
+    'UNS_OUTBOX': False,
+    'UNS_OUTBOX_INTERVAL': 10,
     'ROLE_ADMIN': [],
     'CACHING': True,
+    'CACHE_TYPE': 'simple',
+    'CACHE_THRESHOLD': 500,
+    'CACHE_MAX_BYTES': 16 * 1024 * 1024,
+    'CACHE_SERVERS': ['127.0.0.1:11211'],
     'ALLOW_PARCEL_DELETION': False,
     'LDAP_SERVER': None,
+    'METRICS_DIR': None,
+    'ZODB_POOL_SIZE': 7,
+    'ZODB_CACHE_SIZE': 400,
+    'ZODB_CACHE_SIZE_BYTES': 0,
+    'SLOW_REQUEST_THRESHOLD': 10,
+    'SLOW_REQUEST_SAMPLE_INTERVAL': 0.5,
 }
 
 
@@ -24,6 +41,7 @@ LOG_FORMAT = "[%(asctime)s] %(name)s %(levelname)s %(message)s"
 
 
 def register_monitoring_views(app):
+    from gioland import metrics
     from gioland import warehouse
 
     @app.route('/ping')
@@ -31,6 +49,8 @@ def register_monitoring_views(app):
         warehouse.get_warehouse()
         return 'gioland is ok'
 
+    app.add_url_rule('/metrics', 'metrics', metrics.view_metrics)
+
     @app.route('/crash')
     def crash():
         raise ValueError("Crashing as requested")
@@ -38,7 +58,11 @@ def register_monitoring_views(app):
 
 def create_app(config={}, testing=False):
     from gioland import auth
+    from gioland import metrics
+    from gioland import notification
     from gioland import parcel
+    from gioland import profiler
+    from gioland import slowlog
     from gioland import warehouse
     from gioland import utils
     app = flask.Flask(__name__)
@@ -48,9 +72,13 @@ def create_app(config={}, testing=False):
     else:
         app.config.update(configuration_from_environ())
     app.config.update(config)
+    metrics.register_on(app)
     warehouse.initialize_app(app)
     auth.register_on(app)
     parcel.register_on(app)
+    notification.register_on(app)
+    profiler.register_on(app)
+    slowlog.register_on(app)
     register_monitoring_views(app)
     utils.initialize_app(app)
 
@@ -93,6 +121,8 @@ manager = flask_script.Manager(create_app)
 
 def configuration_from_environ():
     BOOL = lambda value: value == 'on'
+    INT = lambda value: int(value)
+    FLOAT = lambda value: float(value)
     STR = lambda value: value
     STRLIST = lambda value: value.split()
     options = {
@@ -112,10 +142,28 @@ def configuration_from_environ():
         'UNS_LOGIN_USERNAME': STR,
         'UNS_LOGIN_PASSWORD': STR,
         'UNS_SUPPRESS_NOTIFICATIONS': BOOL,
+        'UNS_URL': STR,
+        'UNS_TIMEOUT': INT,
+        'UNS_OUTBOX': BOOL,
+        'UNS_OUTBOX_INTERVAL': INT,
         'LDAP_SERVER': STR,
         'LDAP_USER_DN_PATTERN': STR,
+        'LDAP_POOL_SIZE': INT,
+        'LDAP_POOL_IDLE_TIMEOUT': INT,
+        'LDAP_GROUPS_REFRESH_INTERVAL': INT,
         'ALLOW_PARCEL_DELETION': BOOL,
         'DOCS_URL': STR,
+        'CACHE_TYPE': STR,
+        'CACHE_DIR': STR,
+        'CACHE_THRESHOLD': INT,
+        'CACHE_MAX_BYTES': INT,
+        'CACHE_SERVERS': STRLIST,
+        'METRICS_DIR': STR,
+        'ZODB_POOL_SIZE': INT,
+        'ZODB_CACHE_SIZE': INT,
+        'ZODB_CACHE_SIZE_BYTES': INT,
+        'SLOW_REQUEST_THRESHOLD': FLOAT,
+        'SLOW_REQUEST_SAMPLE_INTERVAL': FLOAT,
     }
     config = {}
     for name, converter in options.items():
@@ -196,6 +244,25 @@ def fsck():
     print "Finished checking for parcel checksums"
 
 
+@manager.command
+def rebuild_chains():
+    """ Index the parcels of each delivery chain again, from the links
+    between parcels. """
+    from gioland.warehouse import get_warehouse
+    count = get_warehouse().rebuild_chains()
+    print "Indexed %d chains" % count
+
+
+@manager.command
+def rebuild_views():
+    """ List the chain tails in the country, lot and stream overview views,
+    and in the similarity index used to find parcels to merge, again. """
+    from gioland.warehouse import get_warehouse
+    wh = get_warehouse()
+    print "Rebuilt %d overview pages" % wh.rebuild_views()
+    print "Indexed %d similarity keys" % wh.rebuild_similar()
+
+
 @manager.command
 def update_tree():
     from gioland.warehouse import get_warehouse
@@ -206,6 +273,169 @@ def update_tree():
         print p.name, (p.link_in_tree() or '[already linked]')
 
 
+@manager.option('--parcel', dest='parcel')
+@manager.option('--user', dest='user')
+@manager.option('--since', dest='since')
+@manager.option('--until', dest='until')
+@manager.option('--limit', dest='limit', type=int, default=100)
+def audit_log(parcel=None, user=None, since=None, until=None, limit=100):
+    """ Print audit records as JSON lines, newest first. `since` and
+    `until` are days, e.g. 2014-01-31. """
+    import json
+    from gioland import audit
+    app = flask._request_ctx_stack.top.app
+    audit_dir = os.path.join(app.config['WAREHOUSE_PATH'],
+                             audit.AUDIT_DIR_NAME)
+    for record in audit.query(audit_dir, parcel=parcel, user=user,
+                              since=since, until=until, limit=limit):
+        print json.dumps(record, sort_keys=True)
+
+
+@manager.command
+def bench_notifications(count=1000):
+    """ Time building the UNS payload of a notification. """
+    import timeit
+    from datetime import datetime
+    from gioland import notification
+    from gioland.definitions import COUNTRY, LOT, STREAM
+    from gioland.warehouse import Parcel
+
+    count = int(count)
+    for delivery_type in [COUNTRY, LOT, STREAM]:
+        parcel = Parcel(None, 'bench')
+        parcel.metadata.update({
+            'country': 'dk',
+            'lot': 'lot3',
+            'stage': 'c-fsc',
+            'product': 'grl',
+            'resolution': '20m',
+            'extent': 'full',
+            'reference': '2015',
+            'delivery_type': delivery_type,
+        })
+        item = parcel.add_history_item("Bench", datetime.utcnow(),
+                                       'somebody', "")
+        duration = timeit.timeit(
+            lambda: notification.prepare_notification_rdf(item, 'comment'),
+            number=count)
+        print "%-8s %8.1f us per notification" % (
+            delivery_type, duration / count * 10 ** 6)
+
+
+@manager.option('--chains', dest='chains', type=int, default=50)
+@manager.option('--chain-length', dest='chain_length', type=int, default=4)
+@manager.option('--fan-in', dest='fan_in', type=int, default=1)
+@manager.option('--history', dest='history', type=int, default=5)
+@manager.option('--file-size', dest='file_size', type=int, default=64 * 1024)
+@manager.option('--upload-size', dest='upload_size', type=int,
+                default=4 * 1024 * 1024)
+@manager.option('--chunk-size', dest='chunk_size', type=int,
+                default=1024 * 1024)
+@manager.option('--repeat', dest='repeat', type=int, default=5)
+@manager.option('--seed', dest='seed', type=int, default=0)
+@manager.option('--output', dest='output')
+def bench(output=None, **options):
+    """ Build a synthetic warehouse in a temporary folder, time the main
+    views, a chunked upload and fsck against it, and print the results as
+    JSON (or write them to `output`). """
+    import json
+    from gioland import bench as bench_module
+
+    report = json.dumps(bench_module.run_report(**options),
+                        indent=2, sort_keys=True)
+    if output:
+        with open(output, 'wb') as f:
+            f.write(report + '\n')
+    else:
+        print report
+
+
+@manager.option('--base', dest='base')
+@manager.option('--input', dest='input')
+@manager.option('--store', dest='store', default='bench-results.jsonl')
+@manager.option('--tolerance', dest='tolerance', type=float, default=0.1)
+@manager.option('--noise', dest='noise', type=float, default=3)
+@manager.option('--no-save', dest='save', action='store_false', default=True)
+@manager.option('--force', dest='force', action='store_true', default=False)
+def bench_compare(base=None, input=None, store='bench-results.jsonl',
+                  tolerance=0.1, noise=3, save=True, force=False):
+    """ Run the benchmarks (or read the JSON of `bench --output` from
+    `input`), store the results in `store` keyed by git revision and
+    machine, and compare them with the `base` revision, by default the
+    latest other revision measured on this machine. Exits with status 1
+    when a scenario got slower by more than `tolerance`, and with status 2
+    when there is no such base or it was run with other options (unless
+    `force` is set). """
+    import json
+    import sys
+    from gioland import bench as bench_module
+
+    revision = bench_module.git_revision()
+    machine = bench_module.machine_fingerprint()
+    runs = bench_module.load_runs(store)
+    baseline = bench_module.find_run(runs, machine, revision=base,
+                                     exclude_revision=revision)
+    if base and baseline is None:
+        print "No run of revision %s on this machine in %s" % (base, store)
+        sys.exit(2)
+
+    if input:
+        with open(input, 'rb') as f:
+            report = json.load(f)
+    else:
+        options = baseline['options'] if baseline else {}
+        report = bench_module.run_report(**options)
+    if save:
+        bench_module.store_run(store, report, revision, machine)
+
+    if baseline is None:
+        print "No earlier run on this machine to compare with"
+        return
+    differences = bench_module.option_differences(baseline, report)
+    if differences and not force:
+        print "Not comparing with %s: it was run with other %s" % (
+            baseline['revision'], ', '.join(differences))
+        print "Use --force to compare anyway"
+        sys.exit(2)
+    print "Comparing %s with base %s (machine %s)" % (
+        revision, baseline['revision'], machine)
+    rows = bench_module.compare(baseline, report, tolerance=tolerance,
+                                noise=noise)
+    print bench_module.format_comparison(rows)
+    if any(row[-1] == 'regression' for row in rows):
+        sys.exit(1)
+
+
+@manager.option('--url', dest='url', default='http://127.0.0.1:5000')
+@manager.option('--user', dest='user', required=True)
+@manager.option('--uploaders', dest='uploaders', type=int, default=10)
+@manager.option('--downloaders', dest='downloaders', type=int, default=2)
+@manager.option('--files', dest='files', type=int, default=1)
+@manager.option('--file-size', dest='file_size', type=int,
+                default=20 * 1024 * 1024)
+@manager.option('--chunk-size', dest='chunk_size', type=int,
+                default=1024 * 1024)
+@manager.option('--cleanup', dest='cleanup', action='store_true',
+                default=False)
+def loadtest(url, user, uploaders, downloaders, files, file_size, chunk_size,
+             cleanup):
+    """ Simulate concurrent chunked uploads and downloads against the
+    instance at `url`, logged in as `user` (who needs the ROLE_SP or
+    ROLE_ADMIN role there), and print throughput, chunk latency, lock
+    wait time and errors as JSON. The instance must share this
+    configuration's SECRET_KEY. """
+    import json
+    from gioland import loadtest as loadtest_module
+
+    app = flask._request_ctx_stack.top.app
+    cookie = loadtest_module.session_cookie(app, user)
+    report = loadtest_module.run(url, cookie, uploaders=uploaders,
+                                 downloaders=downloaders, files=files,
+                                 file_size=file_size, chunk_size=chunk_size,
+                                 cleanup=cleanup)
+    print json.dumps(report, indent=2, sort_keys=True)
+
+
 if __name__ == '__main__':
     stderr = logging.StreamHandler()
     stderr.setFormatter(logging.Formatter(LOG_FORMAT))
@@ -0,0 +1,134 @@
+import shutil
+import tempfile
+import unittest
+
+from common import AppTestCase, authorization_patch
+from path import path
+
+
+def setUpModule(self):
+    from gioland import activitylog
+    self.activitylog = activitylog
+
+
+LOG_LINES = [
+    "[2014-01-01 10:00:00] INFO New parcel path('aaa') (user alice)",
+    "[2014-01-01 10:01:00] INFO New parcel path('bbb') (user bob)",
+    "[2014-01-01 10:02:00] INFO Finalizing path('aaa') (user alice)",
+    "[2014-01-01 10:03:00] INFO Delete file 'x.tif' for parcel u'bbb' "
+    "(user alice)",
+    "[2014-01-01 10:04:00] INFO Deleting parcel 'aaa' (user bob)",
+]
+
+
+class ActivityLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.log_path = str(self.tmp / 'activity.log')
+        self.write(LOG_LINES)
+
+    def write(self, lines):
+        with open(self.log_path, 'ab') as f:
+            for line in lines:
+                f.write(line + '\n')
+
+    def read_all(self, **kwargs):
+        pages = []
+        before = None
+        while True:
+            lines, before = activitylog.read_page(self.log_path,
+                                                  before=before, **kwargs)
+            pages.append(lines)
+            if before is None:
+                return pages
+
+    def test_newest_lines_first(self):
+        lines, cursor = activitylog.read_page(self.log_path, limit=2)
+        self.assertEqual(lines, LOG_LINES[:2:-1])
+        self.assertIsNotNone(cursor)
+
+    def test_pages_cover_the_whole_log(self):
+        pages = self.read_all(limit=2)
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(sum(pages, []), LOG_LINES[::-1])
+
+    def test_empty_log(self):
+        open(self.log_path, 'wb').close()
+        self.assertEqual(activitylog.read_page(self.log_path), ([], None))
+
+    def test_filter_by_user(self):
+        pages = self.read_all(limit=1, user='alice')
+        self.assertEqual(sum(pages, []),
+                         [LOG_LINES[3], LOG_LINES[2], LOG_LINES[0]])
+
+    def test_filter_by_parcel_and_user(self):
+        lines, cursor = activitylog.read_page(self.log_path, parcel='aaa',
+                                              user='bob')
+        self.assertEqual(lines, [LOG_LINES[4]])
+        self.assertIsNone(cursor)
+
+    def test_index_follows_appended_lines(self):
+        activitylog.read_page(self.log_path, user='bob')
+        line = "[2014-01-01 10:05:00] INFO New parcel path('ccc') (user bob)"
+        self.write([line])
+        lines, cursor = activitylog.read_page(self.log_path, user='bob')
+        self.assertEqual(lines, [line, LOG_LINES[4], LOG_LINES[1]])
+
+    def test_index_is_rebuilt_after_rotation(self):
+        activitylog.read_page(self.log_path, user='bob')
+        open(self.log_path, 'wb').close()
+        line = "[2014-01-02 10:00:00] INFO New parcel path('ddd') (user bob)"
+        self.write([line])
+        lines, cursor = activitylog.read_page(self.log_path, user='bob')
+        self.assertEqual(lines, [line])
+
+    def test_index_is_rebuilt_when_new_log_outgrows_the_old_one(self):
+        activitylog.read_page(self.log_path, user='bob')
+        self.tmp.joinpath('activity.log').rename(self.log_path + '.1')
+        lines = ["[2014-01-02 10:%02d:00] INFO New parcel path('n%d') "
+                 "(user bob)" % (n, n) for n in range(10)]
+        self.write(lines)
+        result, cursor = activitylog.read_page(self.log_path, user='bob')
+        self.assertEqual(result, lines[::-1])
+
+    def test_parsed_index_is_kept_between_queries(self):
+        activitylog.read_page(self.log_path, user='bob')
+        index_path = path(self.log_path + activitylog.INDEX_SUFFIX)
+        index_path.remove()
+        lines, cursor = activitylog.read_page(self.log_path, user='bob')
+        self.assertEqual(lines, [LOG_LINES[4], LOG_LINES[1]])
+        self.assertFalse(index_path.exists())
+
+    def test_index_written_by_another_process_is_reused(self):
+        activitylog.read_page(self.log_path, user='bob')
+        index_path = path(self.log_path + activitylog.INDEX_SUFFIX)
+        size = index_path.getsize()
+        activitylog._indexes.clear()
+        lines, cursor = activitylog.read_page(self.log_path, user='bob')
+        self.assertEqual(lines, [LOG_LINES[4], LOG_LINES[1]])
+        self.assertEqual(index_path.getsize(), size)
+
+
+class ActivityLogViewTest(AppTestCase):
+
+    CREATE_WAREHOUSE = True
+
+    def setUp(self):
+        from gioland import warehouse
+        self.addCleanup(authorization_patch().stop)
+        self.wh_path.makedirs_p()
+        log_path = self.wh_path / warehouse.LOG_FILE_NAME
+        with open(log_path, 'wb') as f:
+            for line in LOG_LINES:
+                f.write(line + '\n')
+
+    def test_page_links_to_older_entries(self):
+        self.add_to_role('somebody', 'ROLE_ADMIN')
+        resp = self.client.get('/logs?limit=2&user=alice')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("x.tif", resp.data)
+        self.assertNotIn("path('bbb') (user bob)", resp.data)
+        self.assertIn("before=", resp.data)
+        self.assertNotIn("parcel=None", resp.data)
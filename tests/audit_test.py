@@ -0,0 +1,71 @@
+import json
+import os
+
+from common import AppTestCase, authorization_patch
+
+
+def setUpModule(self):
+    from gioland import audit
+    self.audit = audit
+
+
+class AuditLogTest(AppTestCase):
+
+    CREATE_WAREHOUSE = True
+
+    def setUp(self):
+        self.addCleanup(authorization_patch().stop)
+        self.audit_dir = self.wh_path / audit.AUDIT_DIR_NAME
+
+    def new_parcel(self):
+        resp = self.client.post('/parcel/new/country',
+                                data=self.PARCEL_METADATA)
+        return resp.location.rsplit('/', 1)[-1]
+
+    def test_warehouse_changes_are_recorded(self):
+        name = self.new_parcel()
+        records = audit.query(self.audit_dir)
+        self.assertEqual([r['event'] for r in records],
+                         ['metadata_update', 'new_parcel'])
+        self.assertEqual(records[1]['parcel'], name)
+        self.assertEqual(records[1]['user'], 'somebody')
+        self.assertEqual(records[0]['data']['metadata']['country'], 'be')
+
+    def test_query_by_parcel(self):
+        name1 = self.new_parcel()
+        name2 = self.new_parcel()
+        records = audit.query(self.audit_dir, parcel=name1)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(set(r['parcel'] for r in records), set([name1]))
+        self.assertEqual(audit.query(self.audit_dir, parcel=name2,
+                                     user='nobody'), [])
+
+    def test_query_only_indexes_new_records(self):
+        from mock import patch
+        name = self.new_parcel()
+        audit.query(self.audit_dir, parcel=name)
+        self.new_parcel()
+        with patch.object(audit, 'record_keys',
+                          wraps=audit.record_keys) as record_keys:
+            records = audit.query(self.audit_dir, parcel=name)
+            self.assertEqual(len(records), 2)
+            self.assertEqual(record_keys.call_count, 2)
+
+    def test_query_by_day(self):
+        self.audit_dir.makedirs_p()
+        for day in ['2014-01-01', '2014-01-02', '2014-01-03']:
+            with open(os.path.join(self.audit_dir, day + '.jsonl'), 'wb') as f:
+                f.write(json.dumps({'time': day, 'user': 'x'}) + '\n')
+        records = audit.query(self.audit_dir, since='2014-01-02',
+                              until='2014-01-02')
+        self.assertEqual([r['time'] for r in records], ['2014-01-02'])
+        records = audit.query(self.audit_dir, user='x', limit=2)
+        self.assertEqual([r['time'] for r in records],
+                         ['2014-01-03', '2014-01-02'])
+
+    def test_admin_query_endpoint(self):
+        name = self.new_parcel()
+        self.add_to_role('somebody', 'ROLE_ADMIN')
+        resp = self.client.get('/logs/audit?parcel=%s&limit=1' % name)
+        [record] = json.loads(resp.data)['records']
+        self.assertEqual(record['event'], 'metadata_update')
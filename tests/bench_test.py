@@ -0,0 +1,91 @@
+import tempfile
+import unittest
+
+from path import path
+
+from common import AppTestCase
+
+
+class BenchTest(AppTestCase):
+
+    def setUp(self):
+        from gioland import bench
+        self.bench = bench
+        self.app = bench.create_bench_app(self.tmp / 'warehouse')
+        self.addCleanup(self.app.extensions['warehouse_connector'].close)
+
+    def test_generated_chains_include_merges(self):
+        tails = self.bench.generate_warehouse(self.app, chains=4,
+                                              chain_length=4, fan_in=3,
+                                              history=2, file_size=10)
+        self.assertEqual(len(tails), 4)
+        with self.app.test_request_context():
+            parcels = list(self.wh.get_all_parcels())
+            merged = [p for p in parcels
+                      if len(p.metadata.get('prev_parcel_list', [])) == 3]
+            tail = self.wh.get_parcel(tails[0])
+            self.assertNotIn('next_parcel', tail.metadata)
+            self.assertEqual(tail.get_path().joinpath('data.gml').size, 10)
+        self.assertEqual(len(merged), 2)
+        self.assertEqual(len(parcels), 2 * 4 + 2 * (3 + 3 + 2))
+
+    def test_run_reports_every_scenario(self):
+        tails = self.bench.generate_warehouse(self.app, chains=2,
+                                              file_size=10)
+        results = self.bench.run(self.app, tails, repeat=1,
+                                 upload_size=1000, chunk_size=300)
+        self.assertEqual(sorted(results), ['chain', 'country', 'fsck', 'lot',
+                                           'parcel', 'search', 'upload'])
+        self.assertEqual(results['upload']['n'], 1)
+        self.assertEqual(results['upload']['bytes'], 1000)
+
+
+class BenchCompareTest(unittest.TestCase):
+
+    def setUp(self):
+        from gioland import bench
+        self.bench = bench
+        self.tmp = path(tempfile.mkdtemp())
+        self.addCleanup(self.tmp.rmtree)
+
+    def report(self, **medians):
+        return {'options': {}, 'results': {
+            name: {'median': median, 'mad': 0.001}
+            for name, median in medians.items()}}
+
+    def test_runs_are_found_by_machine_and_revision(self):
+        store = self.tmp / 'results.jsonl'
+        self.bench.store_run(store, self.report(search=1), 'aaa111', 'm1')
+        self.bench.store_run(store, self.report(search=2), 'bbb222', 'm2')
+        self.bench.store_run(store, self.report(search=3), 'ccc333', 'm1')
+        runs = self.bench.load_runs(store)
+        self.assertEqual(len(runs), 3)
+
+        latest = self.bench.find_run(runs, 'm1', exclude_revision='ddd444')
+        self.assertEqual(latest['revision'], 'ccc333')
+        other = self.bench.find_run(runs, 'm1', exclude_revision='ccc333')
+        self.assertEqual(other['revision'], 'aaa111')
+        self.assertEqual(self.bench.find_run(runs, 'm2', 'bbb')['revision'],
+                         'bbb222')
+        self.assertIsNone(self.bench.find_run(runs, 'm2', 'aaa'))
+
+    def test_option_differences(self):
+        base = dict(self.report(search=1), options={'chains': 50,
+                                                    'seed': 1})
+        new = dict(self.report(search=1), options={'chains': 10,
+                                                   'seed': 1, 'repeat': 3})
+        self.assertEqual(self.bench.option_differences(base, new),
+                         ['chains', 'repeat'])
+        self.assertEqual(self.bench.option_differences(base, base), [])
+
+    def test_changes_within_noise_or_tolerance_are_ok(self):
+        base = self.report(search=0.100, lot=0.100, fsck=0.100, chain=0.010)
+        new = self.report(search=0.150, lot=0.105, fsck=0.050, chain=0.014)
+        rows = self.bench.compare(base, new, tolerance=0.1, noise=3)
+        status = {row[0]: row[-1] for row in rows}
+        self.assertEqual(status, {
+            'search': 'regression',
+            'lot': 'ok',
+            'fsck': 'improvement',
+            'chain': 'ok',
+        })
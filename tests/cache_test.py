@@ -0,0 +1,347 @@
+import cPickle as pickle
+import os
+import tempfile
+import time
+import unittest
+
+from mock import patch
+from path import path
+
+
+def setUpModule(self):
+    from gioland import cache
+    self.cache = cache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_item_is_evicted(self):
+        lru = cache.LRUCache(threshold=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('c'), 3)
+
+    def test_size_limit(self):
+        lru = cache.LRUCache(threshold=100, max_bytes=250)
+        for n in range(5):
+            lru.set(n, 'x' * 100)
+        self.assertEqual([lru.get(n) is not None for n in range(5)],
+                         [False, False, False, True, True])
+
+    def test_expired_items_are_misses(self):
+        lru = cache.LRUCache()
+        lru.set('a', 1, timeout=10)
+        with patch('gioland.cache.time', lambda: time.time() + 20):
+            self.assertIsNone(lru.get('a'))
+        self.assertEqual(lru._size, 0)
+
+
+class FileSystemLRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = path(tempfile.mkdtemp())
+        self.addCleanup(self.tmp.rmtree)
+
+    def test_cache_is_shared_between_instances(self):
+        cache1 = cache.FileSystemLRUCache(self.tmp)
+        cache2 = cache.FileSystemLRUCache(self.tmp)
+        cache1.set('a', u"Joe")
+        self.assertEqual(cache2.get('a'), u"Joe")
+
+    def test_least_recently_used_file_is_evicted(self):
+        fs_cache = cache.FileSystemLRUCache(self.tmp, threshold=2)
+        fs_cache.set('a', 1)
+        fs_cache.set('b', 2)
+        past = time.time() - 100
+        os.utime(fs_cache._get_filename('a'), (past, past - 10))
+        os.utime(fs_cache._get_filename('b'), (past, past))
+        fs_cache.get('a')
+        fs_cache.set('c', 3)
+        self.assertEqual(fs_cache.get('a'), 1)
+        self.assertIsNone(fs_cache.get('b'))
+        self.assertEqual(fs_cache.get('c'), 3)
+
+    def test_folder_is_only_scanned_when_needed(self):
+        fs_cache = cache.FileSystemLRUCache(self.tmp, threshold=3)
+        with patch.object(fs_cache, '_list_dir',
+                          wraps=fs_cache._list_dir) as list_dir:
+            fs_cache.set('a', 1)
+            fs_cache.set('b', 2)
+            fs_cache.set('c', 3)
+            self.assertEqual(list_dir.call_count, 1)
+            fs_cache.set('d', 4)
+            self.assertEqual(list_dir.call_count, 2)
+        self.assertEqual(len(fs_cache._list_dir()), 3)
+
+    def test_files_of_other_processes_are_counted_on_rescan(self):
+        cache1 = cache.FileSystemLRUCache(self.tmp, threshold=5)
+        cache2 = cache.FileSystemLRUCache(self.tmp, threshold=10)
+        cache1.RESCAN_INTERVAL = 2
+        cache1.set('a', 1)
+        for key in 'bcdef':
+            cache2.set(key, 2)
+        cache1.set('g', 3)
+        self.assertEqual(len(cache1._list_dir()), 7)
+        cache1.set('h', 3)
+        self.assertEqual(len(cache1._list_dir()), 5)
+
+
+class FakeMemcacheClient(object):
+    """ Stand-in for `memcache.Client`, keeping pickled items in a dict. """
+
+    def __init__(self, servers):
+        self.servers = servers
+        self.items = {}
+
+    def get(self, key):
+        data = self.items.get(key)
+        return None if data is None else pickle.loads(data)
+
+    def get_multi(self, keys):
+        return {key: self.get(key) for key in keys if key in self.items}
+
+    def set(self, key, value, time=0):
+        self.items[key] = pickle.dumps(value)
+        return True
+
+    def add(self, key, value, time=0):
+        if key not in self.items:
+            self.set(key, value, time)
+
+    def delete(self, key):
+        self.items.pop(key, None)
+
+
+class FakeRedis(object):
+    """ Stand-in for `redis.Redis`, keeping string values in a dict. """
+
+    def __init__(self, host, port, password=None):
+        self.address = (host, port)
+        self.items = {}
+        self.timeouts = {}
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def mget(self, keys):
+        return [self.items.get(key) for key in keys]
+
+    def setex(self, key, value, time):
+        assert isinstance(value, str)
+        self.items[key] = value
+        self.timeouts[key] = time
+
+    def delete(self, *keys):
+        for key in keys:
+            self.items.pop(key, None)
+
+
+class NetworkBackendsTest(unittest.TestCase):
+
+    config = {
+        'CACHING': True,
+        'CACHE_THRESHOLD': 10,
+        'CACHE_MAX_BYTES': 1000,
+    }
+
+    def create_cache(self, cache_type, servers, **modules):
+        import sys
+        import types
+        fake_modules = {'pylibmc': None, 'google.appengine': None,
+                        'google.appengine.api': None}
+        for name, attrs in modules.items():
+            module = fake_modules[name] = types.ModuleType(name)
+            module.__dict__.update(attrs)
+        config = dict(self.config, CACHE_TYPE=cache_type,
+                      CACHE_SERVERS=servers)
+        with patch.dict(sys.modules, fake_modules):
+            return cache.create_cache(config)
+
+    def check_cached_decorator(self, backend):
+        import flask
+        from gioland.utils import cached
+        app = flask.Flask(__name__)
+        app.extensions['gioland-cache'] = backend
+        calls = []
+
+        @cached(timeout=60)
+        def full_name(user_id):
+            calls.append(user_id)
+            return u"Jo\xeb"
+
+        with app.app_context():
+            self.assertEqual(full_name('joe'), u"Jo\xeb")
+            self.assertEqual(full_name('joe'), u"Jo\xeb")
+            self.assertEqual(full_name.lookup_many([('joe',), ('ann',)]),
+                             {('joe',): u"Jo\xeb"})
+        self.assertEqual(calls, ['joe'])
+
+    def test_memcached(self):
+        backend = self.create_cache('memcached', ['localhost:11211'],
+                                    memcache={'Client': FakeMemcacheClient})
+        self.assertEqual(backend._client.servers, ['localhost:11211'])
+        self.check_cached_decorator(backend)
+        self.assertTrue(all(key.startswith('gioland:')
+                            for key in backend._client.items))
+
+    def test_redis(self):
+        backend = self.create_cache('redis', ['localhost:6380'],
+                                    redis={'Redis': FakeRedis})
+        self.assertEqual(backend._client.address, ('localhost', 6380))
+        self.check_cached_decorator(backend)
+        [(key, timeout)] = backend._client.timeouts.items()
+        self.assertTrue(key.startswith('gioland:'))
+        self.assertEqual(timeout, 60)
+
+
+class CreateCacheTest(unittest.TestCase):
+
+    config = {
+        'CACHING': True,
+        'CACHE_TYPE': 'simple',
+        'CACHE_THRESHOLD': 10,
+        'CACHE_MAX_BYTES': 1000,
+    }
+
+    def test_caching_off(self):
+        from werkzeug.contrib.cache import NullCache
+        config = dict(self.config, CACHING=False)
+        self.assertIsInstance(cache.create_cache(config), NullCache)
+
+    def test_simple(self):
+        self.assertIsInstance(cache.create_cache(self.config),
+                              cache.LRUCache)
+
+    def test_filesystem_defaults_to_warehouse_folder(self):
+        tmp = path(tempfile.mkdtemp())
+        self.addCleanup(tmp.rmtree)
+        config = dict(self.config, CACHE_TYPE='filesystem',
+                      WAREHOUSE_PATH=tmp)
+        fs_cache = cache.create_cache(config)
+        self.assertIsInstance(fs_cache, cache.FileSystemLRUCache)
+        self.assertEqual(fs_cache._path, tmp / 'cache')
+
+    def test_unknown_type(self):
+        config = dict(self.config, CACHE_TYPE='nosuch')
+        self.assertRaises(ValueError, cache.create_cache, config)
+
+
+class CachedDecoratorTest(unittest.TestCase):
+
+    def setUp(self):
+        import flask
+        self.app = flask.Flask(__name__)
+        self.app.extensions['gioland-cache'] = cache.LRUCache()
+        self.calls = []
+
+    def make_cached(self, result=u"Joe", delay=0, **kwargs):
+        from gioland.utils import cached
+
+        @cached(timeout=60, **kwargs)
+        def full_name(user_id):
+            self.calls.append(user_id)
+            time.sleep(delay)
+            return result
+
+        return full_name
+
+    def test_result_is_cached(self):
+        full_name = self.make_cached()
+        with self.app.app_context():
+            self.assertEqual(full_name('joe'), u"Joe")
+            self.assertEqual(full_name('joe'), u"Joe")
+        self.assertEqual(self.calls, ['joe'])
+
+    def test_none_is_cached_with_negative_timeout(self):
+        full_name = self.make_cached(result=None, negative_timeout=10)
+        with self.app.app_context():
+            self.assertIsNone(full_name('joe'))
+            self.assertIsNone(full_name('joe'))
+            self.assertEqual(len(self.calls), 1)
+            later = time.time() + 11
+            with patch('gioland.utils.time.time', lambda: later), \
+                    patch('gioland.cache.time', lambda: later):
+                full_name('joe')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_concurrent_misses_compute_once(self):
+        import threading
+        full_name = self.make_cached(delay=0.1)
+        results = []
+
+        def call():
+            with self.app.app_context():
+                results.append(full_name('joe'))
+
+        threads = [threading.Thread(target=call) for n in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [u"Joe"] * 5)
+        self.assertEqual(self.calls, ['joe'])
+
+    def test_concurrent_misses_share_a_failure(self):
+        import threading
+        from gioland.utils import cached
+        errors = []
+
+        @cached(timeout=60)
+        def full_name(user_id):
+            self.calls.append(user_id)
+            time.sleep(0.1)
+            raise IOError("LDAP is down")
+
+        def call():
+            with self.app.app_context():
+                try:
+                    full_name('joe')
+                except IOError as e:
+                    errors.append(str(e))
+
+        threads = [threading.Thread(target=call) for n in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, ["LDAP is down"] * 5)
+        self.assertEqual(self.calls, ['joe'])
+
+    def test_waiting_for_a_slow_computation_times_out(self):
+        import threading
+        full_name = self.make_cached(delay=0.3)
+        errors = []
+
+        def call():
+            with self.app.app_context():
+                try:
+                    full_name('joe')
+                except RuntimeError as e:
+                    errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        time.sleep(0.05)
+        with patch('gioland.utils.FLIGHT_TIMEOUT', 0.01):
+            call()
+        leader.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.calls, ['joe'])
+
+    def test_stale_value_served_while_refreshing(self):
+        full_name = self.make_cached(stale=60)
+        with self.app.app_context():
+            full_name.prime(('joe',), u"Old Joe")
+            later = time.time() + 61
+            with patch('gioland.utils.time.time', lambda: later):
+                self.assertEqual(full_name('joe'), u"Old Joe")
+            for n in range(100):
+                if full_name.lookup_many([('joe',)]) == {('joe',): u"Joe"}:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(full_name('joe'), u"Joe")
+        self.assertEqual(self.calls, ['joe'])
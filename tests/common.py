@@ -58,6 +58,58 @@ def record_events(signal):
         signal.disconnect(_record)
 
 
+@contextmanager
+def uns_stand_in(fail=False, multicall=True, keep_alive=False):
+    """ Local XML-RPC server standing in for UNS. Yields an object with its
+    `url`, the `calls` to `sendNotification`, the HTTP `requests` and the
+    TCP `connections`. """
+    import threading
+    from SimpleXMLRPCServer import SimpleXMLRPCServer
+    from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+
+    class RequestHandler(SimpleXMLRPCRequestHandler):
+
+        if keep_alive:
+            protocol_version = 'HTTP/1.1'
+            timeout = 1
+
+    class StandIn(SimpleXMLRPCServer):
+
+        calls = []
+        requests = []
+        connections = []
+
+        def process_request(self, request, client_address):
+            self.connections.append(client_address)
+            SimpleXMLRPCServer.process_request(self, request, client_address)
+
+        def _marshaled_dispatch(self, data, *args, **kwargs):
+            self.requests.append(data)
+            return SimpleXMLRPCServer._marshaled_dispatch(self, data,
+                                                          *args, **kwargs)
+
+    def send_notification(channel_id, rdf_triples):
+        if fail:
+            raise RuntimeError("UNS is down")
+        server.calls.append((channel_id, rdf_triples))
+        return 'ok'
+
+    server = StandIn(('127.0.0.1', 0), requestHandler=RequestHandler,
+                     logRequests=False)
+    server.url = 'http://127.0.0.1:%d/RPC2' % server.server_address[1]
+    server.register_function(send_notification, 'UNSService.sendNotification')
+    if multicall:
+        server.register_multicall_functions()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 def select(container, selector):
     """ Select elements using CSS """
     import lxml.cssselect, lxml.html
@@ -101,7 +153,13 @@ class AppTestCase(unittest.TestCase):
     })
 
     def add_to_role(self, username, role_name):
-        self.app.config.setdefault(role_name, []).append('user_id:' + username)
+        principals = self.app.config.get(role_name, [])
+        self.set_role(role_name, principals + ['user_id:' + username])
+
+    def set_role(self, role_name, principals):
+        from gioland import auth
+        self.app.config[role_name] = principals
+        auth.reload_roles(self.app)
 
     def new_parcel(self, delivery_type=COUNTRY, **extra_metadata):
         if delivery_type == COUNTRY:
@@ -0,0 +1,82 @@
+import unittest
+
+import ldap
+from mock import Mock, patch
+
+
+def setUpModule(self):
+    from gioland import ldappool
+    self.ldappool = ldappool
+
+
+class LdapPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+
+        def connect():
+            conn = Mock()
+            self.connections.append(conn)
+            return conn
+
+        self.pool = ldappool.LdapPool(connect, size=2, idle_timeout=300)
+
+    def test_connection_is_reused(self):
+        self.pool.run(lambda conn: conn.search_s('a'))
+        self.pool.run(lambda conn: conn.search_s('b'))
+        self.assertEqual(len(self.connections), 1)
+
+    def test_result_is_returned(self):
+        self.assertEqual(self.pool.run(lambda conn: 13), 13)
+
+    def test_reconnect_on_server_down(self):
+        calls = []
+
+        def search(conn):
+            calls.append(conn)
+            if len(calls) == 1:
+                raise ldap.SERVER_DOWN()
+            return 'ok'
+
+        self.assertEqual(self.pool.run(search), 'ok')
+        self.assertEqual(len(self.connections), 2)
+        self.assertIsNot(calls[0], calls[1])
+        self.pool.run(lambda conn: None)
+        self.assertEqual(len(self.connections), 2)
+
+    def test_server_down_twice_is_raised(self):
+        def search(conn):
+            raise ldap.SERVER_DOWN()
+
+        self.assertRaises(ldap.SERVER_DOWN, self.pool.run, search)
+        self.assertEqual(self.pool._in_use, 0)
+
+    def test_other_errors_keep_connection(self):
+        def search(conn):
+            raise ldap.NO_SUCH_OBJECT()
+
+        self.assertRaises(ldap.NO_SUCH_OBJECT, self.pool.run, search)
+        self.pool.run(lambda conn: None)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_idle_connections_expire(self):
+        self.pool.run(lambda conn: None)
+        with patch('time.time', Mock(return_value=10 ** 10)):
+            self.pool.run(lambda conn: None)
+        self.assertEqual(len(self.connections), 2)
+        self.assertEqual(self.connections[0].unbind_s.call_count, 1)
+
+    def test_restore_identity_rebinds_anonymously(self):
+        self.pool.run(lambda conn: conn.simple_bind_s('uid=x', 'pw'),
+                      restore_identity=True)
+        [conn] = self.connections
+        self.assertEqual(conn.simple_bind_s.call_args[0], ('', ''))
+
+    def test_pool_is_bounded(self):
+        def nested(conn):
+            return self.pool.run(lambda conn2: self.pool.run(lambda c: 1))
+
+        with patch('gioland.ldappool.WAIT_TIMEOUT', 0.01):
+            self.assertRaises(RuntimeError, self.pool.run, nested)
+        self.assertEqual(len(self.connections), 2)
+        self.assertEqual(self.pool._in_use, 0)
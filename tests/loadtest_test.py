@@ -0,0 +1,57 @@
+import threading
+
+from werkzeug.serving import make_server
+
+from common import AppTestCase
+
+
+class LoadTestTest(AppTestCase):
+
+    CREATE_WAREHOUSE = True
+
+    def setUp(self):
+        from gioland import loadtest
+        self.loadtest = loadtest
+        self.add_to_role('somebody', 'ROLE_ADMIN')
+        server = make_server('127.0.0.1', 0, self.app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % server.server_address[1]
+        self.cookie = loadtest.session_cookie(self.app, 'somebody')
+
+    def test_concurrent_uploads_and_downloads(self):
+        report = self.loadtest.run(self.url, self.cookie, uploaders=3,
+                                   downloaders=2, files=2, file_size=10000,
+                                   chunk_size=3000)
+        self.assertEqual(report['first_errors'], [])
+        self.assertEqual(report['uploads']['files'], 6)
+        self.assertEqual(report['uploads']['bytes'], 60000)
+        self.assertEqual(report['uploads']['chunk_latency']['n'], 24)
+        self.assertGreater(report['downloads']['files'], 0)
+        self.assertEqual(report['downloads']['bytes'],
+                         report['downloads']['files'] * 10000)
+        self.assertGreater(report['lock_hold_seconds'], 0)
+
+        with self.app.test_request_context():
+            uploaded = [f for p in self.wh.get_all_parcels()
+                        for f in p.get_files() if f.name.startswith('load_')]
+        self.assertEqual(sorted(f.size for f in uploaded), [10000] * 6)
+
+    def test_failed_uploads_are_reported(self):
+        client = self.loadtest.Client(self.url, self.cookie)
+        name = self.loadtest.create_parcel(client)
+        self.set_role('ROLE_ADMIN', [])
+        stats = self.loadtest.Stats()
+        self.assertFalse(self.loadtest.upload_file(client, name, 'a.bin',
+                                                   100, 30, stats))
+        self.assertEqual(stats.errors, ["Chunk 1 of a.bin returned 403"])
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(self.loadtest.percentile(values, .5), 50)
+        self.assertEqual(self.loadtest.percentile(values, .99), 99)
+        self.assertEqual(self.loadtest.percentile([3], .99), 3)
+        self.assertIsNone(self.loadtest.percentile([], .5))
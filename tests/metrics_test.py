@@ -0,0 +1,109 @@
+import unittest
+
+from StringIO import StringIO
+from common import AppTestCase, authorization_patch
+
+
+def setUpModule(self):
+    from gioland import metrics
+    self.metrics = metrics
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_latency_is_counted_in_bucket(self):
+        registry = metrics.Registry()
+        registry.observe('parcel.view', 0.02, {'zodb_loads': 3})
+        registry.observe('parcel.view', 100, {'zodb_loads': 1})
+        stats = registry.snapshot()['parcel.view']
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['buckets'][2], 1)
+        self.assertEqual(stats['buckets'][-1], 1)
+        self.assertEqual(stats['counters']['zodb_loads'], 4)
+        self.assertEqual(stats['counters']['ldap_calls'], 0)
+
+    def test_count_outside_request_is_ignored(self):
+        metrics.count('zodb_loads')
+
+
+class InstrumentationTest(AppTestCase):
+
+    CREATE_WAREHOUSE = True
+
+    def setUp(self):
+        self.addCleanup(authorization_patch().stop)
+
+    def stats(self, endpoint):
+        return metrics.get_registry(self.app).snapshot()[endpoint]
+
+    def test_requests_are_timed_per_endpoint(self):
+        name = self.new_parcel()
+        # the test client leaves closing the response to us, as a WSGI
+        # server would
+        self.client.get('/parcel/%s' % name).close()
+        self.client.get('/parcel/%s' % name).close()
+        stats = self.stats('parcel.view')
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(sum(stats['buckets']), 2)
+
+    def test_zodb_stores_are_counted(self):
+        self.client.post('/parcel/new/country',
+                         data=self.PARCEL_METADATA).close()
+        stats = self.stats('parcel.country_delivery')
+        self.assertGreater(stats['counters']['zodb_stores'], 0)
+
+    def test_lock_and_file_bytes_are_counted(self):
+        name = self.new_parcel()
+        self.client.post('/parcel/%s/file' % name,
+                         data={'file': (StringIO('teh map data'), 'a.gml')}
+                         ).close()
+        stats = self.stats('parcel.upload_single_file')
+        self.assertEqual(stats['counters']['file_write_bytes'], 12)
+        self.assertGreater(stats['counters']['lock_hold_seconds'], 0)
+
+        resp = self.client.get('/parcel/%s/download/a.gml' % name)
+        self.assertEqual(resp.data, 'teh map data')
+        resp.close()
+        stats = self.stats('parcel.download')
+        self.assertEqual(stats['counters']['file_read_bytes'], 12)
+
+
+class MetricsEndpointTest(AppTestCase):
+
+    CREATE_WAREHOUSE = True
+
+    def setUp(self):
+        self.addCleanup(authorization_patch().stop)
+
+    def test_prometheus_format(self):
+        self.client.get('/ping').close()
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('gioland_request_duration_seconds_bucket'
+                      '{endpoint="ping",le="+Inf"} 1\n', resp.data)
+        self.assertIn('gioland_request_duration_seconds_count'
+                      '{endpoint="ping"} 1\n', resp.data)
+        self.assertIn('gioland_zodb_loads_total{endpoint="ping"} ', resp.data)
+        self.assertIn('gioland_zodb_cache_objects{pid="', resp.data)
+
+    def test_processes_are_added_up(self):
+        import json
+        import os
+        metrics_dir = self.tmp / 'metrics'
+        metrics_dir.makedirs()
+        self.app.extensions['gioland-metrics-collector'] = \
+            metrics.FileCollector(metrics_dir)
+        other = metrics.Registry()
+        other.observe('ping', 0.001, {'ldap_calls': 2})
+        with open(metrics_dir / '1.json', 'wb') as f:
+            json.dump({'pid': 1, 'endpoints': other.snapshot(),
+                       'gauges': {}}, f)
+
+        self.client.get('/ping').close()
+        resp = self.client.get('/metrics')
+        self.assertIn('gioland_request_duration_seconds_count'
+                      '{endpoint="ping"} 2\n', resp.data)
+        self.assertIn('gioland_ldap_calls_total{endpoint="ping"} 2\n',
+                      resp.data)
+        self.assertTrue(os.path.exists(metrics_dir /
+                                       ('%d.json' % os.getpid())))
@@ -1,7 +1,9 @@
 from contextlib import contextmanager
 from datetime import datetime
+import transaction
 
 from common import AppTestCase, record_events, authorization_patch
+from common import uns_stand_in
 from dateutil import tz
 from mock import Mock, patch, call
 
@@ -42,6 +44,25 @@ class NotificationDeliveryTest(AppTestCase):
 
         self.assertEqual(len(events), 1)
 
+    def test_batch_looks_up_actor_names_together(self):
+        from gioland.definitions import RDF_URI
+        parcel = self.item.parcel
+        parcel.add_history_item("Again", self.utcnow, 'other', "descr")
+        with patch('gioland.auth.LdapConnection') as LdapConnection:
+            ldap_conn = LdapConnection.return_value
+            ldap_conn.get_user_names.return_value = {
+                'somewho': u"Some Who", 'other': u"Other One"}
+            with record_events(notification.uns_notification_sent) as events:
+                with self.app.test_request_context():
+                    with notification.batch():
+                        for item in parcel.history:
+                            notification.notify(item, 'comment')
+        self.assertEqual(ldap_conn.mock_calls,
+                         [call.get_user_names(['other', 'somewho'])])
+        names = [dict((p, o) for s, p, o in extra['rdf_triples'])
+                 [RDF_URI['actor_name']] for sender, extra in events]
+        self.assertEqual(names, [u"Some Who", u"Other One"])
+
     def test_notification_rdf(self):
         from gioland.definitions import RDF_URI
 
@@ -70,6 +91,22 @@ class NotificationDeliveryTest(AppTestCase):
             RDF_URI['event_type']: "comment",
         }, rdf_data)
 
+    def test_notification_rdf_leaves_out_excluded_metadata(self):
+        from gioland.definitions import LOT, LOT_EXCLUDE_METADATA, RDF_URI
+        from gioland.definitions import UNS_FIELD_DEFS
+        self.item.parcel.metadata['delivery_type'] = LOT
+        self.item.parcel.metadata['extent'] = 'full'
+
+        with self.app.test_request_context():
+            rdf_triples = notification.prepare_notification_rdf(self.item,
+                                                                'comment')
+
+        predicates = set(p for s, p, o in rdf_triples)
+        for field in UNS_FIELD_DEFS:
+            if field['name'] in LOT_EXCLUDE_METADATA:
+                self.assertNotIn(field['rdf_uri'], predicates)
+        self.assertIn(RDF_URI['product'], predicates)
+
     @contextmanager
     def record_uns_calls(self):
         with patch('gioland.notification.get_uns_proxy') as mock_get_uns_proxy:
@@ -100,6 +137,57 @@ class NotificationDeliveryTest(AppTestCase):
                 self.app.config['TESTING'] = True
         self.assertEqual(len(uns_calls), 1)
 
+    def test_uns_connection_is_reused(self):
+        with uns_stand_in(keep_alive=True) as uns:
+            self.app.config['UNS_URL'] = uns.url
+            self.app.config['TESTING'] = False
+            try:
+                with self.app.test_request_context():
+                    notification.notify(self.item, 'comment')
+                with self.app.test_request_context():
+                    notification.notify(self.item, 'comment')
+            finally:
+                self.app.config['TESTING'] = True
+        self.assertEqual(len(uns.calls), 2)
+        self.assertEqual(len(uns.connections), 1)
+
+    def test_uns_transports_apply_the_timeout(self):
+        for transport_class in [notification.KeepAliveTransport,
+                                notification.SafeKeepAliveTransport]:
+            transport = transport_class(7)
+            conn = transport.make_connection('uns.example.com')
+            self.assertEqual(conn.timeout, 7)
+
+    def send_batch(self, uns, count):
+        self.app.config['UNS_URL'] = uns.url
+        self.app.config['TESTING'] = False
+        try:
+            with self.app.test_request_context():
+                with notification.batch():
+                    for n in range(count):
+                        notification.notify(self.item, 'comment')
+        finally:
+            self.app.config['TESTING'] = True
+
+    def test_batch_is_sent_in_one_request(self):
+        with uns_stand_in() as uns:
+            self.send_batch(uns, 3)
+        self.assertEqual(len(uns.calls), 3)
+        self.assertEqual(len(uns.requests), 1)
+
+    @patch('gioland.notification._multicall_supported', {})
+    def test_batch_without_multicall_is_sent_one_by_one(self):
+        with uns_stand_in(multicall=False) as uns:
+            self.send_batch(uns, 3)
+            self.send_batch(uns, 2)
+        self.assertEqual(len(uns.calls), 5)
+        # one failed multicall, then no more attempts
+        self.assertEqual(len(uns.requests), 6)
+
+    def test_batch_failure_is_raised(self):
+        with uns_stand_in(fail=True) as uns:
+            self.assertRaises(Exception, self.send_batch, uns, 2)
+
 
 def rdfdata(event):
     (sender, extra) = event
@@ -211,3 +299,110 @@ class NotificationSubscriptionTest(AppTestCase):
         }]
         self.assertEqual(mock_proxy.return_value.makeSubscription.mock_calls,
                          [call(self.channel_id, 'somebody', ok_filters)])
+
+    @patch('gioland.notification.get_uns_proxy')
+    def test_can_subscribe_is_cached(self, mock_proxy):
+        from gioland.cache import LRUCache
+        self.app.extensions['gioland-cache'] = LRUCache()
+        mock_proxy.return_value.canSubscribe.return_value = True
+        with self.app.test_request_context():
+            self.assertTrue(notification.can_subscribe('somebody'))
+            self.assertTrue(notification.can_subscribe('somebody'))
+        self.assertEqual(mock_proxy.return_value.canSubscribe.mock_calls,
+                         [call(self.channel_id, 'somebody')])
+
+
+class NotificationOutboxTest(AppTestCase):
+
+    CREATE_WAREHOUSE = True
+
+    def setUp(self):
+        self.addCleanup(authorization_patch().stop)
+        self.app.config['UNS_OUTBOX'] = True
+
+    def finalize_new_parcel(self):
+        resp = self.client.post('/parcel/new/country',
+                                data=self.PARCEL_METADATA)
+        parcel_name = resp.location.rsplit('/', 1)[-1]
+        self.app.config['TESTING'] = False
+        try:
+            resp = self.client.post('/parcel/%s/finalize' % parcel_name)
+        finally:
+            self.app.config['TESTING'] = True
+        self.assertEqual(resp.status_code, 302)
+
+    def deliver(self):
+        with self.app.test_request_context():
+            return notification.deliver_outbox(self.wh)
+
+    def test_notification_is_queued_with_the_transaction(self):
+        with patch('gioland.notification.get_uns_proxy') as mock_proxy:
+            self.finalize_new_parcel()
+        self.assertEqual(mock_proxy.mock_calls, [])
+        with self.app.test_request_context():
+            [message] = self.wh.outbox.pending.values()
+            self.assertEqual(message.attempts, 0)
+
+    def test_queued_notification_is_delivered(self):
+        self.finalize_new_parcel()
+        with uns_stand_in() as uns:
+            self.app.config['UNS_URL'] = uns.url
+            self.assertEqual(self.deliver(), 1)
+            self.assertEqual(self.deliver(), 0)
+        self.assertEqual(len(uns.calls), 1)
+        with self.app.test_request_context():
+            self.assertEqual(len(self.wh.outbox.pending), 0)
+
+    def test_queued_notifications_are_delivered_together(self):
+        self.finalize_new_parcel()
+        self.finalize_new_parcel()
+        with uns_stand_in() as uns:
+            self.app.config['UNS_URL'] = uns.url
+            self.assertEqual(self.deliver(), 2)
+        self.assertEqual(len(uns.calls), 2)
+        self.assertEqual(len(uns.requests), 1)
+
+    def test_failed_delivery_is_retried_later(self):
+        self.finalize_new_parcel()
+        with uns_stand_in(fail=True) as uns:
+            self.app.config['UNS_URL'] = uns.url
+            self.deliver()
+            self.assertEqual(self.deliver(), 0)
+        with self.app.test_request_context():
+            [message] = self.wh.outbox.pending.values()
+            self.assertEqual(message.attempts, 1)
+            self.assertIn("UNS is down", message.last_error)
+            self.assertGreater(message.next_attempt, datetime.utcnow())
+
+    def test_notification_given_up_after_max_attempts(self):
+        self.finalize_new_parcel()
+        with uns_stand_in(fail=True) as uns:
+            self.app.config['UNS_URL'] = uns.url
+            for n in range(notification.OUTBOX_MAX_ATTEMPTS):
+                with self.app.test_request_context():
+                    for message in self.wh.outbox.pending.values():
+                        message.next_attempt = datetime.utcnow()
+                self.deliver()
+        with self.app.test_request_context():
+            self.assertEqual(len(self.wh.outbox.pending), 0)
+            [message] = self.wh.outbox.dead.values()
+            key = message.key
+
+        self.add_to_role('somebody', 'ROLE_ADMIN')
+        resp = self.client.get('/notifications/outbox')
+        self.assertIn(key, resp.data)
+        self.client.post('/notifications/outbox', data={'revive': key})
+        with self.app.test_request_context():
+            self.assertEqual(list(self.wh.outbox.pending), [key])
+
+    def test_old_databases_are_read_without_writing(self):
+        with self.app.test_request_context():
+            del self.wh._outbox
+            transaction.commit()
+            self.assertEqual(notification.deliver_outbox(self.wh), 0)
+            self.assertFalse(self.wh._p_changed)
+        self.add_to_role('somebody', 'ROLE_ADMIN')
+        resp = self.client.get('/notifications/outbox')
+        self.assertEqual(resp.status_code, 200)
+        with self.app.test_request_context():
+            self.assertIsNone(getattr(self.wh, '_outbox', None))
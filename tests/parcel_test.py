@@ -575,3 +575,84 @@ class ApiTest(AppTestCase):
             wh = warehouse.get_warehouse()
             parcel = wh.get_parcel(name)
             self.assertEqual(resp['metadata'], parcel.metadata)
+
+    def test_find_parcels_is_paginated_in_name_order(self):
+        names = sorted(self.new_parcel() for i in range(5))
+        resp = self.get_json('/api/find_parcels?limit=2')
+        self.assertEqual(resp, {'parcels': names[:2], 'next': names[1]})
+        resp = self.get_json('/api/find_parcels?limit=2&after=' + names[1])
+        self.assertEqual(resp, {'parcels': names[2:4], 'next': names[3]})
+        resp = self.get_json('/api/find_parcels?limit=2&after=' + names[3])
+        self.assertEqual(resp, {'parcels': names[4:], 'next': None})
+
+    def test_find_parcels_page_applies_filters(self):
+        self.new_parcel()
+        name = self.new_parcel(country='dk')
+        self.new_parcel()
+        resp = self.get_json('/api/find_parcels?country=dk&limit=1')
+        self.assertEqual(resp, {'parcels': [name], 'next': None})
+
+    def test_find_parcels_rejects_bad_limit(self):
+        for limit in ['0', 'x', '100000']:
+            resp = self.client.get('/api/find_parcels?limit=' + limit)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_find_parcels_includes_selected_fields(self):
+        name = self.new_parcel(country='dk')
+        resp = self.get_json('/api/find_parcels?fields=country,stage,nope')
+        self.assertEqual(resp['parcels'], [{
+            'name': name,
+            'metadata': {'country': 'dk', 'stage': 'c-int'},
+        }])
+        resp = self.get_json('/api/find_parcels?fields=country&limit=5')
+        self.assertEqual(resp['parcels'], [{
+            'name': name,
+            'metadata': {'country': 'dk'},
+        }])
+
+    def test_find_parcels_streams_all_parcels(self):
+        names = sorted(self.new_parcel() for i in range(5))
+        with patch('gioland.parcel.STREAM_CACHE_GC_INTERVAL', 2):
+            resp = self.client.get('/api/find_parcels')
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(flask.json.loads(resp.data), {'parcels': names})
+
+    def post_json(self, url, data):
+        return self.client.post(url, data=flask.json.dumps(data),
+                                content_type='application/json')
+
+    def test_bulk_parcel_metadata(self):
+        from gioland import warehouse
+        name1 = self.new_parcel()
+        name2 = self.new_parcel(country='dk')
+        resp = self.post_json('/api/parcels',
+                              {'names': [name2, name1, 'nothere', name2]})
+        self.assertEqual(resp.status_code, 200)
+        data = flask.json.loads(resp.data)
+        with self.app.test_request_context():
+            wh = warehouse.get_warehouse()
+            self.assertEqual(data['parcels'], {
+                name1: wh.get_parcel(name1).metadata,
+                name2: wh.get_parcel(name2).metadata,
+            })
+        self.assertEqual(data['missing'], ['nothere'])
+
+    def test_bulk_parcel_metadata_selected_fields(self):
+        name = self.new_parcel(country='dk')
+        resp = self.post_json('/api/parcels', {'names': [name],
+                                               'fields': ['country', 'nope']})
+        data = flask.json.loads(resp.data)
+        self.assertEqual(data['parcels'], {name: {'country': 'dk'}})
+
+    def test_bulk_parcel_metadata_rejects_bad_requests(self):
+        name = self.new_parcel()
+        for data in [{}, {'names': 'abc'}, {'names': [{}]},
+                     {'names': [], 'fields': 'country'},
+                     {'names': [name], 'fields': [{'a': 1}]}]:
+            resp = self.post_json('/api/parcels', data)
+            self.assertEqual(resp.status_code, 400)
+        resp = self.client.post('/api/parcels', data='names')
+        self.assertEqual(resp.status_code, 400)
+        with patch('gioland.parcel.BULK_METADATA_MAX_NAMES', 1):
+            resp = self.post_json('/api/parcels', {'names': ['a', 'b']})
+            self.assertEqual(resp.status_code, 400)
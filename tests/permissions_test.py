@@ -1,7 +1,11 @@
+import threading
+import time
+
 import flask
+import ldap
 from StringIO import StringIO
 from common import AppTestCase, record_events, select
-from mock import patch, call
+from mock import Mock, patch, call
 
 from gioland.definitions import COUNTRY, LOT, STREAM
 
@@ -20,8 +24,8 @@ class PermisionsTest(AppTestCase):
     def remove_from_role(self, username, role_name):
         if role_name in self.app.config:
             users = self.app.config[role_name]
-            self.app.config[role_name] = [u for u in users
-                                          if u != 'user_id:%s' % username]
+            self.set_role(role_name, [u for u in users
+                                      if u != 'user_id:%s' % username])
 
     def create_parcel(self, stage=None, delivery_type=LOT):
         with patch('gioland.auth.authorize'):
@@ -290,7 +294,7 @@ class PermisionsTest(AppTestCase):
         self.add_to_role('somebody', 'ROLE_SP')
         name = self.create_parcel()
         self.try_upload(name)
-        self.app.config["ROLE_SP"] = []
+        self.set_role('ROLE_SP', [])
         self.assertFalse(self.try_delete_file(name, 'y.txt'))
 
     def test_admin_user_allowed_to_delete_file_from_parcel(self):
@@ -314,14 +318,14 @@ class PermisionsTest(AppTestCase):
     def test_random_user_allowed_to_view_report(self):
         self.add_to_role('somebody', 'ROLE_SP')
         self.try_new_report()
-        self.app.config['ROLE_SP'] = []
+        self.set_role('ROLE_SP', [])
         resp = self.client.get('/lot/lot1')
         self.assertEqual(1, len(select(resp.data, '.report-list')))
 
     def test_random_user_not_allowed_to_delete_report(self):
         self.add_to_role('somebody', 'ROLE_SP')
         self.try_new_report()
-        self.app.config["ROLE_SP"] = []
+        self.set_role('ROLE_SP', [])
         resp = self.client.post('/report/1/delete')
         self.assertEqual(403, resp.status_code)
 
@@ -329,23 +333,44 @@ class PermisionsTest(AppTestCase):
 class RolesTest(AppTestCase):
 
     def setUp(self):
+        from gioland import auth
         self.app.config['LDAP_SERVER'] = 'ldap://some.ldap.server'
-        UsersDB_patch = patch('gioland.auth.UsersDB')
-        self.mock_UsersDB = UsersDB_patch.start()
-        self.addCleanup(UsersDB_patch.stop)
-
-    def test_users_db_connection(self):
+        self.get_users_db = auth.get_users_db
+        users_db_patch = patch('gioland.auth.get_users_db')
+        self.mock_udb = users_db_patch.start().return_value
+        self.addCleanup(users_db_patch.stop)
+
+    def test_users_db_is_built_once_per_app(self):
+        udb = self.get_users_db(self.app)
+        self.assertIs(self.get_users_db(self.app), udb)
+        self.assertIsNone(udb.conn)
+
+    def test_users_db_connection_is_per_thread(self):
+        udb = self.get_users_db(self.app)
+        udb.conn = 'pooled'
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(udb.conn))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [None])
+        self.assertEqual(udb.conn, 'pooled')
+
+    def test_groups_are_fetched_on_a_pooled_connection(self):
         from gioland import auth
-        mock_udb = self.mock_UsersDB.return_value
-        mock_udb.member_roles_info.return_value = []
-        with self.app.test_request_context():
-            auth.get_ldap_groups('somebody')
-        self.assertEqual(self.mock_UsersDB.mock_calls[0],
-                         call(ldap_server='some.ldap.server'))
+        conn = Mock()
+        seen = []
+        self.mock_udb.member_roles_info.side_effect = \
+            lambda *args: seen.append(self.mock_udb.conn) or []
+        with patch('gioland.auth.get_ldap_pool') as mock_get_pool:
+            mock_get_pool.return_value.run.side_effect = lambda f: f(conn)
+            with self.app.test_request_context():
+                auth.get_ldap_groups('somebody')
+        self.assertEqual(seen, [conn])
+        self.assertIsNone(self.mock_udb.conn)
 
     def test_role_list_fetched_from_ldap(self):
         from gioland import auth
-        mock_udb = self.mock_UsersDB.return_value
+        mock_udb = self.mock_udb
         mock_udb.member_roles_info.return_value = [
             ('eionet', None),
             ('eionet-nfp', None),
@@ -361,23 +386,123 @@ class RolesTest(AppTestCase):
 
     def test_authorize_looks_into_ldap_groups(self):
         from gioland import auth
-        mock_udb = self.mock_UsersDB.return_value
+        mock_udb = self.mock_udb
         mock_udb.member_roles_info.return_value = [('eionet-nrc', None)]
-        self.app.config['ROLE_NRC'] = ['ldap_group:eionet-nrc']
+        self.set_role('ROLE_NRC', ['ldap_group:eionet-nrc'])
 
         with self.app.test_request_context():
             flask.g.username = 'somebody'
             self.assertFalse(auth.authorize(['ROLE_ETC']))
             self.assertTrue(auth.authorize(['ROLE_NRC']))
 
-    def test_authorize_for_anonymous_returns_false(self):
+    def test_ldap_groups_fetched_once_per_request(self):
+        from gioland import auth
+        mock_udb = self.mock_udb
+        mock_udb.member_roles_info.return_value = [('eionet-nrc', None)]
+        self.set_role('ROLE_NRC', ['ldap_group:eionet-nrc'])
+        self.set_role('ROLE_ETC', ['ldap_group:eionet-etc'])
+
+        with self.app.test_request_context():
+            flask.g.username = 'somebody'
+            self.assertFalse(auth.authorize(['ROLE_ETC']))
+            self.assertTrue(auth.authorize(['ROLE_NRC']))
+            self.assertTrue(auth.authorize(['ROLE_ETC', 'ROLE_NRC']))
+        self.assertEqual(len(mock_udb.member_roles_info.mock_calls), 1)
+
+    def test_role_changes_in_config_are_picked_up(self):
+        from gioland import auth
+        with self.app.test_request_context():
+            flask.g.username = 'somebody'
+            self.assertFalse(auth.authorize(['ROLE_ETC']))
+        self.add_to_role('somebody', 'ROLE_ETC')
+        with self.app.test_request_context():
+            flask.g.username = 'somebody'
+            self.assertTrue(auth.authorize(['ROLE_ETC']))
+
+    def test_roles_are_compiled_once(self):
         from gioland import auth
         self.app.config['ROLE_ETC'] = ['user_id:somebody']
+        with self.app.test_request_context():
+            flask.g.username = 'somebody'
+            self.assertFalse(auth.authorize(['ROLE_ETC']))
+        auth.reload_roles(self.app)
+        with self.app.test_request_context():
+            flask.g.username = 'somebody'
+            self.assertTrue(auth.authorize(['ROLE_ETC']))
+
+    def test_group_refresher_updates_cache(self):
+        from gioland import auth
+        from werkzeug.contrib.cache import SimpleCache
+        self.app.extensions['gioland-cache'] = SimpleCache()
+        mock_udb = self.mock_udb
+        mock_udb.member_roles_info.return_value = [('eionet-nrc', None)]
+        refresher = auth.GroupRefresher(self.app, interval=60)
+        refresher._users['somebody'] = time.time()
+
+        refresher.refresh()
+        mock_udb.member_roles_info.return_value = []
+        with self.app.test_request_context():
+            self.assertEqual(auth.get_ldap_groups('somebody'), ['eionet-nrc'])
+
+    def test_authorize_for_anonymous_returns_false(self):
+        from gioland import auth
+        self.set_role('ROLE_ETC', ['user_id:somebody'])
         with self.app.test_request_context():
             self.app.preprocess_request()
             self.assertFalse(auth.authorize(['ROLE_ETC']))
 
 
+class LdapNamesTest(AppTestCase):
+
+    def setUp(self):
+        self.app.config['LDAP_SERVER'] = 'ldap://some.ldap.server'
+        self.app.config['LDAP_USER_DN_PATTERN'] = 'uid={user_id},ou=Users,o=EU'
+        self.conn = Mock()
+        pool_patch = patch('gioland.auth.get_ldap_pool')
+        mock_get_pool = pool_patch.start()
+        mock_get_pool.return_value.run.side_effect = lambda f, **kw: f(self.conn)
+        self.addCleanup(pool_patch.stop)
+
+    def test_prefetch_uses_one_search(self):
+        from gioland import auth
+        self.conn.search_s.return_value = [
+            ('uid=joe,ou=Users,o=EU', {'uid': ['joe'], 'cn': ['Joe Doe']}),
+            ('uid=ann,ou=Users,o=EU', {'uid': ['ann'], 'cn': ['Ann Smith']}),
+        ]
+        with self.app.test_request_context():
+            auth.prefetch_full_names(['joe', 'ann', 'joe', 'nobody'])
+            self.assertEqual(auth.ldap_full_name('joe'), u"Joe Doe")
+            self.assertEqual(auth.ldap_full_name('ann'), u"Ann Smith")
+            self.assertIsNone(auth.ldap_full_name('nobody'))
+
+        [search_call] = self.conn.search_s.mock_calls
+        self.assertEqual(search_call, call(
+            'ou=Users,o=EU', ldap.SCOPE_ONELEVEL,
+            '(|(uid=ann)(uid=joe)(uid=nobody))', ['uid', 'cn']))
+
+    def test_prefetch_skips_cached_names(self):
+        from gioland import auth
+        from werkzeug.contrib.cache import SimpleCache
+        self.app.extensions['gioland-cache'] = SimpleCache()
+        self.conn.search_s.return_value = [
+            ('uid=joe,ou=Users,o=EU', {'uid': ['joe'], 'cn': ['Joe Doe']}),
+        ]
+        with self.app.test_request_context():
+            auth.prefetch_full_names(['joe'])
+        with self.app.test_request_context():
+            auth.prefetch_full_names(['joe'])
+            self.assertEqual(auth.ldap_full_name('joe'), u"Joe Doe")
+        self.assertEqual(len(self.conn.search_s.mock_calls), 1)
+
+    def test_filter_values_are_escaped(self):
+        from gioland import auth
+        self.conn.search_s.return_value = []
+        with self.app.test_request_context():
+            auth.prefetch_full_names(['a*)(uid=b'])
+        self.assertEqual(self.conn.search_s.call_args[0][2],
+                         r'(|(uid=a\2a\29\28uid=b))')
+
+
 class RequireAdminTest(AppTestCase):
 
     def setUp(self):
@@ -394,7 +519,7 @@ class RequireAdminTest(AppTestCase):
         self.assertIn('/login', resp.location)
 
     def test_admin_required_decorator_allows_admin_user(self):
-        self.app.config.setdefault('ROLE_ADMIN', []).append('user_id:somebody')
+        self.add_to_role('somebody', 'ROLE_ADMIN')
         resp = self.client.get('/some_view')
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp.data, "inside")
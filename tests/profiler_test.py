@@ -0,0 +1,36 @@
+from common import AppTestCase
+from mock import patch
+
+
+class ProfilerTest(AppTestCase):
+
+    CREATE_WAREHOUSE = True
+
+    def test_profile_is_only_for_admins(self):
+        resp = self.client.get('/?_profile=inline')
+        self.assertNotIn('function calls', resp.data)
+
+    def test_inline_profile(self):
+        self.add_to_role('somebody', 'ROLE_ADMIN')
+        resp = self.client.get('/?_profile=inline')
+        self.assertEqual(resp.content_type, 'text/plain; charset=utf-8')
+        self.assertIn('function calls', resp.data)
+
+    def test_stored_profile(self):
+        self.add_to_role('somebody', 'ROLE_ADMIN')
+        resp = self.client.get('/', headers={'X-Profile': 'store'})
+        self.assertIn('<html>', resp.data)
+        url = resp.headers['X-Profile']
+        self.assertIn(url.rsplit('/', 1)[-1], self.client.get('/profiles').data)
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreater(len(resp.data), 0)
+
+    @patch('gioland.profiler.MAX_STORED_PROFILES', 2)
+    def test_only_latest_profiles_are_kept(self):
+        self.add_to_role('somebody', 'ROLE_ADMIN')
+        urls = [self.client.get('/', headers={'X-Profile': 'store'})
+                .headers['X-Profile'] for n in range(3)]
+        self.assertEqual(self.client.get(urls[0]).status_code, 404)
+        for url in urls[1:]:
+            self.assertEqual(self.client.get(url).status_code, 200)
@@ -0,0 +1,50 @@
+import time
+
+from common import AppTestCase
+
+
+def setUpModule(self):
+    from gioland import slowlog
+    self.slowlog = slowlog
+
+
+class SlowLogTest(AppTestCase):
+
+    CREATE_WAREHOUSE = True
+
+    def setUp(self):
+        # not installed by default in tests
+        watchdog = slowlog.Watchdog(0.05, 0.01,
+                                    self.wh_path / slowlog.SLOW_LOG_FILE_NAME)
+        self.app.extensions['gioland-slowlog'] = watchdog
+        self.app.before_request(slowlog._begin_request)
+        self.app.teardown_request(slowlog._end_request)
+
+        @self.app.route('/parcel/<string:name>/slow_test_view')
+        def slow_test_view(name):
+            time.sleep(0.3)
+            return "done"
+
+        @self.app.route('/fast_test_view')
+        def fast_test_view():
+            return "done"
+
+    def read_log(self):
+        log_path = self.wh_path / slowlog.SLOW_LOG_FILE_NAME
+        if not log_path.exists():
+            return ''
+        with open(log_path, 'rb') as f:
+            return f.read()
+
+    def test_slow_request_is_logged_with_stacks(self):
+        self.wh_path.makedirs_p()
+        self.client.get('/parcel/asdf/slow_test_view')
+        report = self.read_log()
+        self.assertIn("Slow request GET /parcel/asdf/slow_test_view "
+                      "(endpoint slow_test_view, parcel asdf)", report)
+        self.assertIn(" slow_test_view\n", report)
+
+    def test_fast_request_is_not_logged(self):
+        self.wh_path.makedirs_p()
+        self.client.get('/fast_test_view')
+        self.assertEqual(self.read_log(), '')
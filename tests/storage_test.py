@@ -4,6 +4,7 @@ from contextlib import contextmanager
 from datetime import datetime
 
 import transaction
+from mock import patch
 from common import AppTestCase
 from path import path
 
@@ -313,6 +314,376 @@ class DeleteParcelTest(AppTestCase):
         self.assertIn(parcel2.name, parcel.history[-1].description_html)
 
 
+class WorkflowTestCase(AppTestCase):
+
+    CREATE_WAREHOUSE = True
+
+    def setUp(self):
+        import flask
+        reqctx = self.app.test_request_context()
+        reqctx.push()
+        flask.g.username = 'testuser'
+        self.addCleanup(reqctx.pop)
+
+    def create_initial_parcel(self, **extra):
+        parcel = self.wh.new_parcel()
+        metadata = {
+            'stage': 'c-int',
+            'country': 'dk',
+            'lot': 'lot1',
+            'product': 'imp-deg',
+            'resolution': '20m',
+            'delivery_type': 'country',
+        }
+        metadata.update(extra)
+        parcel.save_metadata(metadata)
+        return parcel
+
+    def finalize(self, parcel, reject=False):
+        from gioland.parcel import finalize_parcel
+        finalize_parcel(self.wh, parcel, reject=reject)
+        return self.wh.get_parcel(parcel.metadata['next_parcel'])
+
+    def merge(self, parcels):
+        from gioland.definitions import LOT_STAGES
+        from gioland.parcel import create_next_parcel, link_to_next_parcel
+        stage_def = LOT_STAGES['l-vsc']
+        next_stage_def = LOT_STAGES['l-sch']
+        merged = create_next_parcel(self.wh, parcels, 'l-sch', stage_def,
+                                    next_stage_def)
+        for parcel in parcels:
+            parcel.finalize()
+            link_to_next_parcel(merged, parcel, stage_def, next_stage_def)
+        return merged
+
+
+class ChainIndexTest(WorkflowTestCase):
+
+    def test_new_parcel_starts_a_chain(self):
+        parcel = self.wh.new_parcel()
+        chain = self.wh.get_chain(parcel.name)
+        self.assertEqual(chain.id, parcel.name)
+        self.assertEqual(list(chain.parcels), [parcel.name])
+
+    def test_next_parcel_joins_the_chain_when_created(self):
+        parcel1 = self.create_initial_parcel()
+        from gioland.warehouse import Warehouse
+        with patch.object(Warehouse, '_new_chain') as new_chain:
+            parcel2 = self.finalize(parcel1)
+        self.assertFalse(new_chain.called)
+        self.assertEqual(parcel2.chain_id, parcel1.name)
+
+    def test_finalized_parcels_join_the_chain(self):
+        from gioland.parcel import walk_parcels
+        parcel1 = self.create_initial_parcel()
+        parcel2 = self.finalize(parcel1)
+        parcel3 = self.finalize(parcel2, reject=True)
+        names = [parcel1.name, parcel2.name, parcel3.name]
+        self.assertEqual(list(self.wh.get_chain(parcel3.name).parcels), names)
+        self.assertEqual(parcel3.chain_id, parcel1.name)
+        self.assertEqual([p.name for p in walk_parcels(self.wh, parcel2.name)],
+                         names[1:])
+        self.assertEqual([p.name for p in walk_parcels(self.wh, parcel2.name,
+                                                       forward=False)],
+                         names[1::-1])
+        self.assertEqual(len(self.wh.chains), 1)
+
+    def test_merge_starts_a_new_chain(self):
+        from gioland.parcel import walk_parcels
+        partial1 = self.create_initial_parcel(delivery_type='lot',
+                                              extent='partial', stage='l-vsc')
+        partial2 = self.create_initial_parcel(delivery_type='lot',
+                                              extent='partial', stage='l-vsc')
+        merged = self.merge([partial1, partial2])
+        self.assertEqual(list(self.wh.get_chain(merged.name).parcels),
+                         [merged.name])
+        self.assertEqual(list(self.wh.get_chain(partial1.name).parcels),
+                         [partial1.name])
+        self.assertEqual([p.name for p in walk_parcels(self.wh,
+                                                       partial1.name)],
+                         [partial1.name, merged.name])
+        self.assertEqual([p.name for p in walk_parcels(self.wh, merged.name,
+                                                       forward=False)],
+                         [merged.name])
+
+    def test_deleting_followers_trims_the_chain(self):
+        from gioland.parcel import delete_parcel_and_followers
+        parcel1 = self.create_initial_parcel()
+        parcel2 = self.finalize(parcel1)
+        self.finalize(parcel2)
+        delete_parcel_and_followers(self.wh, parcel2.name)
+        self.assertEqual(list(self.wh.get_chain(parcel1.name).parcels),
+                         [parcel1.name])
+        self.assertEqual(len(self.wh.chains), 1)
+
+    def forget_chains(self, parcels):
+        # as in databases that predate the chain index
+        del self.wh._chains
+        for parcel in parcels:
+            del parcel.chain_id
+        transaction.commit()
+
+    def test_old_chains_are_read_without_writing(self):
+        from gioland.parcel import get_parcels_by_stage
+        parcel1 = self.create_initial_parcel()
+        parcel2 = self.finalize(parcel1)
+        parcel3 = self.finalize(parcel2)
+        self.forget_chains([parcel1, parcel2, parcel3])
+        chain = self.wh.get_chain(parcel2.name)
+        self.assertEqual(list(chain.parcels),
+                         [parcel1.name, parcel2.name, parcel3.name])
+        self.assertEqual(list(chain.stages), ['c-int', 'c-fsc', 'c-fih'])
+        self.assertIs(get_parcels_by_stage(parcel3.name)['c-fsc'], parcel2)
+        self.assertFalse(self.wh._p_changed)
+        for parcel in [parcel1, parcel2, parcel3]:
+            self.assertFalse(parcel._p_changed)
+            self.assertIsNone(parcel.chain_id)
+
+    def test_finalizing_old_parcels_indexes_their_chain(self):
+        parcel1 = self.create_initial_parcel()
+        parcel2 = self.finalize(parcel1)
+        self.forget_chains([parcel1, parcel2])
+        parcel3 = self.finalize(parcel2)
+        self.assertEqual(list(self.wh.chains[parcel1.name].parcels),
+                         [parcel1.name, parcel2.name, parcel3.name])
+        self.assertEqual(parcel3.chain_id, parcel1.name)
+
+    def test_rebuild_chains_indexes_old_parcels(self):
+        parcel1 = self.create_initial_parcel()
+        parcel2 = self.finalize(parcel1)
+        self.forget_chains([parcel1, parcel2])
+        self.assertEqual(self.wh.rebuild_chains(), 1)
+        self.assertEqual(list(self.wh.chains[parcel1.name].stages),
+                         ['c-int', 'c-fsc'])
+        self.assertEqual(parcel2.chain_id, parcel1.name)
+
+    def test_rebuild_chains_leaves_indexed_parcels_alone(self):
+        parcel1 = self.create_initial_parcel()
+        parcel2 = self.finalize(parcel1)
+        transaction.commit()
+        self.wh.rebuild_chains()
+        self.assertFalse(parcel1._p_changed)
+        self.assertFalse(parcel2._p_changed)
+
+    def test_rebuild_chains(self):
+        parcel1 = self.create_initial_parcel()
+        parcel2 = self.finalize(parcel1)
+        other = self.wh.new_parcel()
+        self.wh.chains.clear()
+        self.assertEqual(self.wh.rebuild_chains(), 2)
+        self.assertEqual(list(self.wh.get_chain(parcel2.name).parcels),
+                         [parcel1.name, parcel2.name])
+        self.assertEqual(list(self.wh.get_chain(other.name).parcels),
+                         [other.name])
+
+    def test_chain_keeps_the_stages_of_its_parcels(self):
+        parcel1 = self.create_initial_parcel()
+        parcel2 = self.finalize(parcel1)
+        parcel3 = self.finalize(parcel2, reject=True)
+        chain = self.wh.get_chain(parcel3.name)
+        self.assertEqual(list(chain.stages), ['c-int', 'c-fsc', 'c-int'])
+        self.assertEqual(chain.stage_summary(parcel3.name),
+                         {'c-int': parcel3.name, 'c-fsc': parcel2.name})
+        self.assertEqual(chain.stage_summary(parcel2.name),
+                         {'c-int': parcel1.name, 'c-fsc': parcel2.name})
+
+    def test_stage_change_updates_the_chain(self):
+        parcel = self.create_initial_parcel()
+        parcel.save_metadata({'stage': 'c-fsc'})
+        self.assertEqual(list(self.wh.get_chain(parcel.name).stages),
+                         ['c-fsc'])
+
+    def test_stages_of_old_chains_are_read_without_writing(self):
+        parcel1 = self.create_initial_parcel()
+        parcel2 = self.finalize(parcel1)
+        chain = self.wh.chains[parcel1.name]
+        del chain.stages
+        transaction.commit()
+        self.assertEqual(list(self.wh.get_chain(parcel2.name).stages),
+                         ['c-int', 'c-fsc'])
+        self.assertIsNone(chain.stages)
+        self.wh.rebuild_chains()
+        self.assertEqual(list(self.wh.chains[parcel1.name].stages),
+                         ['c-int', 'c-fsc'])
+
+    def test_merged_chain_remembers_the_merge(self):
+        partial1 = self.create_initial_parcel(delivery_type='lot',
+                                              extent='partial', stage='l-vsc')
+        partial2 = self.create_initial_parcel(delivery_type='lot',
+                                              extent='partial', stage='l-vsc')
+        merged = self.merge([partial1, partial2])
+        self.assertEqual(self.wh.get_chain(merged.name).merged, ('l-vsc', 2))
+        self.assertIsNone(self.wh.get_chain(partial1.name).merged)
+
+    def test_parcels_by_stage(self):
+        from gioland.parcel import get_parcels_by_stage
+        parcel1 = self.create_initial_parcel()
+        parcel2 = self.finalize(parcel1)
+        stages = get_parcels_by_stage(parcel2.name)
+        self.assertIs(stages['c-int'], parcel1)
+        self.assertIs(stages['c-fsc'], parcel2)
+        self.assertIsNone(stages['c-fih'])
+
+
+class OverviewViewsTest(WorkflowTestCase):
+
+    def listed(self, delivery_type='country', code='dk'):
+        view = self.wh.get_view(delivery_type, code)
+        return {product: list(names) for product, names in view.items()}
+
+    def test_parcels_are_listed_under_their_product(self):
+        parcel = self.create_initial_parcel()
+        self.assertEqual(self.listed(), {'imp-deg': [parcel.name]})
+        self.assertEqual(self.listed(code='be'), {})
+
+    def test_only_chain_tails_are_listed(self):
+        parcel1 = self.create_initial_parcel()
+        parcel2 = self.finalize(parcel1)
+        self.assertEqual(self.listed(), {'imp-deg': [parcel2.name]})
+
+    def test_changing_metadata_moves_the_parcel(self):
+        parcel = self.create_initial_parcel()
+        parcel.save_metadata({'country': 'be'})
+        self.assertEqual(self.listed(), {})
+        self.assertEqual(self.listed(code='be'), {'imp-deg': [parcel.name]})
+
+    def test_deleting_followers_lists_the_previous_parcel(self):
+        from gioland.parcel import delete_parcel_and_followers
+        parcel1 = self.create_initial_parcel()
+        parcel2 = self.finalize(parcel1)
+        delete_parcel_and_followers(self.wh, parcel2.name)
+        self.assertEqual(self.listed(), {'imp-deg': [parcel1.name]})
+
+    def test_deleted_parcel_is_dropped(self):
+        parcel = self.create_initial_parcel()
+        self.wh.delete_parcel(parcel.name)
+        self.assertEqual(self.listed(), {})
+
+    def test_old_databases_are_read_without_writing(self):
+        parcel = self.create_initial_parcel(delivery_type='lot',
+                                            extent='partial', stage='l-int')
+        del self.wh._views
+        del parcel.view_key
+        transaction.commit()
+        self.assertEqual(self.listed('lot', 'lot1'),
+                         {'imp-deg': [parcel.name]})
+        parcel.save_metadata({'product': 'imp-chg'})
+        self.assertEqual(self.listed('lot', 'lot1'),
+                         {'imp-chg': [parcel.name]})
+        self.assertIsNone(self.wh.views)
+        self.assertIsNone(parcel.view_key)
+
+    def test_rebuild_views_indexes_old_databases(self):
+        parcel = self.create_initial_parcel()
+        del self.wh._views
+        del parcel.view_key
+        self.assertEqual(self.wh.rebuild_views(), 1)
+        self.assertEqual(self.listed(), {'imp-deg': [parcel.name]})
+        self.assertEqual(parcel.view_key, (('country', 'dk'), 'imp-deg'))
+
+    def test_rebuild_views_leaves_listed_parcels_alone(self):
+        parcel = self.create_initial_parcel()
+        transaction.commit()
+        self.wh.rebuild_views()
+        self.assertFalse(parcel._p_changed)
+
+    def test_rebuild_views(self):
+        self.create_initial_parcel()
+        self.create_initial_parcel(country='be')
+        self.wh.views.clear()
+        self.assertEqual(self.wh.rebuild_views(), 2)
+        self.assertEqual(len(self.listed()['imp-deg']), 1)
+
+    def test_overview_groups_by_product_order(self):
+        from gioland.parcel import overview_parcels
+        parcel1 = self.create_initial_parcel(product='imp-chg')
+        parcel2 = self.create_initial_parcel()
+        grouped = overview_parcels(self.wh, 'country', 'dk')
+        self.assertEqual([(product, [p.name for p in parcels])
+                          for product, parcels in grouped],
+                         [('imp-deg', [parcel2.name]),
+                          ('imp-chg', [parcel1.name])])
+
+
+class SimilarityIndexTest(WorkflowTestCase):
+
+    def create_partial(self, **extra):
+        extra.setdefault('stage', 'l-vsc')
+        return self.create_initial_parcel(delivery_type='lot',
+                                          extent='partial', **extra)
+
+    def similar_names(self, parcel):
+        from gioland.parcel import similar_parcels
+        return [p.name for p in similar_parcels(self.wh, parcel)]
+
+    def test_similar_parcels_share_metadata_and_stage(self):
+        partial1 = self.create_partial()
+        partial2 = self.create_partial()
+        self.create_partial(product='imp-chg')
+        self.create_partial(stage='l-int')
+        self.assertEqual(self.similar_names(partial1),
+                         sorted([partial1.name, partial2.name]))
+
+    def test_stage_change_moves_the_parcel(self):
+        partial1 = self.create_partial()
+        partial2 = self.create_partial(stage='l-int')
+        partial2.save_metadata({'stage': 'l-vsc'})
+        self.assertEqual(self.similar_names(partial1),
+                         sorted([partial1.name, partial2.name]))
+
+    def test_merged_parcels_are_dropped(self):
+        partial1 = self.create_partial()
+        partial2 = self.create_partial()
+        self.merge([partial1, partial2])
+        self.assertEqual(self.similar_names(partial1), [])
+
+    def test_deleted_parcel_is_dropped(self):
+        partial1 = self.create_partial()
+        partial2 = self.create_partial()
+        self.wh.delete_parcel(partial2.name)
+        self.assertEqual(self.similar_names(partial1), [partial1.name])
+
+    def forget_index(self, parcels):
+        # as in databases that predate the similarity index
+        del self.wh._similar
+        for parcel in parcels:
+            del parcel.similar_key
+        transaction.commit()
+
+    def test_old_databases_are_read_without_writing(self):
+        partial1 = self.create_partial()
+        partial2 = self.create_partial(stage='l-int')
+        self.forget_index([partial1, partial2])
+        self.assertEqual(self.similar_names(partial1), [partial1.name])
+        partial2.save_metadata({'stage': 'l-vsc'})
+        self.assertEqual(self.similar_names(partial1),
+                         sorted([partial1.name, partial2.name]))
+        self.assertIsNone(self.wh.similar)
+        self.assertIsNone(partial2.similar_key)
+
+    def test_rebuild_similar_indexes_old_databases(self):
+        partial1 = self.create_partial()
+        partial2 = self.create_partial()
+        self.forget_index([partial1, partial2])
+        from gioland.warehouse import similarity_key
+        self.assertEqual(self.wh.rebuild_similar(), 1)
+        self.assertEqual(list(self.wh.similar[similarity_key(partial1)]),
+                         sorted([partial1.name, partial2.name]))
+
+    def test_rebuild_similar_leaves_indexed_parcels_alone(self):
+        partial = self.create_partial()
+        transaction.commit()
+        self.wh.rebuild_similar()
+        self.assertFalse(partial._p_changed)
+
+    def test_rebuild_similar(self):
+        self.create_partial()
+        self.create_partial()
+        self.create_partial(stage='l-int')
+        self.wh.similar.clear()
+        self.assertEqual(self.wh.rebuild_similar(), 2)
+
+
 class ParcelHistoryTest(unittest.TestCase):
 
     def test_history_initially_empty(self):
@@ -459,3 +830,27 @@ class FilesystemSymlinkTest(AppTestCase):
             parcel.link_in_tree()
 
         self.assertEqual(parent_path.listdir(), [parent_path / '1'])
+
+
+class ZodbStatsTest(AppTestCase):
+
+    CREATE_WAREHOUSE = True
+
+    def test_cache_options_are_passed_to_database(self):
+        connector = warehouse.WarehouseConnector(self.tmp / 'wh2',
+                                                 pool_size=3, cache_size=50)
+        db = connector._get_db()
+        self.addCleanup(connector.close)
+        self.assertEqual(db.getPoolSize(), 3)
+        self.assertEqual(db.getCacheSize(), 50)
+
+    def test_stats_page(self):
+        self.add_to_role('somebody', 'ROLE_ADMIN')
+        self.client.post('/parcel/new/country', data=self.PARCEL_METADATA)
+        resp = self.client.get('/zodb_stats')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('1 commits', resp.data)
+        self.assertIn('gioland.warehouse.Parcel', resp.data)
+
+    def test_stats_page_is_for_admins(self):
+        self.assertEqual(self.client.get('/zodb_stats').status_code, 403)